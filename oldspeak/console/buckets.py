@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import sys
+import json
+
+from oldspeak import settings
+from oldspeak.console.base import get_sub_parser_argv
+
+
+def execute_command_migrate_buckets():
+    from oldspeak.console.parsers.migrate_buckets import parser
+    from oldspeak.persistence.vfs import find_repositories
+    from oldspeak.persistence.vfs import convert_to_bare
+    from oldspeak.persistence.vfs import get_registry
+
+    args = parser.parse_args(get_sub_parser_argv())
+    datadir = args.datadir or settings.OLDSPEAK_DATADIR
+
+    converted = 0
+    for path in find_repositories(datadir):
+        if not os.path.isdir(os.path.join(path, '.git')):
+            continue
+
+        if args.dry_run:
+            print "would convert {0}".format(path)
+        elif convert_to_bare(path):
+            print "converted {0}".format(path)
+
+        converted += 1
+
+    print "{0} bucket(s) {1}".format(converted, args.dry_run and 'to be converted' or 'converted')
+
+    if not args.reshard:
+        return
+
+    registry = get_registry(datadir)
+    moved = 0
+    for name in registry.rebuild(write=not args.dry_run):
+        if registry.resolve(name) == registry.location(name):
+            continue
+
+        if args.dry_run:
+            print "would move {0} to {1}".format(name, registry.location(name))
+        elif registry.migrate(name):
+            print "moved {0} to {1}".format(name, registry.location(name))
+
+        moved += 1
+
+    print "{0} bucket(s) {1}".format(moved, args.dry_run and 'to be moved' or 'moved')
+
+
+def execute_command_export_bucket():
+    from oldspeak.console.parsers.export_bucket import parser
+    from oldspeak.persistence.vfs import Bucket
+    from oldspeak.persistence.replication import export_bucket
+
+    args = parser.parse_args(get_sub_parser_argv())
+    bucket = Bucket(args.name)
+
+    if args.output:
+        with open(args.output, 'wb') as fd:
+            head = export_bucket(bucket, fd, since=args.since)
+    else:
+        head = export_bucket(bucket, sys.stdout, since=args.since)
+        sys.stdout.flush()
+
+    if head:
+        sys.stderr.write('exported {0} up to {1}\n'.format(args.name, head))
+    else:
+        sys.stderr.write('{0} has nothing newer than {1}\n'.format(args.name, args.since))
+
+
+def execute_command_import_bucket():
+    from oldspeak.console.parsers.import_bucket import parser
+    from oldspeak.persistence.vfs import Bucket
+    from oldspeak.persistence.replication import import_bucket
+
+    args = parser.parse_args(get_sub_parser_argv())
+    bucket = Bucket(args.name)
+
+    if args.input:
+        with open(args.input, 'rb') as fd:
+            head = import_bucket(bucket, fd)
+    else:
+        head = import_bucket(bucket, sys.stdin)
+
+    sys.stderr.write('imported {0} up to {1}\n'.format(args.name, head))
+
+
+def execute_command_rebuild_search():
+    from oldspeak.console.parsers.rebuild_search import parser
+    from oldspeak.persistence.vfs import Bucket
+    from oldspeak.persistence.vfs import get_registry
+    from oldspeak.persistence.search import rebuild_index
+
+    args = parser.parse_args(get_sub_parser_argv())
+    names = args.names or list(get_registry().buckets())
+
+    for name in names:
+        bucket = Bucket(name)
+        if not bucket.repo.head:
+            continue
+
+        index = rebuild_index(bucket.repo)
+        print "indexed {0} documents in {1}".format(len(index), name)
+
+
+def execute_command_benchmark_vfs():
+    from oldspeak.console.parsers.benchmark_vfs import parser
+    from oldspeak.persistence import benchmark
+
+    args = parser.parse_args(get_sub_parser_argv())
+    report = benchmark.run(
+        sizes=args.sizes,
+        depths=args.depths,
+        datadir=args.datadir,
+        samples=args.samples,
+        writers=args.writers,
+    )
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+
+    if not args.baseline:
+        return
+
+    with open(args.baseline) as fd:
+        regressions = benchmark.compare(report, json.load(fd), args.tolerance)
+
+    for regression in regressions:
+        sys.stderr.write('regression: {0}\n'.format(regression))
+
+    if regressions:
+        raise SystemExit(1)
+
+
+def execute_command_bucket_usage():
+    from oldspeak.console.parsers.bucket_usage import parser
+    from oldspeak.persistence.vfs import get_registry
+
+    args = parser.parse_args(get_sub_parser_argv())
+    registry = get_registry(args.datadir)
+
+    if args.all:
+        for name in registry.buckets(args.namespace):
+            usage = registry.usage(name)
+            print "{0}\t{1[bytes]} bytes\t{1[files]} files\t{1[objects]} objects".format(name, usage)
+
+    print json.dumps(registry.total_usage(args.namespace), indent=2)
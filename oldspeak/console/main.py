@@ -8,6 +8,12 @@ import warnings
 from oldspeak.console.base import get_main_parser_argv
 from oldspeak.console.base import execute_command_version
 from oldspeak.console.web import execute_command_webserver
+from oldspeak.console.buckets import execute_command_migrate_buckets
+from oldspeak.console.buckets import execute_command_export_bucket
+from oldspeak.console.buckets import execute_command_import_bucket
+from oldspeak.console.buckets import execute_command_rebuild_search
+from oldspeak.console.buckets import execute_command_benchmark_vfs
+from oldspeak.console.buckets import execute_command_bucket_usage
 
 
 warnings.catch_warnings()
@@ -18,6 +24,12 @@ def entrypoint():
     handlers = {
         'web': execute_command_webserver,
         'version': execute_command_version,
+        'migrate-buckets': execute_command_migrate_buckets,
+        'export-bucket': execute_command_export_bucket,
+        'import-bucket': execute_command_import_bucket,
+        'rebuild-search': execute_command_rebuild_search,
+        'benchmark-vfs': execute_command_benchmark_vfs,
+        'bucket-usage': execute_command_bucket_usage,
     }
     parser = argparse.ArgumentParser(prog='oldspeak')
     options = ", ".join(handlers.keys())
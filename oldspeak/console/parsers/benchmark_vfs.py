@@ -0,0 +1,56 @@
+import argparse
+
+
+def integers(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak benchmark-vfs',
+    description='benchmarks the buckets with thousands of files and prints a JSON report')
+
+parser.add_argument(
+    '-s', '--sizes',
+    help='comma-separated number of files of each bucket, e.g: 1000,10000,100000',
+    type=integers,
+    default='1000,10000,100000',
+)
+parser.add_argument(
+    '-d', '--depths',
+    help='comma-separated number of folders deep the files are, e.g: 1,3,6',
+    type=integers,
+    default='1,3,6',
+)
+parser.add_argument(
+    '-n', '--samples',
+    help='how many times to write and read single files',
+    type=int,
+    default=200,
+)
+parser.add_argument(
+    '-w', '--writers',
+    help='how many greenlets write to the bucket at the same time',
+    type=int,
+    default=8,
+)
+parser.add_argument(
+    '--datadir',
+    help='keep the generated buckets in this folder instead of a temporary one',
+    default=None,
+)
+parser.add_argument(
+    '-o', '--output',
+    help='the path of the JSON report, defaults to the stdout',
+    default=None,
+)
+parser.add_argument(
+    '-b', '--baseline',
+    help='a previous report to compare with, exits with 1 when there are regressions',
+    default=None,
+)
+parser.add_argument(
+    '-t', '--tolerance',
+    help='how much slower than the baseline is still acceptable, defaults to 0.2',
+    type=float,
+    default=0.2,
+)
@@ -0,0 +1,23 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak bucket-usage',
+    description='prints how much the buckets store from their running totals')
+
+parser.add_argument(
+    'namespace',
+    help='only count the buckets in this namespace, e.g: fingerprint',
+    nargs='?',
+    default=None,
+)
+parser.add_argument(
+    '-d', '--datadir',
+    help='the folder where the buckets are stored',
+    default=None,
+)
+parser.add_argument(
+    '-a', '--all',
+    help='also print the usage of each bucket',
+    action='store_true',
+    default=False,
+)
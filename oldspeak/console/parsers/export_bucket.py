@@ -0,0 +1,20 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak export-bucket',
+    description='writes a git bundle with the history of a bucket')
+
+parser.add_argument(
+    'name',
+    help='the name of the bucket, e.g: system/core',
+)
+parser.add_argument(
+    '-s', '--since',
+    help='only export the commits that came after this one',
+    default=None,
+)
+parser.add_argument(
+    '-o', '--output',
+    help='the path of the bundle, defaults to the stdout',
+    default=None,
+)
@@ -0,0 +1,15 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak import-bucket',
+    description='applies a git bundle written by export-bucket to a bucket')
+
+parser.add_argument(
+    'name',
+    help='the name of the bucket, e.g: system/core',
+)
+parser.add_argument(
+    '-i', '--input',
+    help='the path of the bundle, defaults to the stdin',
+    default=None,
+)
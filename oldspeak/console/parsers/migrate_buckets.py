@@ -0,0 +1,23 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak migrate-buckets',
+    description='converts the bucket repositories that still have a working tree into bare repositories')
+
+parser.add_argument(
+    '-d', '--datadir',
+    help='the folder where the buckets are stored',
+    default=None,
+)
+parser.add_argument(
+    '-r', '--reshard',
+    help='also move the buckets into the sharded folder layout and rebuild the catalog',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '-n', '--dry-run',
+    help='only list the repositories that would be converted',
+    action='store_true',
+    default=False,
+)
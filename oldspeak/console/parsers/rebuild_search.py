@@ -0,0 +1,11 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    prog='oldspeak rebuild-search',
+    description='rebuilds the full-text search index of buckets')
+
+parser.add_argument(
+    'names',
+    help='the names of the buckets, defaults to every bucket',
+    nargs='*',
+)
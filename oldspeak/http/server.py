@@ -16,6 +16,8 @@ from oldspeak.lib.logs import configure_logging
 from oldspeak.lib.networking import get_free_tcp_port
 from oldspeak.http.core import html
 from oldspeak.http.endpoints import get_server_components
+from oldspeak.persistence.sql.session import open_session
+from oldspeak.persistence.sql.session import close_session
 
 COLORED_LOGS_LEVEL = os.environ.get('COLORED_LOGS_LEVEL')
 
@@ -52,6 +54,11 @@ class Application(Flask):
             logger.info('registering component {}'.format(bp))
             self.register_blueprint(bp)
 
+        # every request runs in its own greenlet and gets its own
+        # database connections, returned to the pool at the end
+        self.before_request(open_session)
+        self.teardown_request(lambda error: close_session())
+
     def run(self, **kw):
         kw['host'] = kw.pop('host', self.host)
         kw['port'] = kw.pop('port', self.port)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""a reproducible benchmark of :py:mod:`oldspeak.persistence.vfs`.
+
+Generates buckets with thousands of files at varying depths, times the
+common operations and reports the results as JSON so that every change
+can be compared against a stored baseline::
+
+    oldspeak benchmark-vfs --output report.json --baseline baseline.json
+"""
+import time
+import random
+import shutil
+import resource
+import tempfile
+import platform
+from collections import OrderedDict
+
+import gevent
+from gevent import subprocess
+
+from oldspeak import settings
+from oldspeak.persistence import vfs
+from oldspeak.persistence.offload import git_threads
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_DEPTHS = (1, 3, 6)
+
+# how many entries each folder of a generated bucket has
+FANOUT = 16
+
+
+def percentile(values, fraction):
+    """returns the value below which ``fraction`` of the sorted
+    ``values`` fall, using the nearest rank"""
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def get_rss():
+    """returns the resident set size of the process in bytes"""
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+
+        return pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is the peak in KB on linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+
+def count_objects(git_dir):
+    """returns the output of ``git count-objects -v`` as a dict"""
+    process = subprocess.Popen(
+        ['git', '--git-dir', git_dir, 'count-objects', '-v'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = process.communicate()
+    result = OrderedDict()
+    for line in stdout.splitlines():
+        key, _, value = line.partition(':')
+        if value.strip().isdigit():
+            result[key.strip().replace('-', '_')] = int(value)
+
+    return result
+
+
+def generate_paths(count, depth, seed=0):
+    """returns ``count`` distinct paths nested ``depth`` folders deep,
+    the same arguments always generate the same paths"""
+    generator = random.Random(seed)
+    paths = []
+    for number in xrange(count):
+        folders = ['d{:02d}'.format(generator.randint(0, FANOUT - 1)) for _ in xrange(depth - 1)]
+        folders.append('file-{:08d}.txt'.format(number))
+        paths.append('/'.join(folders))
+
+    return paths
+
+
+def generate_data(path, size):
+    line = '{} '.format(path)
+    return (line * (size // len(line) + 1))[:size]
+
+
+class Measurement(object):
+    """collects the latency of each run of an operation"""
+    __slots__ = ('name', 'latencies', 'started', 'finished')
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def __enter__(self):
+        self.started = self.started or time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.finished = time.time()
+
+    def time(self, function, *args, **kw):
+        started = time.time()
+        result = function(*args, **kw)
+        self.latencies.append(time.time() - started)
+        return result
+
+    def to_dict(self):
+        elapsed = (self.finished or time.time()) - (self.started or time.time())
+        operations = len(self.latencies)
+        return OrderedDict([
+            ('operations', operations),
+            ('elapsed', elapsed),
+            ('ops_per_second', operations / elapsed if elapsed else None),
+            ('p50', percentile(self.latencies, 0.50)),
+            ('p99', percentile(self.latencies, 0.99)),
+        ])
+
+
+class Scenario(object):
+    """a bucket with ``size`` files ``depth`` folders deep and the
+    measurements of the operations run against it"""
+
+    def __init__(self, size, depth, batch_size=1000, file_size=256, samples=200, writers=8, page_size=100):
+        self.size = size
+        self.depth = depth
+        self.batch_size = batch_size
+        self.file_size = file_size
+        self.samples = samples
+        self.writers = writers
+        self.page_size = page_size
+        self.name = '{}x{}'.format(size, depth)
+        self.paths = generate_paths(size, depth)
+        self.measurements = OrderedDict()
+
+    def measure(self, name):
+        measurement = self.measurements[name] = Measurement(name)
+        return measurement
+
+    def populate(self, bucket):
+        with self.measure('populate') as measurement:
+            for start in xrange(0, len(self.paths), self.batch_size):
+                batch = self.paths[start:start + self.batch_size]
+                measurement.time(bucket.write_files, dict(
+                    (path, generate_data(path, self.file_size)) for path in batch
+                ))
+
+    def write_file(self, bucket):
+        generator = random.Random(self.size)
+        with self.measure('write_file') as measurement:
+            for number in xrange(self.samples):
+                path = generator.choice(self.paths)
+                measurement.time(bucket.write_file, path, generate_data(path, self.file_size + number))
+
+    def read_file(self, bucket):
+        generator = random.Random(self.size + 1)
+        with self.measure('read_file') as measurement:
+            for _ in xrange(self.samples):
+                measurement.time(bucket.read_file, generator.choice(self.paths))
+
+    def list(self, bucket):
+        with self.measure('list') as measurement:
+            cursor = None
+            while True:
+                page = measurement.time(bucket.list, limit=self.page_size, cursor=cursor)
+                if len(page) < self.page_size:
+                    break
+
+                cursor = page[-1]
+
+    def traverse_blobs(self, bucket):
+        with self.measure('traverse_blobs') as measurement:
+            measurement.time(lambda: sum(1 for _ in bucket.repo.traverse_blobs()))
+
+    def history(self, bucket):
+        with self.measure('history') as measurement:
+            cursor = None
+            while True:
+                page = measurement.time(bucket.history, limit=self.page_size, cursor=cursor)
+                if len(page) < self.page_size:
+                    break
+
+                cursor = page[-1]['oid']
+
+    def concurrent_writers(self, bucket):
+        def write(writer):
+            for number in xrange(self.samples // self.writers or 1):
+                path = 'writers/{}/{:08d}.txt'.format(writer, number)
+                measurement.time(bucket.write_file, path, generate_data(path, self.file_size))
+
+        with self.measure('concurrent_writers') as measurement:
+            gevent.joinall([gevent.spawn(write, writer) for writer in xrange(self.writers)], raise_error=True)
+
+    def run(self, bucket):
+        rss = get_rss()
+        self.populate(bucket)
+        self.write_file(bucket)
+        self.read_file(bucket)
+        self.list(bucket)
+        self.traverse_blobs(bucket)
+        self.history(bucket)
+        self.concurrent_writers(bucket)
+
+        return OrderedDict([
+            ('size', self.size),
+            ('depth', self.depth),
+            ('operations', OrderedDict([
+                (name, measurement.to_dict()) for name, measurement in self.measurements.items()
+            ])),
+            ('objects', count_objects(bucket.repo.git.path)),
+            ('git_threads', git_threads.stats()),
+            ('rss', get_rss()),
+            ('rss_growth', get_rss() - rss),
+        ])
+
+
+def run(sizes=DEFAULT_SIZES, depths=DEFAULT_DEPTHS, datadir=None, **kw):
+    """runs a :py:class:`Scenario` for every combination of ``sizes``
+    and ``depths`` in a scratch data dir and returns the report.
+
+    The data dir is a temporary folder removed at the end unless one
+    is given.
+    """
+    scratch = datadir or tempfile.mkdtemp(prefix='oldspeak-benchmark-')
+    original_datadir = settings.OLDSPEAK_DATADIR
+    settings.OLDSPEAK_DATADIR = scratch
+    vfs.clear_caches()
+
+    report = OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('started', time.time()),
+        ('scenarios', OrderedDict()),
+    ])
+    try:
+        for size in sizes:
+            for depth in depths:
+                scenario = Scenario(size, depth, **kw)
+                bucket = vfs.Bucket('benchmark/{}'.format(scenario.name))
+                report['scenarios'][scenario.name] = scenario.run(bucket)
+    finally:
+        settings.OLDSPEAK_DATADIR = original_datadir
+        vfs.clear_caches()
+        if not datadir:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    report['finished'] = time.time()
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """returns a list of human-readable regressions of ``report`` in
+    relation to ``baseline``: throughput that dropped or p99 latency
+    that grew by more than ``tolerance``"""
+    regressions = []
+    for name, scenario in report['scenarios'].items():
+        reference = baseline.get('scenarios', {}).get(name)
+        if not reference:
+            continue
+
+        for operation, current in scenario['operations'].items():
+            previous = reference['operations'].get(operation)
+            if not previous:
+                continue
+
+            if previous['ops_per_second'] and (current['ops_per_second'] or 0) < previous['ops_per_second'] * (1 - tolerance):
+                regressions.append('{} {}: {:.1f} ops/s, was {:.1f}'.format(
+                    name, operation, current['ops_per_second'], previous['ops_per_second']))
+
+            if previous['p99'] and (current['p99'] or 0) > previous['p99'] * (1 + tolerance):
+                regressions.append('{} {}: p99 {:.2f}ms, was {:.2f}ms'.format(
+                    name, operation, current['p99'] * 1000, previous['p99'] * 1000))
+
+    return regressions
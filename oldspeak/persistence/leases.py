@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import uuid
+import socket
+from contextlib import contextmanager
+
+import gevent
+
+from oldspeak import settings
+from oldspeak.core import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class LeaseUnavailable(Exception):
+    """raised when another node holds the lease for longer than we
+    are willing to wait"""
+
+
+class LeaseLost(Exception):
+    """raised when a lease expired or was taken over before the write
+    that depended on it"""
+
+
+ACQUIRE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return nil
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+return token
+"""
+
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLeaseBackend(object):
+    """stores the leases in redis, each bucket has a key with the
+    ``owner:token`` of the current holder that expires on its own and
+    a counter that hands out the fencing tokens"""
+
+    def __init__(self, connection, prefix='oldspeak:lease:'):
+        self.connection = connection
+        self.prefix = prefix
+        self.acquire_script = connection.register_script(ACQUIRE_SCRIPT)
+        self.renew_script = connection.register_script(RENEW_SCRIPT)
+        self.release_script = connection.register_script(RELEASE_SCRIPT)
+
+    def keys(self, name):
+        return ['{}{}'.format(self.prefix, name), '{}{}:fence'.format(self.prefix, name)]
+
+    def acquire(self, name, owner, ttl):
+        """returns a new fencing token or ``None`` if the lease is
+        held by someone else, ``ttl`` is in seconds"""
+        token = self.acquire_script(keys=self.keys(name), args=[owner, int(ttl * 1000)])
+        return int(token) if token else None
+
+    def renew(self, name, owner, token, ttl):
+        value = '{}:{}'.format(owner, token)
+        return bool(self.renew_script(keys=self.keys(name)[:1], args=[value, int(ttl * 1000)]))
+
+    def release(self, name, owner, token):
+        value = '{}:{}'.format(owner, token)
+        return bool(self.release_script(keys=self.keys(name)[:1], args=[value]))
+
+
+class LocalLeaseBackend(object):
+    """an in-memory stand-in for :py:class:`RedisLeaseBackend` with the
+    same semantics, for tests and single node setups"""
+
+    def __init__(self):
+        self.leases = {}
+        self.fences = {}
+
+    def holder(self, name):
+        value, expires = self.leases.get(name, (None, 0))
+        if expires <= time.time():
+            self.leases.pop(name, None)
+            return None
+
+        return value
+
+    def acquire(self, name, owner, ttl):
+        if self.holder(name) is not None:
+            return None
+
+        token = self.fences[name] = self.fences.get(name, 0) + 1
+        self.leases[name] = ('{}:{}'.format(owner, token), time.time() + ttl)
+        return token
+
+    def renew(self, name, owner, token, ttl):
+        value = '{}:{}'.format(owner, token)
+        if self.holder(name) != value:
+            return False
+
+        self.leases[name] = (value, time.time() + ttl)
+        return True
+
+    def release(self, name, owner, token):
+        if self.holder(name) != '{}:{}'.format(owner, token):
+            return False
+
+        del self.leases[name]
+        return True
+
+
+def write_fence(folder, token):
+    """records the fencing token of a write next to the repository,
+    refusing tokens older than the last one recorded.
+
+    A node that was paused for longer than its lease and resumes
+    writing is stopped here, since whoever took the lease over has
+    written a newer token.
+    """
+    path = os.path.join(folder, 'fence')
+    if os.path.exists(path):
+        with open(path) as fd:
+            last = int(fd.read().strip() or 0)
+
+        if token < last:
+            raise LeaseLost('fencing token {} is older than {} in {}'.format(token, last, folder))
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as fd:
+        fd.write('{}\n'.format(token))
+
+    os.rename(temporary_path, path)
+
+
+class Lease(object):
+    """a time-bounded write lease on a bucket, renewed in a background
+    greenlet until it is released"""
+
+    def __init__(self, manager, name, token, expires):
+        self.manager = manager
+        self.name = name
+        self.token = token
+        self.expires = expires
+        self.lost = False
+        self.renewer = None
+
+    def __repr__(self):
+        return '<Lease {} token={}>'.format(self.name, self.token)
+
+    @property
+    def valid(self):
+        return not self.lost and time.time() < self.expires
+
+    def renew(self):
+        started = time.time()
+        renewed = self.manager.backend.renew(self.name, self.manager.owner, self.token, self.manager.ttl)
+        if renewed:
+            self.expires = started + self.manager.ttl
+        else:
+            self.lost = True
+            logger.warning('lost the write lease of %s', self.name)
+
+        return renewed
+
+    def keep_alive(self):
+        while self.valid:
+            gevent.sleep(self.manager.ttl / 3.0)
+            if not self.lost:
+                self.renew()
+
+    def start(self):
+        self.renewer = gevent.spawn(self.keep_alive)
+
+    def release(self):
+        if self.renewer is not None:
+            self.renewer.kill(block=False)
+            self.renewer = None
+
+        if not self.lost:
+            self.manager.backend.release(self.name, self.manager.owner, self.token)
+            self.lost = True
+
+    def fence(self, folder):
+        """makes sure that the lease is still held and records its
+        token in ``folder``, call right before committing"""
+        if not self.valid:
+            raise LeaseLost('the write lease of {} expired'.format(self.name))
+
+        write_fence(folder, self.token)
+
+
+class LeaseManager(object):
+    """hands out fenced write leases per bucket so that only one node
+    at a time commits to a repository on shared storage.
+
+    Readers never take leases.
+    """
+
+    def __init__(self, backend, owner=None, ttl=None, wait=None, retry_interval=0.05):
+        self.backend = backend
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl or settings.VFS_LEASE_TTL
+        self.wait = wait if wait is not None else settings.VFS_LEASE_WAIT
+        self.retry_interval = retry_interval
+        self.held = {}
+
+    def acquire(self, name, wait=None):
+        """returns a :py:class:`Lease`, waiting up to ``wait`` seconds
+        for the current holder to release it"""
+        deadline = time.time() + (self.wait if wait is None else wait)
+        while True:
+            started = time.time()
+            token = self.backend.acquire(name, self.owner, self.ttl)
+            if token:
+                lease = Lease(self, name, token, started + self.ttl)
+                lease.start()
+                return lease
+
+            if time.time() >= deadline:
+                raise LeaseUnavailable('the write lease of {} is held by another node'.format(name))
+
+            gevent.sleep(self.retry_interval)
+
+    @contextmanager
+    def hold(self, name, wait=None):
+        """holds the lease of a bucket for the duration of the block,
+        greenlets of the same process share it"""
+        lease, users = self.held.get(name) or (None, 0)
+        if lease is None or not lease.valid:
+            lease = self.acquire(name, wait)
+
+        self.held[name] = (lease, users + 1)
+        try:
+            yield lease
+        finally:
+            lease, users = self.held.pop(name)
+            if users > 1:
+                self.held[name] = (lease, users - 1)
+            else:
+                lease.release()
+
+
+managers = {}
+
+
+def get_lease_manager():
+    """returns the process-wide :py:class:`LeaseManager` or ``None``
+    when write leases are disabled"""
+    if not settings.VFS_WRITE_LEASES:
+        return None
+
+    manager = managers.get(settings.VFS_LEASE_BACKEND)
+    if manager is None:
+        if settings.VFS_LEASE_BACKEND == 'redis':
+            from oldspeak.persistence import connectors
+            backend = RedisLeaseBackend(connectors.redis.get_connection())
+        else:
+            backend = LocalLeaseBackend()
+
+        manager = managers.setdefault(settings.VFS_LEASE_BACKEND, LeaseManager(backend))
+
+    return manager
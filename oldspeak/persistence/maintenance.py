@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from collections import deque
+from collections import OrderedDict
+
+import gevent
+from gevent import subprocess
+
+from oldspeak import settings
+from oldspeak.core import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def count_loose_objects(git_dir):
+    """counts the loose objects in the object database of a git
+    repository"""
+    objects_dir = os.path.join(git_dir, 'objects')
+    if not os.path.isdir(objects_dir):
+        return 0
+
+    total = 0
+    for name in os.listdir(objects_dir):
+        if len(name) == 2:
+            total += len(os.listdir(os.path.join(objects_dir, name)))
+
+    return total
+
+
+def count_packs(git_dir):
+    pack_dir = os.path.join(git_dir, 'objects', 'pack')
+    if not os.path.isdir(pack_dir):
+        return 0
+
+    return len([name for name in os.listdir(pack_dir) if name.endswith('.pack')])
+
+
+class RepositoryStats(object):
+    __slots__ = ('git_dir', 'loose_objects', 'packs', 'repacks', 'last_repack', 'scheduled', 'packer')
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.loose_objects = count_loose_objects(git_dir)
+        self.packs = count_packs(git_dir)
+        self.repacks = 0
+        self.last_repack = None
+        self.scheduled = False
+        # packs the objects instead of git repack, e.g: for the shared
+        # object store
+        self.packer = None
+
+    def to_dict(self):
+        return OrderedDict([
+            ('loose_objects', self.loose_objects),
+            ('packs', self.packs),
+            ('repacks', self.repacks),
+            ('last_repack', self.last_repack),
+            ('scheduled', self.scheduled),
+        ])
+
+
+class Maintenance(object):
+    """keeps track of how many loose objects each repository has and
+    repacks them in a background greenlet once they cross
+    ``threshold``.
+
+    Repacks run one at a time, at most once every ``min_interval``
+    seconds and never twice in a row for the same repository within
+    ``cooldown`` seconds, so they don't compete with the writes. The
+    git commands run through ``gevent.subprocess`` and never block the
+    hub.
+    """
+
+    def __init__(self, threshold=None, min_interval=None, cooldown=None, prune_expire=None):
+        self.threshold = threshold or settings.VFS_REPACK_LOOSE_OBJECTS
+        self.min_interval = min_interval if min_interval is not None else settings.VFS_REPACK_MIN_INTERVAL
+        self.cooldown = cooldown if cooldown is not None else settings.VFS_REPACK_COOLDOWN
+        self.prune_expire = prune_expire or settings.VFS_PRUNE_EXPIRE
+        self.repositories = OrderedDict()
+        self.queue = deque()
+        self.lock = threading.RLock()
+        self.worker = None
+
+    def get_stats(self, git_dir):
+        with self.lock:
+            stats = self.repositories.get(git_dir)
+            if stats is None:
+                stats = self.repositories[git_dir] = RepositoryStats(git_dir)
+
+            return stats
+
+    def stats(self, git_dir=None):
+        """returns the stats of a repository or of every tracked
+        repository when no ``git_dir`` is given"""
+        if git_dir:
+            return self.get_stats(git_dir).to_dict()
+
+        return OrderedDict([(path, stats.to_dict()) for path, stats in self.repositories.items()])
+
+    def forget(self, git_dir):
+        """drops the stats of a repository that was closed, they are
+        counted again from disk if it is opened later"""
+        with self.lock:
+            self.repositories.pop(git_dir, None)
+            if git_dir in self.queue:
+                self.queue.remove(git_dir)
+
+    def track(self, git_dir, new_objects, packer=None):
+        """records that ``new_objects`` loose objects were just written
+        to the repository and schedules a repack when needed, the
+        repack calls ``packer()`` when given"""
+        stats = self.get_stats(git_dir)
+        if packer is not None:
+            stats.packer = packer
+
+        stats.loose_objects += new_objects
+        if stats.loose_objects >= self.threshold:
+            self.schedule(git_dir)
+
+        return stats
+
+    def schedule(self, git_dir):
+        stats = self.get_stats(git_dir)
+        with self.lock:
+            if stats.scheduled:
+                return False
+
+            stats.scheduled = True
+            self.queue.append(git_dir)
+
+        if self.worker is None or self.worker.dead:
+            self.worker = gevent.spawn(self.run_forever)
+
+        return True
+
+    def run_git(self, git_dir, *args):
+        command = ['git', '--git-dir', git_dir] + list(args)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.error('%s failed: %s', ' '.join(command), stderr.strip())
+
+        return process.returncode == 0
+
+    def repack(self, git_dir):
+        """packs the loose objects of a repository and prunes the
+        unreachable ones.
+
+        Only objects older than ``prune_expire`` are pruned, so that
+        objects written by a commit that is still in-flight survive.
+        """
+        stats = self.get_stats(git_dir)
+        started = time.time()
+        try:
+            if stats.packer is not None:
+                packed = stats.packer()
+            else:
+                # -l leaves out the objects borrowed from the shared object store
+                packed = self.run_git(git_dir, 'repack', '-a', '-d', '-l', '-q')
+                if packed:
+                    self.run_git(git_dir, 'prune', '--expire', self.prune_expire)
+
+            stats.loose_objects = count_loose_objects(git_dir)
+            stats.packs = count_packs(git_dir)
+            stats.repacks += 1
+        finally:
+            stats.last_repack = time.time()
+            stats.scheduled = False
+
+        logger.info('repacked %s in %.2fs', git_dir, stats.last_repack - started)
+        return packed
+
+    def repack_safely(self, git_dir):
+        """repacks a repository, logging failures instead of raising
+        them so that one broken repository doesn't stop the others"""
+        try:
+            return self.repack(git_dir)
+        except Exception:
+            logger.exception('failed to repack %s', git_dir)
+            return False
+
+    def next_repository(self):
+        with self.lock:
+            for _ in range(len(self.queue)):
+                git_dir = self.queue.popleft()
+                stats = self.repositories.get(git_dir)
+                if stats is None:
+                    continue
+
+                if stats.last_repack and time.time() - stats.last_repack < self.cooldown:
+                    self.queue.append(git_dir)
+                    continue
+
+                return git_dir
+
+    def run_pending(self):
+        """repacks every repository that is due without waiting, returns
+        the number of repositories repacked"""
+        count = 0
+        git_dir = self.next_repository()
+        while git_dir:
+            self.repack_safely(git_dir)
+            count += 1
+            git_dir = self.next_repository()
+
+        return count
+
+    def run_forever(self):
+        while self.queue:
+            git_dir = self.next_repository()
+            if git_dir:
+                self.repack_safely(git_dir)
+
+            gevent.sleep(self.min_interval)
+
+
+maintenance = Maintenance()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+from gevent.lock import Semaphore
+from gevent.threadpool import ThreadPool
+
+from oldspeak import settings
+
+
+class GitThreadPool(object):
+    """runs blocking libgit2 calls in a bounded pool of native threads
+    so that a big commit doesn't hold the gevent hub and stall every
+    other request of the process.
+
+    Calls are keyed by the git dir of the handle they use and calls
+    with the same key run one at a time in the order they were
+    submitted, a pygit2 handle must not be used by several threads at
+    once. The functions run outside of the hub and must not touch
+    gevent primitives, e.g: the locks of a :py:class:`RepositoryPool`.
+
+    With ``size=0`` the calls run inline in the calling greenlet.
+    """
+
+    def __init__(self, size=None):
+        self.size = settings.VFS_GIT_THREADS if size is None else size
+        self.pool = None
+        self.keys = {}
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.size)
+
+        return self.pool
+
+    def acquire(self, key):
+        lock, users = self.keys.get(key) or (Semaphore(), 0)
+        self.keys[key] = (lock, users + 1)
+        try:
+            lock.acquire()
+        except BaseException:
+            # e.g: a timeout while waiting for the previous calls
+            self.leave(key)
+            raise
+
+    def leave(self, key):
+        lock, users = self.keys[key]
+        if users > 1:
+            self.keys[key] = (lock, users - 1)
+        else:
+            del self.keys[key]
+
+    def release(self, key):
+        self.keys[key][0].release()
+        self.leave(key)
+
+    def run(self, key, function, *args, **kw):
+        """calls ``function(*args, **kw)`` in a thread after every
+        previous call with the same ``key`` finished and returns its
+        result, the calling greenlet yields to the others meanwhile"""
+        if not self.size:
+            return function(*args, **kw)
+
+        submitted = time.time()
+        started = []
+
+        def call():
+            started.append(time.time())
+            return function(*args, **kw)
+
+        acquired = False
+        self.pending += 1
+        try:
+            self.acquire(key)
+            acquired = True
+            self.running += 1
+            result = self.get_pool().apply(call)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            if acquired:
+                self.running -= 1
+                self.release(key)
+            if started:
+                wait = started[0] - submitted
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        """``pending`` is the queue depth: calls submitted but not
+        finished, ``running`` the calls handed to the threads"""
+        finished = self.completed + self.failed
+        return OrderedDict([
+            ('size', self.size),
+            ('pending', self.pending),
+            ('running', self.running),
+            ('completed', self.completed),
+            ('failed', self.failed),
+            ('average_wait', self.total_wait / finished if finished else 0.0),
+            ('max_wait', self.max_wait),
+        ])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.kill()
+            self.pool = None
+
+
+git_threads = GitThreadPool()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from gevent import subprocess
+
+from oldspeak.core import get_logger
+
+
+logger = get_logger(__name__)
+
+BUNDLE_REFERENCE = 'refs/heads/master'
+# bundles are fetched here before the branch is moved to them
+IMPORT_REFERENCE = 'refs/oldspeak/import'
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def run_git(git_dir, *args):
+    command = ['git', '--git-dir', git_dir] + list(args)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise ReplicationError('{} failed: {}'.format(' '.join(command), stderr.strip()))
+
+    return stdout
+
+
+def make_temporary_file():
+    fd, path = tempfile.mkstemp(prefix='oldspeak-', suffix='.bundle')
+    os.close(fd)
+    return path
+
+
+def export_bucket(bucket, fileobj, since=None):
+    """writes a git bundle with the history of a bucket into
+    ``fileobj``.
+
+    When ``since`` is given only the objects that were added after
+    that commit are included, the receiver must already have it.
+
+    :returns: the oid of the newest commit in the bundle or ``None``
+      if there is nothing newer than ``since``.
+    """
+    head = bucket.repo.head
+    if not head:
+        raise ReplicationError('{} is empty'.format(bucket.path))
+
+    if since and since == head.hex:
+        return None
+
+    revision = BUNDLE_REFERENCE
+    if since:
+        revision = '{}..{}'.format(since, BUNDLE_REFERENCE)
+
+    path = make_temporary_file()
+    try:
+        run_git(bucket.repo.git.path, 'bundle', 'create', path, revision)
+        with open(path, 'rb') as bundle:
+            shutil.copyfileobj(bundle, fileobj)
+    finally:
+        os.remove(path)
+
+    logger.info('exported %s from %s', bucket.path, since or 'the beginning')
+    return head.hex
+
+
+def import_bucket(bucket, fileobj):
+    """applies a bundle written by :py:func:`export_bucket` on top of a
+    bucket, creating it if needed. Only fast-forwards are accepted.
+
+    The objects are fetched aside and the branch is then moved like
+    the commits of the bucket are, under its write lease and with a
+    compare-and-swap.
+
+    :returns: the oid of the new head of the bucket
+    """
+    from oldspeak.persistence.vfs import CommitConflict
+
+    path = make_temporary_file()
+    git_dir = bucket.repo.git.path
+    try:
+        with open(path, 'wb') as bundle:
+            shutil.copyfileobj(fileobj, bundle)
+
+        run_git(git_dir, 'bundle', 'verify', path)
+        run_git(git_dir, 'fetch', '--quiet', path, '+{0}:{1}'.format(BUNDLE_REFERENCE, IMPORT_REFERENCE))
+        target = run_git(git_dir, 'rev-parse', IMPORT_REFERENCE).strip()
+        bucket.repo.fast_forward(target, 'importing {}'.format(target))
+    except CommitConflict as error:
+        raise ReplicationError(str(error))
+    finally:
+        os.remove(path)
+        run_git(git_dir, 'update-ref', '-d', IMPORT_REFERENCE)
+
+    logger.info('imported %s up to %s', bucket.path, target)
+    return target
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import uuid
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from oldspeak import settings
+from oldspeak.core import get_logger
+from oldspeak.persistence import vfs
+
+
+logger = get_logger(__name__)
+
+TOKEN_REGEX = re.compile(r'\w+', re.UNICODE)
+QUERY_REGEX = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """returns the lowercase terms of a text in order"""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+
+    return [match.group(0).lower() for match in TOKEN_REGEX.finditer(text)]
+
+
+def parse_query(query):
+    """turns a query into a list of phrases, each phrase is a list of
+    terms, e.g: ``todo "white listed"`` becomes
+    ``[['todo'], ['white', 'listed']]``"""
+    phrases = []
+    for quoted, word in QUERY_REGEX.findall(query):
+        terms = tokenize(quoted or word)
+        if terms:
+            phrases.append(terms)
+
+    return phrases
+
+
+def is_indexable(path):
+    return os.path.splitext(path)[1].lower() in settings.VFS_SEARCH_EXTENSIONS
+
+
+class Segment(object):
+    """an immutable batch of indexed documents.
+
+    Besides the positional postings of its documents a segment lists
+    the documents that were deleted, a path is owned by the newest
+    segment that mentions it.
+    """
+    __slots__ = ('name', 'docs', 'deleted', 'postings')
+
+    def __init__(self, name, docs=None, deleted=None, postings=None):
+        self.name = name
+        self.docs = docs or {}
+        self.deleted = set(deleted or [])
+        self.postings = postings or {}
+
+    def __len__(self):
+        return len(self.docs) + len(self.deleted)
+
+    @classmethod
+    def load(cls, folder, name):
+        with open(os.path.join(folder, name)) as fd:
+            data = json.load(fd)
+
+        return cls(name, data['docs'], data['deleted'], data['postings'])
+
+    def save(self, folder):
+        temporary_path = os.path.join(folder, '{}.tmp'.format(self.name))
+        with open(temporary_path, 'w') as fd:
+            json.dump({
+                'docs': self.docs,
+                'deleted': sorted(self.deleted),
+                'postings': self.postings,
+            }, fd)
+
+        os.rename(temporary_path, os.path.join(folder, self.name))
+
+    def add(self, path, oid, text):
+        self.deleted.discard(path)
+        self.docs[path] = oid
+        for position, term in enumerate(tokenize(text)):
+            self.postings.setdefault(term, {}).setdefault(path, []).append(position)
+
+    def delete(self, path):
+        self.docs.pop(path, None)
+        self.deleted.add(path)
+
+
+class SearchIndex(object):
+    """an inverted index of the text files of a repository made of
+    immutable segments.
+
+    Every time the head of the repository moves, the paths that
+    changed since the last indexed commit are written to a new segment.
+    Segments are merged into one once there are more than
+    ``settings.VFS_SEARCH_MAX_SEGMENTS`` of them.
+
+    Processes that share the folder update it one at a time: the
+    manifest is read again under a lock before it is changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.clear()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.path, 'manifest.lock')
+
+    def clear(self):
+        self.commit = None
+        self.segments = []
+        self.owners = {}
+        self.counter = 0
+        self.version = None
+
+    def __len__(self):
+        return len(self.owners)
+
+    @contextmanager
+    def locked(self):
+        """holds the lock of the index across threads and processes"""
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            with open(self.lock_path, 'a') as fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def get_version(self):
+        """identifies the manifest on disk, which is replaced rather
+        than changed in place"""
+        try:
+            stat = os.stat(self.manifest_path)
+        except OSError:
+            return None
+
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    def refresh(self):
+        """loads the manifest again if another process replaced it"""
+        if self.get_version() != self.version:
+            self.load()
+
+        return self
+
+    def load(self):
+        self.clear()
+        self.version = self.get_version()
+        if self.version is None:
+            return self
+
+        with open(self.manifest_path) as fd:
+            manifest = json.load(fd)
+
+        self.commit = manifest['commit']
+        self.counter = manifest['counter']
+        for name in manifest['segments']:
+            self.append(Segment.load(self.path, name))
+
+        return self
+
+    def save(self):
+        temporary_path = '{}.tmp'.format(self.manifest_path)
+        with open(temporary_path, 'w') as fd:
+            json.dump({
+                'commit': self.commit,
+                'counter': self.counter,
+                'segments': [segment.name for segment in self.segments],
+            }, fd)
+
+        os.rename(temporary_path, self.manifest_path)
+        self.version = self.get_version()
+
+    def append(self, segment):
+        index = len(self.segments)
+        self.segments.append(segment)
+        for path in segment.docs:
+            self.owners[path] = index
+
+        for path in segment.deleted:
+            self.owners.pop(path, None)
+
+    def new_segment(self):
+        # the counter orders the names, the random part keeps them
+        # apart even if the folder was changed behind the manifest
+        self.counter += 1
+        return Segment('segment-{:08d}-{}.json'.format(self.counter, uuid.uuid4().hex[:12]))
+
+    def sync(self, repository):
+        """indexes the text files that changed between the last indexed
+        commit and the head of the repository"""
+        head = repository.head
+        head_id = head.hex if head else None
+        if head_id == self.commit:
+            return self
+
+        with self.locked():
+            # another process may have indexed some of the commits
+            self.refresh()
+            if head_id == self.commit:
+                return self
+
+            return self.update(repository, head)
+
+    def update(self, repository, head):
+        """writes a segment with the changes between the indexed commit
+        and ``head``, runs with the lock held"""
+        head_id = head.hex if head else None
+        segment = self.new_segment()
+        old_tree_id = None
+        if self.commit:
+            old_commit = repository.get_commit(self.commit)
+            if old_commit:
+                old_tree_id = old_commit.tree.id
+            else:
+                # the history was rewritten, start over
+                for path in self.owners:
+                    segment.delete(path)
+
+        new_tree_id = head.tree.id if head else None
+        with repository.checkout() as git:
+            changes = vfs.read_diff(git, old_tree_id, new_tree_id)
+
+        for path, entry in changes:
+            indexable = (
+                entry is not None and is_indexable(path) and
+                repository.blob_size(entry.id) <= settings.VFS_SEARCH_MAX_DOCUMENT_SIZE
+            )
+            if indexable:
+                segment.add(path, entry.hex, repository.read_blob(entry.id))
+            elif path in self.owners:
+                segment.delete(path)
+
+        if len(segment):
+            segment.save(self.path)
+            self.append(segment)
+
+        self.commit = head_id
+        if len(self.segments) > settings.VFS_SEARCH_MAX_SEGMENTS:
+            self.merge()
+        else:
+            self.save()
+
+        return self
+
+    def merge(self):
+        """folds every segment into a single one"""
+        merged = self.new_segment()
+        for index, segment in enumerate(self.segments):
+            for path, oid in segment.docs.items():
+                if self.owners.get(path) == index:
+                    merged.docs[path] = oid
+
+            for term, postings in segment.postings.items():
+                for path, positions in postings.items():
+                    if self.owners.get(path) == index:
+                        merged.postings.setdefault(term, {})[path] = positions
+
+        merged.save(self.path)
+        obsolete = self.segments
+        self.segments = []
+        self.owners = {}
+        self.append(merged)
+        self.save()
+        for segment in obsolete:
+            os.remove(os.path.join(self.path, segment.name))
+
+    def postings(self, term):
+        """returns a dict of ``path -> positions`` for the live
+        documents that contain ``term``"""
+        result = {}
+        for index, segment in enumerate(self.segments):
+            for path, positions in segment.postings.get(term, {}).items():
+                if self.owners.get(path) == index:
+                    result[path] = positions
+
+        return result
+
+    def match_phrase(self, terms):
+        """returns a dict of ``path -> number of occurrences`` of the
+        documents that contain the terms in sequence"""
+        postings = [self.postings(term) for term in terms]
+        if not all(postings):
+            return {}
+
+        candidates = set(postings[0])
+        for other in postings[1:]:
+            candidates.intersection_update(other)
+
+        result = {}
+        for path in candidates:
+            following = [set(p[path]) for p in postings[1:]]
+            count = 0
+            for position in postings[0][path]:
+                if all(position + offset + 1 in positions for offset, positions in enumerate(following)):
+                    count += 1
+
+            if count:
+                result[path] = count
+
+        return result
+
+    def search(self, query):
+        """returns a dict of ``path -> score`` for the documents that
+        match every term and phrase of the query"""
+        phrases = parse_query(query)
+        if not phrases:
+            return {}
+
+        scores = None
+        for terms in phrases:
+            matches = self.match_phrase(terms)
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((path, scores[path] + count) for path, count in matches.items() if path in scores)
+
+            if not scores:
+                return {}
+
+        return scores
+
+
+indexes = vfs.RepositoryPool()
+vfs.pools.append(indexes)
+
+
+def get_index(repository):
+    index = indexes.get(repository.path, lambda: SearchIndex(os.path.join(repository.index_path, 'search')))
+    return index.sync(repository)
+
+
+def rebuild_index(repository):
+    """drops the index of a repository and indexes its head again"""
+    indexes.close(repository.path)
+    folder = os.path.join(repository.index_path, 'search')
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+
+    return get_index(repository)
+
+
+def search(query, buckets, limit=None):
+    """searches the text files of the given buckets, which should be
+    the ones that the user is allowed to read.
+
+    :returns: a list of dicts with the ``bucket``, ``path`` and
+      ``score`` of each match, best matches first
+    """
+    results = []
+    for bucket in buckets:
+        if not bucket.repo.head:
+            continue
+
+        for path, score in get_index(bucket.repo).search(query).items():
+            results.append(OrderedDict([
+                ('bucket', bucket.path),
+                ('path', path),
+                ('score', score),
+            ]))
+
+    results.sort(key=lambda result: (-result['score'], result['bucket'], result['path']))
+    return results[:limit] if limit else results
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from collections import deque
+from collections import defaultdict
+
+from gevent import subprocess
+from pygit2 import Repository
+from pygit2 import init_repository
+
+from oldspeak import settings
+from oldspeak.core import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def get_objects_dir(git_dir):
+    return os.path.join(git_dir, 'objects')
+
+
+class SharedObjectStore(object):
+    """a content-addressed store of blobs shared by every bucket.
+
+    Bucket repositories borrow its objects through git alternates, so
+    a blob that is written to many buckets is stored only once.
+
+    The store has no refs of its own, so git can never tell which of
+    its objects are in use. Instead every bucket that references a
+    blob is recorded in an append-only log, shared by every process,
+    and :py:meth:`collect` removes the loose blobs that no bucket
+    references anymore.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.RLock()
+        self.references = None
+        self.log_offset = 0
+        self.log_inode = None
+        # pygit2 handles must not be used by several threads at once,
+        # each thread borrows one of these while writing
+        self.handles = deque()
+
+    @property
+    def objects_dir(self):
+        return get_objects_dir(self.path)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, 'references.log')
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.path, 'references.lock')
+
+    @contextmanager
+    def locked(self):
+        """holds the lock of the store across threads and processes"""
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            with open(self.lock_path, 'a') as fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def create(self):
+        """creates the repository of the store unless it exists"""
+        with self.lock:
+            if not os.path.isdir(self.objects_dir):
+                init_repository(self.path, bare=True)
+
+    @contextmanager
+    def checkout(self):
+        """lends a handle of the store to the calling thread, can be
+        called from :py:data:`git_threads` since it only uses a
+        ``deque``, whose ``pop`` and ``append`` are atomic"""
+        try:
+            git = self.handles.pop()
+        except IndexError:
+            git = Repository(self.path)
+
+        try:
+            yield git
+        finally:
+            self.handles.append(git)
+
+    def create_blob(self, data):
+        with self.checkout() as git:
+            return git.create_blob(data)
+
+    def create_blob_fromdisk(self, path):
+        with self.checkout() as git:
+            return git.create_blob_fromdisk(path)
+
+    def attach(self, git_dir):
+        """makes a repository borrow objects from the store, returns
+        ``True`` if the repository had to be changed, in which case
+        open handles must be reopened to see the shared objects"""
+        self.create()
+        alternates_path = os.path.join(get_objects_dir(git_dir), 'info', 'alternates')
+        alternates = []
+        if os.path.exists(alternates_path):
+            with open(alternates_path) as fd:
+                alternates = [line.strip() for line in fd if line.strip()]
+
+        if self.objects_dir in alternates:
+            return False
+
+        folder = os.path.dirname(alternates_path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with open(alternates_path, 'a') as fd:
+            fd.write('{}\n'.format(self.objects_dir))
+
+        return True
+
+    def read_log(self, references, offset=0):
+        """applies the lines of the log after ``offset`` to
+        ``references`` and returns the offset where they end"""
+        with open(self.log_path) as fd:
+            fd.seek(offset)
+            for line in fd:
+                if not line.endswith('\n'):
+                    # partially written line
+                    break
+
+                offset += len(line)
+                parts = line.split()
+                if len(parts) != 3:
+                    continue
+
+                action, oid, name = parts
+                if action == '+':
+                    references[oid].add(name)
+                else:
+                    references[oid].discard(name)
+
+        return offset
+
+    def load(self):
+        references = defaultdict(set)
+        self.log_offset = 0
+        self.log_inode = None
+        if os.path.exists(self.log_path):
+            self.log_inode = os.stat(self.log_path).st_ino
+            self.log_offset = self.read_log(references)
+
+        self.references = references
+        return references
+
+    def refresh(self):
+        """catches up with the lines that other processes appended to
+        the log since it was last read, or reads it again when it was
+        rewritten by :py:meth:`collect`"""
+        if self.references is None or not os.path.exists(self.log_path):
+            return self.load()
+
+        stat = os.stat(self.log_path)
+        if stat.st_ino != self.log_inode or stat.st_size < self.log_offset:
+            return self.load()
+
+        if stat.st_size > self.log_offset:
+            self.log_offset = self.read_log(self.references, self.log_offset)
+
+        return self.references
+
+    def get_references(self):
+        with self.locked():
+            return self.refresh()
+
+    def refcount(self, oid):
+        return len(self.get_references().get(str(oid), ()))
+
+    def append(self, lines):
+        if lines:
+            with open(self.log_path, 'a') as fd:
+                fd.writelines(lines)
+
+            self.refresh()
+
+        return len(lines)
+
+    def reference(self, name, oids):
+        """records that the bucket ``name`` references the given blobs"""
+        with self.locked():
+            references = self.refresh()
+            lines = ['+ {} {}\n'.format(oid, name) for oid in set(map(str, oids)) if name not in references[oid]]
+            return self.append(lines)
+
+    def release(self, name):
+        """drops every reference of a bucket, e.g: when it is deleted"""
+        with self.locked():
+            references = self.refresh()
+            lines = ['- {} {}\n'.format(oid, name) for oid, names in references.items() if name in names]
+            return self.append(lines)
+
+    def rewrite_log(self, references):
+        temporary_path = '{}.tmp'.format(self.log_path)
+        with open(temporary_path, 'w') as fd:
+            for oid, names in references.items():
+                fd.writelines('+ {} {}\n'.format(oid, name) for name in names)
+
+        os.rename(temporary_path, self.log_path)
+        self.load()
+
+    def collect(self, grace=None):
+        """removes the loose blobs that no bucket references and that
+        are older than ``grace`` seconds, so that blobs that were just
+        written and are not referenced yet survive. Returns the number
+        of objects removed and rewrites the log"""
+        grace = settings.VFS_SHARED_OBJECTS_GRACE if grace is None else grace
+        deadline = time.time() - grace
+        removed = 0
+        with self.locked():
+            # other processes may have referenced blobs since the log
+            # was last read
+            references = self.refresh()
+            for prefix in os.listdir(self.objects_dir):
+                if len(prefix) != 2:
+                    continue
+
+                folder = os.path.join(self.objects_dir, prefix)
+                for suffix in os.listdir(folder):
+                    oid = prefix + suffix
+                    path = os.path.join(folder, suffix)
+                    if references.get(oid) or os.path.getmtime(path) > deadline:
+                        continue
+
+                    os.remove(path)
+                    references.pop(oid, None)
+                    removed += 1
+
+            self.rewrite_log(references)
+
+        logger.info('removed %s unreferenced objects from %s', removed, self.path)
+        return removed
+
+    def is_loose(self, oid):
+        return os.path.exists(os.path.join(self.objects_dir, oid[:2], oid[2:]))
+
+    def pack(self):
+        """moves the loose blobs that are referenced into a new pack and
+        removes their loose copies. Blobs that were written but are not
+        referenced yet stay loose, so :py:meth:`collect` can still
+        remove them. Packed blobs are never removed.
+
+        ``git repack`` can't be used since the store has no refs, every
+        object would look unreachable to it. Returns ``False`` if git
+        failed.
+        """
+        with self.locked():
+            oids = [oid for oid, names in self.refresh().items() if names and self.is_loose(oid)]
+            if not oids:
+                return True
+
+            command = ['git', '--git-dir', self.path, 'pack-objects', '-q', os.path.join(self.objects_dir, 'pack', 'pack')]
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(''.join('{}\n'.format(oid) for oid in oids))
+            if process.returncode != 0:
+                logger.error('%s failed: %s', ' '.join(command), stderr.strip())
+                return False
+
+            process = subprocess.Popen(['git', '--git-dir', self.path, 'prune-packed', '-q'],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process.communicate()
+
+        logger.info('packed %s objects of %s', len(oids), self.path)
+        return process.returncode == 0
+
+
+stores = {}
+
+
+def get_shared_store(root_dir=None):
+    """returns the :py:class:`SharedObjectStore` of a data dir or
+    ``None`` if shared objects are disabled"""
+    if not settings.VFS_SHARED_OBJECTS:
+        return None
+
+    root_dir = os.path.abspath(root_dir or settings.OLDSPEAK_DATADIR)
+    store = stores.get(root_dir)
+    if store is None:
+        store = stores.setdefault(root_dir, SharedObjectStore(os.path.join(root_dir, '.shared-objects')))
+
+    return store
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import re
+import __builtin__
+import datetime
+from decimal import Decimal
+
+import dateutil.parser
+
+
+BUILTIN_TYPES = frozenset(value for value in vars(__builtin__).values() if isinstance(value, type))
+DATE_TYPES = (datetime.datetime, datetime.date, datetime.time)
+
+ISO_8601_REGEX = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?$'
+)
+
+format_decimal = lambda num: '{0:.2f}'.format(num)
+
+
+def parse_datetime(value):
+    """parses the naive ISO-8601 timestamps written by ``isoformat()``
+    without going through ``dateutil``, which is only used for the
+    other formats"""
+    match = isinstance(value, basestring) and ISO_8601_REGEX.match(value)
+    if not match:
+        return dateutil.parser.parse(value)
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return datetime.datetime(
+        int(year), int(month), int(day),
+        int(hour or 0), int(minute or 0), int(second or 0),
+        int((fraction or '0').ljust(6, '0')),
+    )
+
+
+def make_encoder(column, python_type):
+    """returns a function that turns the value of a column into what
+    ``Model.serialize`` outputs"""
+    default = column.default
+    convert = python_type in BUILTIN_TYPES
+
+    def encode(value):
+        if default and not value:
+            value = default.arg(value) if default.is_callable else default.arg
+
+        if isinstance(value, Decimal):
+            return format_decimal(value)
+
+        if isinstance(value, DATE_TYPES):
+            return value.isoformat()
+
+        if not value:
+            return value
+
+        if convert and not isinstance(value, python_type):
+            return python_type(value)
+
+        return value
+
+    return encode
+
+
+def make_decoder(python_type):
+    """returns a function that turns a value given to a model into the
+    value it stores, or ``None`` when values are stored as they are"""
+    if not issubclass(python_type, (datetime.datetime, datetime.date)):
+        return None
+
+    def decode(value):
+        if not value or isinstance(value, python_type):
+            return value
+
+        return parse_datetime(value)
+
+    return decode
+
+
+def compile_codecs(table):
+    """returns the ``(columns, encoders, decoders)`` of a table: dicts
+    of column name to python type, to encoder and to decoder. Columns
+    that need no decoding are left out of the decoders"""
+    columns = {}
+    encoders = {}
+    decoders = {}
+    for column in table.columns:
+        python_type = column.type.python_type
+        columns[column.name] = python_type
+        encoders[column.name] = make_encoder(column, python_type)
+        decoder = make_decoder(python_type)
+        if decoder is not None:
+            decoders[column.name] = decoder
+
+    return columns, encoders, decoders
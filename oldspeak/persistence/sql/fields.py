@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from oldspeak.persistence.meta import orm
+from oldspeak.persistence.sql.codecs import compile_codecs
+
+
+class ColumnDescriptor(object):
+    """the attribute of a model column, generated by the ``orm``
+    metaclass.
+
+    Reads return the serialized value and writes store the decoded
+    value in ``__data__``, without going through ``__getattr__``.
+    """
+    __slots__ = ('name', 'encode', 'decode')
+
+    def __init__(self, name, encode, decode=None):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return self.encode(instance.__data__.get(self.name))
+
+    def __set__(self, instance, value):
+        instance.__data__[self.name] = self.decode(value) if self.decode else value
+
+
+class ModelRow(object):
+    """a compact read-only query result with one slot per column.
+
+    The values are serialized once when the row is built, reading them
+    is as cheap as reading a slot. Call :py:meth:`to_model` to get a
+    model that can be changed and saved.
+    """
+    __slots__ = ()
+    __model__ = None
+    __fields__ = ()
+
+    @classmethod
+    def hydrator(cls, keys):
+        """returns a function that builds a row out of a sequence of
+        values in the order of ``keys``, the columns that are not in
+        ``keys`` are left as ``None``"""
+        positions = dict((key, index) for index, key in enumerate(keys))
+        plan = [(set_value, encode, positions.get(name)) for name, set_value, encode in cls.__fields__]
+        new = cls.__new__
+
+        def hydrate(values):
+            row = new(cls)
+            for set_value, encode, index in plan:
+                set_value(row, None if index is None else encode(values[index]))
+
+            return row
+
+        return hydrate
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('{} is read-only'.format(self.__class__.__name__))
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return '<{0} id={1}>'.format(self.__class__.__name__, self.get('id'))
+
+    def __eq__(self, other):
+        return isinstance(other, ModelRow) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, name, fallback=None):
+        return getattr(self, name, fallback)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name, set_value, encode in self.__fields__)
+
+    serialize = to_dict
+
+    def to_model(self, engine=None):
+        return self.__model__(engine=engine, **self.to_dict())
+
+
+def make_row_class(model, encoders):
+    """creates the :py:class:`ModelRow` subclass of a model"""
+    names = sorted(encoders)
+    Row = type(b'{}Row'.format(model.__name__), (ModelRow, ), {
+        '__slots__': tuple(str(name) for name in names),
+        '__model__': model,
+        '__module__': model.__module__,
+    })
+    Row.__fields__ = tuple(
+        (name, getattr(Row, name).__set__, encoders[name]) for name in names
+    )
+    return Row
+
+
+def add_column_descriptors(model, encoders, decoders):
+    """adds a :py:class:`ColumnDescriptor` for every column whose name
+    isn't already taken by another attribute of the model"""
+    for name, encode in encoders.items():
+        existing = getattr(model, name, None)
+        if existing is None or isinstance(existing, ColumnDescriptor):
+            setattr(model, name, ColumnDescriptor(name, encode, decoders.get(name)))
+
+
+class model_meta(orm):
+    """the metaclass of the sql models, compiles the codecs, the
+    column descriptors and the ``Row`` class of every model that has
+    a ``table``.
+
+    The columns are stored in ``__data__``, so a model that declares
+    ``__slots__`` with the other attributes it sets, if any, has no
+    instance ``__dict__``. Models without ``__slots__`` keep one.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(model_meta, cls).__init__(name, bases, attrs)
+        if not hasattr(cls, 'table'):
+            return
+
+        # the codecs are compiled once here rather than looked up on
+        # every attribute access
+        cls.__columns__, cls.__encoders__, cls.__decoders__ = compile_codecs(cls.table)
+        add_column_descriptors(cls, cls.__encoders__, cls.__decoders__)
+        cls.Row = make_row_class(cls, cls.__encoders__)
@@ -1,39 +1,68 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
-import __builtin__
 
 import json
-import inspect
-import dateutil.parser
-import datetime
 from functools import partial
-from decimal import Decimal
+from contextlib import contextmanager
+from itertools import groupby
 from collections import OrderedDict
 
 import sqlalchemy as db
+from sqlalchemy.util import LRUCache
 
+from oldspeak import settings
 from oldspeak.core import get_logger
 from oldspeak.persistence.meta import orm
 from oldspeak.persistence import connectors
+from oldspeak.persistence.sql import session
+from oldspeak.persistence.sql.codecs import format_decimal  # noqa
+from oldspeak.persistence.sql.fields import model_meta
 # 199-202, 208-209, 216
 
 metadata = db.MetaData()
 logger = get_logger()
 
-format_decimal = lambda num: '{0:.2f}'.format(num)
+# the selects of `Manager.generate_query()` by query shape and their
+# compiled SQL, so that repeated lookups only bind values
+statements = LRUCache(settings.SQL_STATEMENT_CACHE_SIZE)
+compiled_statements = LRUCache(settings.SQL_STATEMENT_CACHE_SIZE)
 
 
-def import_fixture(filename):
-    created = []
+def import_fixture(filename, hydrate=False, chunk_size=1000, alias=None):
+    """loads a JSON list of ``{"model": name, "data": {...}}`` with one
+    bulk insert per run of consecutive fixtures of the same model.
+
+    Returns the number of rows inserted or, when ``hydrate`` is true,
+    the created models, which inserts one row at a time.
+    """
     with open(filename) as f:
         fixtures = json.load(f)
-        for fixture in fixtures:
-            cls = getattr(orm, fixture['model'])
-            instance = cls.create(**fixture['data'])
-            created.append(instance)
 
-    return created
+    created = []
+    total = 0
+    for name, group in groupby(fixtures, key=lambda fixture: fixture['model']):
+        cls = getattr(orm, name)
+        manager = cls.using(alias) if alias else cls.api()
+        rows = [fixture['data'] for fixture in group]
+        result = manager.bulk_create(rows, chunk_size=chunk_size, hydrate=hydrate)
+        if hydrate:
+            created.extend(result)
+        else:
+            total += len(rows)
+
+    return created if hydrate else total
+
+
+def supports_returning(dialect):
+    """tells whether a dialect can return the primary keys of a
+    multi-row insert"""
+    return bool(dialect.implicit_returning and dialect.supports_multivalues_insert)
+
+
+def chunks(items, size):
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
 
 
 def escape_query(query, escape='#'):
@@ -69,18 +98,189 @@ class Manager(object):
         if not result:
             return None
 
-        data = dict(zip(proxy.keys(), result))
-        return self.model(engine=self.engine, **data)
+        return self.get_hydrator(proxy.keys())(result)
 
     def many_from_result_proxy(self, proxy):
-        Models = partial(self.from_result_proxy, proxy)
-        return map(Models, proxy.fetchall())
+        hydrate = self.get_hydrator(proxy.keys())
+        return [hydrate(row) for row in proxy.fetchall()]
+
+    def get_hydrator(self, keys):
+        """Returns a function that turns a row with the given keys into
+        a model instance.
+
+        Rows of plain table columns skip the constructor and are
+        decoded with the precompiled codecs of the model, other rows
+        and models with a custom `preprocess` go through `__init__`.
+        """
+        Model = self.model
+        engine = self.engine
+        keys = list(keys)
+        generic = (
+            Model.preprocess.__func__ is not Model_preprocess or
+            any(key not in Model.__columns__ for key in keys)
+        )
+        if generic:
+            return lambda row: Model(engine=engine, **dict(zip(keys, row)))
+
+        decoders = [(index, Model.__decoders__[key]) for index, key in enumerate(keys) if key in Model.__decoders__]
+
+        def hydrate(row):
+            values = list(row)
+            for index, decode in decoders:
+                values[index] = decode(values[index])
+
+            instance = Model.__new__(Model)
+            instance.__data__ = dict(zip(keys, values))
+            instance.engine = engine
+            instance.initialize()
+            return instance
+
+        return hydrate
+
+    def rows_from_result_proxy(self, proxy):
+        """Returns the read-only `Model.Row` of every row of a
+        sqlalchemy result proxy"""
+        hydrate = self.model.Row.hydrator(proxy.keys())
+        return [hydrate(row) for row in proxy.fetchall()]
 
     def create(self, **data):
         """Creates a new model and saves it to MySQL"""
         instance = self.model(engine=self.engine, **data)
         return instance.save()
 
+    def get_insert_params(self, row):
+        """turns a dict or a model instance into the params of an
+        insert, leaving the primary keys out like `Model.save()`.
+
+        The values of a dict are decoded like the arguments of the
+        model, dicts of models with a custom `preprocess` go through
+        the model itself.
+        """
+        if isinstance(row, Model):
+            return row.to_insert_params()
+
+        if self.model.preprocess.__func__ is not Model_preprocess:
+            return self.model(engine=self.engine, **row).to_insert_params()
+
+        primary_key_names = [c.name for c in self.model.table.primary_key.columns]
+        decoders = self.model.__decoders__
+        params = OrderedDict()
+        for key, value in row.items():
+            if key not in self.model.__columns__:
+                msg = '{0} is not a valid column name for the model {1}'
+                raise InvalidColumnName(msg.format(key, self.model.__name__))
+
+            if key not in primary_key_names:
+                decode = decoders.get(key)
+                params[key] = decode(value) if decode else value
+
+        return params
+
+    def bulk_create(self, rows, chunk_size=1000, return_ids=False, hydrate=False):
+        """Inserts many rows within a single transaction.
+
+        :param rows: a list of dicts or model instances, inserted in
+          the given order
+        :param chunk_size: how many rows are sent per `executemany`
+        :param return_ids: return the generated primary keys
+        :param hydrate: return model instances
+        :returns: the number of rows inserted, or the list of primary
+          keys or models when asked for.
+
+        Dialects with `RETURNING` and multi-row `VALUES`, e.g.
+        PostgreSQL, collect the primary keys of a whole chunk at once.
+        Elsewhere they are collected one statement at a time, so
+        `return_ids` and `hydrate` are slower than the default.
+        """
+        rows = list(rows)
+        table = self.model.table
+        results = []
+        with self.transaction() as conn:
+            returning = (return_ids or hydrate) and supports_returning(conn.dialect)
+            for chunk in chunks(rows, chunk_size):
+                params = map(self.get_insert_params, chunk)
+                if returning:
+                    results.extend(self.insert_returning(conn, chunk, params, hydrate))
+                    continue
+
+                if not (return_ids or hydrate):
+                    # executemany needs the same keys on every row, runs
+                    # of rows with the same keys keep the input order
+                    for keys, group in groupby(params, key=lambda p: sorted(p.keys())):
+                        conn.execute(table.insert(), list(group))
+
+                    continue
+
+                for row, data in zip(chunk, params):
+                    res = conn.execute(table.insert().values(**data))
+                    pk = res.inserted_primary_key[0]
+                    if not hydrate:
+                        results.append(pk)
+                        continue
+
+                    instance = row if isinstance(row, Model) else self.model(engine=self.engine, **row)
+                    instance.__data__['id'] = pk
+                    instance.__data__.update(res.last_inserted_params())
+                    results.append(instance)
+
+        if return_ids or hydrate:
+            return results
+
+        return len(rows)
+
+    def insert_returning(self, conn, rows, params, hydrate=False):
+        """inserts the rows with one `INSERT ... RETURNING` per run of
+        rows with the same keys, returns their primary keys or models"""
+        table = self.model.table
+        columns = list(table.columns) if hydrate else list(table.primary_key.columns)
+        results = []
+        for keys, group in groupby(zip(rows, params), key=lambda item: sorted(item[1].keys())):
+            group = list(group)
+            proxy = conn.execute(table.insert().values([data for row, data in group]).returning(*columns))
+            if not hydrate:
+                results.extend(values[0] for values in proxy.fetchall())
+                continue
+
+            for (row, data), instance in zip(group, self.many_from_result_proxy(proxy)):
+                if isinstance(row, Model):
+                    row.__data__.update(instance.__data__)
+                    instance = row
+
+                results.append(instance)
+
+        return results
+
+    def bulk_update(self, rows, chunk_size=1000):
+        """Updates many rows by primary key within a single transaction.
+
+        :param rows: a list of dicts that have an ``id`` plus the
+          fields to change, or model instances
+        :returns: the number of rows matched
+        """
+        table = self.model.table
+        total = 0
+        with self.transaction() as conn:
+            for chunk in chunks(list(rows), chunk_size):
+                params = []
+                for row in chunk:
+                    pk = row.id if isinstance(row, Model) else row['id']
+                    # sqlalchemy reserves the column names as bind
+                    # parameter names of the SET clause
+                    data = dict(('_' + key, value) for key, value in self.get_insert_params(row).items())
+                    data['_pk'] = pk
+                    params.append(data)
+
+                for keys, group in groupby(params, key=lambda p: sorted(p.keys())):
+                    fields = [key[1:] for key in keys if key != '_pk']
+                    if not fields:
+                        continue
+
+                    query = table.update().where(table.c.id == db.bindparam('_pk')).values(
+                        **dict((field, db.bindparam('_' + field)) for field in fields))
+                    total += conn.execute(query, list(group)).rowcount
+
+        return total
+
     def get_or_create(self, **data):
         """Tries to get a model from the persistence that would match the
         given keyword-args through `Model.find_one_by()`. If not
@@ -96,31 +296,72 @@ class Manager(object):
             self, order_by=None, limit_by=None, offset_by=None, **kw):
         """Queries the table with the given keyword-args and
         optionally a single order_by field."""
-        query = self.model.table.select()
+        statement, params = self.get_statement(order_by, limit_by, offset_by, **kw)
+        return statement.params(**params)
+
+    def get_statement(
+            self, order_by=None, limit_by=None, offset_by=None, **kw):
+        """Returns the select of `generate_query()` with bind parameters
+        in place of the values, plus the values to bind.
+
+        The select is built once per query shape: the fields and
+        modifiers, the fields compared to ``None``, the order and
+        whether there is a limit or an offset. Executing it with
+        `execute_query()` reuses its compiled SQL as well.
+        """
+        has_limit = isinstance(limit_by, (float, int))
+        has_offset = isinstance(offset_by, (float, int))
+        fields = tuple(sorted((field, value is None) for field, value in kw.items()))
+        key = (self.model.table, fields, order_by, has_limit, has_offset)
+        statement = statements.get(key)
+        if statement is None:
+            statement = statements[key] = self.build_statement(fields, order_by, has_limit, has_offset)
+
+        params = {}
+        columns = self.model.table.c
         for field, value in kw.items():
-            if hasattr(self.model.table.c, field):
-                query = query.where(
-                    getattr(self.model.table.c, field) == value)
-            elif '__' in field:
-                field, modifier = field.split('__', 1)
-                f = getattr(self.model.table.c, field)
+            if hasattr(columns, field):
+                if value is not None:
+                    params[field] = value
+            elif field.endswith('__startswith'):
+                params[field] = '{}%'.format(value)
+            else:
+                params[field] = '%{}%'.format(escape_query(value))
+
+        if has_limit:
+            params['limit_by'] = int(limit_by)
+
+        if has_offset:
+            params['offset_by'] = int(offset_by)
+
+        return statement, params
+
+    def build_statement(self, fields, order_by, has_limit, has_offset):
+        query = self.model.table.select()
+        columns = self.model.table.c
+        for name, is_none in fields:
+            if hasattr(columns, name):
+                f = getattr(columns, name)
+                query = query.where(f.is_(None) if is_none else f == db.bindparam(name))
+            elif '__' in name:
+                field, modifier = name.split('__', 1)
+                f = getattr(columns, field)
                 if modifier == 'startswith':
-                    query = query.where(f.startswith(value))
+                    query = query.where(f.like(db.bindparam(name)))
                 elif modifier == 'contains':
-                    contains = f.contains(escape_query(value), escape='#')
-                    query = query.where(contains)
+                    query = query.where(f.like(db.bindparam(name), escape='#'))
                 else:
                     msg = '"{}" is in invalid query modifier.'.format(modifier)
                     raise InvalidQueryModifier(msg)
             else:
-                msg = 'The field "{}" does not exist.'.format(field)
+                msg = 'The field "{}" does not exist.'.format(name)
                 raise InvalidColumnName(msg)
 
-        if isinstance(limit_by, (float, int)):
-            query = query.limit(limit_by)
+        if has_limit:
+            query = query.limit(db.bindparam('limit_by', type_=db.Integer))
 
-        if isinstance(offset_by, (float, int)):
-            query = query.offset(offset_by)
+        if has_offset:
+            query = query.offset(db.bindparam('offset_by', type_=db.Integer))
 
         # Order the results
         db_order = db.desc
@@ -132,41 +373,55 @@ class Manager(object):
                 order_by = order_by[1:]
 
         query = query.order_by(db_order(
-            getattr(self.model.table.c, order_by or 'id')
+            getattr(columns, order_by or 'id')
         ))
 
         return query
 
+    def execute_query(self, conn, **kw):
+        """Runs the cached select of the given keyword-args on
+        ``conn``, only binding the values when its shape was seen
+        before"""
+        statement, params = self.get_statement(**kw)
+        return conn.execution_options(compiled_cache=compiled_statements).execute(statement, params)
+
     def query_by(self, **kwargs):
         """This method is used internally and is not consistent with the other
         ORM methods by not returning a model instance."""
-        conn = self.get_connection()
-        query = self.generate_query(**kwargs)
-        proxy = conn.execute(query)
-        return proxy
+        return self.execute_query(self.get_connection(), **kwargs)
 
     def many_from_query(self, query):
-        conn = self.get_connection()
-        proxy = conn.execute(query)
-        return self.many_from_result_proxy(proxy)
+        with self.connection() as conn:
+            proxy = conn.execute(query)
+            return self.many_from_result_proxy(proxy)
 
     def one_from_query(self, query):
-        conn = self.get_connection()
-        proxy = conn.execute(query)
-        return self.from_result_proxy(proxy, proxy.fetchone())
+        with self.connection() as conn:
+            proxy = conn.execute(query)
+            return self.from_result_proxy(proxy, proxy.fetchone())
+
+    def rows_from_query(self, query):
+        with self.connection() as conn:
+            return self.rows_from_result_proxy(conn.execute(query))
 
     def find_one_by(self, **kw):
         """Find a single model that could be found in the persistence and
         match all the given keyword-arguments"""
-        proxy = self.query_by(**kw)
-        return self.from_result_proxy(proxy, proxy.fetchone())
+        with self.connection() as conn:
+            proxy = self.execute_query(conn, **kw)
+            return self.from_result_proxy(proxy, proxy.fetchone())
 
     def find_by(self, **kw):
         """Find a list of models that could be found in the persistence
         and match all the given keyword-arguments"""
-        proxy = self.query_by(**kw)
-        Models = partial(self.from_result_proxy, proxy)
-        return map(Models, proxy.fetchall())
+        with self.connection() as conn:
+            return self.many_from_result_proxy(self.execute_query(conn, **kw))
+
+    def find_rows_by(self, **kw):
+        """Like `find_by()` but returns compact read-only rows, for
+        large result sets that are only read"""
+        with self.connection() as conn:
+            return self.rows_from_result_proxy(self.execute_query(conn, **kw))
 
     def all(self, limit_by=None, offset_by=None):
         """Returns all existing rows as Model"""
@@ -177,23 +432,45 @@ class Manager(object):
 
     def total_rows(self, field_name='id', **where):
         """Gets the total number of rows in the table"""
-        conn = self.get_connection()
         query = self.model.table.count()
         for key, value in where.items():
             field = getattr(self.model.table.c, key, None)
             if field is not None:
                 query = query.where(field == value)
 
-        proxy = conn.execute(query)
-
-        return proxy.scalar()
+        with self.connection() as conn:
+            return conn.execute(query).scalar()
 
     def get_connection(self):
-        return connectors.sql.get_connection(self.alias)
+        """Returns the connection of the current session or, outside of
+        a session, the engine itself: each statement then checks out a
+        connection that goes back to the pool once its result is
+        consumed."""
+        current = session.get_session()
+        if current is not None:
+            return current.get_connection(self.engine)
+
+        return self.engine
+
+    def connection(self):
+        """A context manager with the connection to be used by a
+        block of statements, see `session.connection()`"""
+        return session.connection(self.engine)
+
+    @contextmanager
+    def transaction(self):
+        """Runs a block of statements within a transaction on the
+        connection of the current session or a connection of its own"""
+        with self.connection() as conn:
+            with conn.begin():
+                yield conn
 
 
 class Model(object):
-    __metaclass__ = orm
+    __metaclass__ = model_meta
+    # the columns are data descriptors generated by the metaclass,
+    # subclasses that declare `__slots__` too have no instance `__dict__`
+    __slots__ = ('__data__', 'engine', '__weakref__')
 
     manager = Manager
 
@@ -206,12 +483,15 @@ class Model(object):
         return cls.manager(cls, 'oldspeak.api')
 
     create = classmethod(lambda cls, **data: cls.api().create(**data))
+    bulk_create = classmethod(lambda cls, rows, **kw: cls.api().bulk_create(rows, **kw))
+    bulk_update = classmethod(lambda cls, rows, **kw: cls.api().bulk_update(rows, **kw))
     get_or_create = classmethod(
         lambda cls, **data: cls.api().get_or_create(**data))
     query_by = classmethod(lambda cls, order_by=None, **
                            kw: cls.api().query_by(order_by=order_by, **kw))
     find_one_by = classmethod(lambda cls, **kw: cls.api().find_one_by(**kw))
     find_by = classmethod(lambda cls, **kw: cls.api().find_by(**kw))
+    find_rows_by = classmethod(lambda cls, **kw: cls.api().find_rows_by(**kw))
     all = classmethod(lambda cls, **kw: cls.api().all(**kw))
     total_rows = classmethod(lambda cls, **kw: cls.api().total_rows(**kw))
     get_connection = classmethod(lambda cls, **kw: cls.api().get_connection())
@@ -219,6 +499,8 @@ class Model(object):
         lambda cls, query: cls.api().many_from_query(query))
     one_from_query = classmethod(
         lambda cls, query: cls.api().one_from_query(query))
+    rows_from_query = classmethod(
+        lambda cls, query: cls.api().rows_from_query(query))
 
     def __init__(self, engine=None, **data):
         '''A Model can be instantiated with keyword-arguments that
@@ -241,26 +523,26 @@ class Model(object):
           called after successfully creating a new model instance.
         '''
         Model = self.__class__
-        module = Model.__module__
-        name = Model.__name__
-        columns = self.__columns__.keys()
         preprocessed_data = self.preprocess(data)
 
         if not isinstance(preprocessed_data, dict):
             raise InvalidModelDeclaration(
                 'The model `{0}` declares a preprocess method but '
-                'it does not return a dictionary!'.format(name))
+                'it does not return a dictionary!'.format(Model.__name__))
 
         self.__data__ = preprocessed_data
 
         self.engine = engine
 
+        columns = self.__columns__
+        decoders = self.__decoders__
         for k, v in data.iteritems():
-            if k not in self.__columns__:
+            if k not in columns:
                 msg = "{0} is not a valid column name for the model {2}.{1} ({3})"
-                raise InvalidColumnName(msg.format(k, name, module, columns))
+                raise InvalidColumnName(msg.format(k, Model.__name__, Model.__module__, columns.keys()))
 
-            setattr(self, k, v)
+            decode = decoders.get(k)
+            preprocessed_data[k] = decode(v) if decode else v
 
         self.initialize()
 
@@ -273,46 +555,11 @@ class Model(object):
         return data
 
     def serialize_value(self, attr, value):
-        col = self.table.columns[attr]
-
-        if col.default and not value:
-            if col.default.is_callable:
-                value = col.default.arg(value)
-            else:
-                value = col.default.arg
-
-        if isinstance(value, Decimal):
-            return format_decimal(value)
-
-        date_types = (datetime.datetime, datetime.date, datetime.time)
-        if isinstance(value, date_types):
-            return value.isoformat()
-
-        if not value:
-            return value
-
-        data_type = self.__columns__.get(attr, None)
-        builtins = dict(inspect.getmembers(__builtin__)).values()
-        if data_type and not isinstance(value, data_type) and data_type in builtins:
-            return data_type(value)
-
-        return value
+        return self.__encoders__[attr](value)
 
     def deserialize_value(self, attr, value):
-        date_types = (datetime.datetime, datetime.date)
-
-        kind = self.__columns__.get(attr, None)
-        if issubclass(kind, date_types) and not isinstance(value, kind) and value:
-            return dateutil.parser.parse(value)
-
-        return value
-
-    def __setattr__(self, attr, value):
-        if attr in self.__columns__:
-            self.__data__[attr] = self.deserialize_value(attr, value)
-            return
-
-        return super(Model, self).__setattr__(attr, value)
+        decode = self.__decoders__.get(attr)
+        return decode(value) if decode else value
 
     def to_dict(self):
         """pre-serializes the model, returning a dictionary with
@@ -331,8 +578,8 @@ class Model(object):
         call `serialize()` rather than `super(SubclassName,
         self).to_dict()`
         """
-        keys = self.__columns__.keys()
-        return dict([(k, self.serialize_value(k, self.__data__.get(k))) for k in keys])
+        data = self.__data__
+        return dict([(k, encode(data.get(k))) for k, encode in self.__encoders__.items()])
 
     def to_insert_params(self):
         pre_data = Model.serialize(self)
@@ -360,9 +607,9 @@ class Model(object):
         return json.dumps(data, indent=indent)
 
     def __getattr__(self, attr):
-        if attr in self.__columns__.keys():
-            value = self.__data__.get(attr, None)
-            return self.serialize_value(attr, value)
+        encode = self.__encoders__.get(attr)
+        if encode is not None:
+            return encode(self.__data__.get(attr, None))
 
         return super(Model, self).__getattribute__(attr)
 
@@ -371,10 +618,9 @@ class Model(object):
         that has the given model primary key)
         """
 
-        conn = self.get_engine().connect()
-
-        return conn.execute(self.table.delete().where(
-            self.table.c.id == self.id))
+        with session.connection(self.get_engine()) as conn:
+            return conn.execute(self.table.delete().where(
+                self.table.c.id == self.id))
 
     @property
     def is_persisted(self):
@@ -399,19 +645,18 @@ class Model(object):
         or if a new record should be created.
         """
 
-        conn = self.get_engine(input_engine).connect()
-
         mid = self.__data__.get('id', None)
-        if mid is None:
-            res = conn.execute(
-                self.table.insert().values(**self.to_insert_params()))
+        with session.connection(self.get_engine(input_engine)) as conn:
+            if mid is None:
+                res = conn.execute(
+                    self.table.insert().values(**self.to_insert_params()))
 
-            self.__data__['id'] = res.inserted_primary_key[0]
-            self.__data__.update(res.last_inserted_params())
-        else:
-            res = conn.execute(
-                self.table.update().values(**self.to_insert_params()).where(self.table.c.id == mid))
-            self.__data__.update(res.last_updated_params())
+                self.__data__['id'] = res.inserted_primary_key[0]
+                self.__data__.update(res.last_inserted_params())
+            else:
+                res = conn.execute(
+                    self.table.update().values(**self.to_insert_params()).where(self.table.c.id == mid))
+                self.__data__.update(res.last_updated_params())
 
         return self
 
@@ -470,3 +715,6 @@ class InvalidModelDeclaration(Exception):
 
 class RecordNotFound(Exception):
     pass
+
+
+Model_preprocess = Model.preprocess.__func__
@@ -28,6 +28,7 @@ logger = get_logger(__name__)
 
 
 class User(Model):
+    __slots__ = ('password', )
 
     table = db.Table(
         'auth_user', metadata,
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from weakref import WeakKeyDictionary
+from contextlib import contextmanager
+
+from gevent import getcurrent
+
+
+class Session(object):
+    """a unit of work bound to a greenlet.
+
+    The first mapper call to each engine checks out a connection from
+    its pool, every other call within the session reuses it and they
+    all go back to the pool when the session closes.
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get_connection(self, engine):
+        conn = self.connections.get(engine)
+        if conn is None or conn.closed:
+            conn = self.connections[engine] = engine.connect()
+
+        return conn
+
+    def close(self):
+        connections, self.connections = self.connections, {}
+        for conn in connections.values():
+            conn.close()
+
+
+# the greenlets are weak keys so that a greenlet that dies without
+# closing its session doesn't keep it around
+sessions = WeakKeyDictionary()
+
+
+def get_session():
+    """returns the :py:class:`Session` of the current greenlet or
+    ``None``"""
+    return sessions.get(getcurrent())
+
+
+def open_session():
+    """binds a new :py:class:`Session` to the current greenlet, or
+    returns the one already bound"""
+    current = getcurrent()
+    session = sessions.get(current)
+    if session is None:
+        session = sessions[current] = Session()
+
+    return session
+
+
+def close_session():
+    """returns the connections of the session of the current greenlet
+    to their pools"""
+    session = sessions.pop(getcurrent(), None)
+    if session is not None:
+        session.close()
+
+
+@contextmanager
+def session_scope():
+    """runs a block within a session, nested scopes share the session
+    of the outermost one::
+
+        with session_scope():
+            user = User.find_one_by(email='mary@oldspeak.io')
+            user.set(status='active')
+            user.save()
+    """
+    if get_session() is not None:
+        yield get_session()
+        return
+
+    session = open_session()
+    try:
+        yield session
+    finally:
+        close_session()
+
+
+@contextmanager
+def connection(engine):
+    """yields the connection of the current session to ``engine``, or
+    a connection of its own that is closed at the end of the block
+    when there is no session"""
+    session = get_session()
+    if session is not None:
+        yield session.get_connection(engine)
+        return
+
+    conn = engine.connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import shutil
+import tempfile
+from StringIO import StringIO
+from collections import OrderedDict
+
+from gevent import subprocess
+from gevent.monkey import get_original
+
+from oldspeak import settings
+
+# header reads also run in git_threads, where the gevent versions of
+# these must not be used
+Popen = get_original('subprocess', 'Popen')
+allocate_lock = get_original('thread', 'allocate_lock')
+
+
+def find_loose_object(git_dir, hexsha):
+    """returns the path of a loose object in the repository or in one of
+    its alternates, or ``None`` if the object is packed"""
+    objects_dirs = [os.path.join(git_dir, 'objects')]
+    alternates_path = os.path.join(objects_dirs[0], 'info', 'alternates')
+    if os.path.exists(alternates_path):
+        with open(alternates_path) as fd:
+            objects_dirs.extend(line.strip() for line in fd if line.strip())
+
+    for objects_dir in objects_dirs:
+        path = os.path.join(objects_dir, hexsha[:2], hexsha[2:])
+        if os.path.exists(path):
+            return path
+
+
+def stop_process(process):
+    process.stdin.close()
+    if process.poll() is None:
+        process.kill()
+
+    process.wait()
+    process.stdout.close()
+
+
+class ObjectHeaderReader(object):
+    """reads the type and size of objects through one long-running
+    ``git cat-file --batch-check`` per repository, so packed objects
+    don't have to be inflated to learn their size.
+
+    At most ``max_processes`` are kept running, the least recently used
+    one is stopped when the limit is reached. Reads are serialized by a
+    native lock and only block for one line of output, so they can be
+    made from the hub and from :py:data:`git_threads` alike.
+    """
+
+    def __init__(self, max_processes=None):
+        self.max_processes = max_processes or settings.VFS_MAX_HEADER_PROCESSES
+        self.processes = OrderedDict()
+        self.lock = allocate_lock()
+
+    def get_process(self, git_dir):
+        process = self.processes.pop(git_dir, None)
+        if process is None or process.poll() is not None:
+            with open(os.devnull, 'w') as devnull:
+                process = Popen(
+                    ['git', '--git-dir', git_dir, 'cat-file', '--batch-check'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=devnull,
+                )
+
+        self.processes[git_dir] = process
+        while len(self.processes) > self.max_processes:
+            stop_process(self.processes.popitem(last=False)[1])
+
+        return process
+
+    def read(self, git_dir, hexsha):
+        """returns the ``(type, size)`` of an object or ``None`` when
+        git can't read it"""
+        with self.lock:
+            process = self.get_process(git_dir)
+            try:
+                process.stdin.write(b'{}\n'.format(hexsha))
+                process.stdin.flush()
+                line = process.stdout.readline()
+            except (IOError, OSError):
+                line = b''
+
+            if not line:
+                stop_process(self.processes.pop(git_dir))
+
+        # "<oid> <type> <size>" or "<oid> missing"
+        parts = line.split()
+        if len(parts) != 3:
+            return None
+
+        return parts[1], int(parts[2])
+
+    def close(self, git_dir):
+        with self.lock:
+            process = self.processes.pop(git_dir, None)
+            if process is not None:
+                stop_process(process)
+
+        return process is not None
+
+    def clear(self):
+        with self.lock:
+            while self.processes:
+                stop_process(self.processes.popitem()[1])
+
+
+object_headers = ObjectHeaderReader()
+
+
+class SpooledFile(object):
+    """a file staged to be written as a blob, either an existing file on
+    disk or a temporary copy of a stream"""
+
+    def __init__(self, path, temporary=False):
+        self.path = path
+        self.temporary = temporary
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @classmethod
+    def from_fileobj(cls, fileobj):
+        name = getattr(fileobj, 'name', None)
+        if isinstance(name, basestring) and os.path.isfile(name) and not fileobj.tell():
+            return cls(name)
+
+        fd, path = tempfile.mkstemp(prefix='oldspeak-', suffix='.spool')
+        with os.fdopen(fd, 'wb') as spool:
+            shutil.copyfileobj(fileobj, spool, settings.VFS_STREAM_CHUNK_SIZE)
+
+        return cls(path, temporary=True)
+
+    def cleanup(self):
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BlobStream(object):
+    """a read-only file-like object with the contents of a blob, the
+    contents are read ``chunk_size`` bytes at a time when iterated.
+
+    Subclasses either implement ``fill(size)``, which adds at least
+    ``size`` bytes to ``buffer`` unless the blob ends first, or
+    override :py:meth:`read`.
+    """
+
+    def __init__(self, size=None, chunk_size=None):
+        self.size = size
+        self.chunk_size = chunk_size or settings.VFS_STREAM_CHUNK_SIZE
+        self.buffer = b''
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+
+            yield chunk
+
+    def read(self, size=-1):
+        self.fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def close(self):
+        pass
+
+
+class CachedBlobStream(BlobStream):
+    def __init__(self, data, **kw):
+        super(CachedBlobStream, self).__init__(len(data), **kw)
+        self.buffer = StringIO(data)
+
+    def read(self, size=-1):
+        return self.buffer.read(size)
+
+
+class LooseBlobStream(BlobStream):
+    """inflates a loose object a chunk at a time"""
+
+    def __init__(self, path, **kw):
+        super(LooseBlobStream, self).__init__(**kw)
+        self.fd = open(path, 'rb')
+        self.decompressor = zlib.decompressobj()
+        self.fill(1)
+
+    def fill(self, size):
+        # the header is read first, the output of each step is capped
+        # at chunk_size so that a chunk that compresses well never
+        # inflates into much more than was asked for
+        while (self.size is None or size < 0 or len(self.buffer) < size) and not self.eof:
+            chunk = self.decompressor.unconsumed_tail or self.fd.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk, self.chunk_size)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+
+            if self.size is None and b'\0' in self.buffer:
+                header, self.buffer = self.buffer.split(b'\0', 1)
+                self.size = int(header.split(b' ', 1)[1])
+
+    def close(self):
+        self.fd.close()
+
+
+class ProcessBlobStream(BlobStream):
+    """streams a packed blob through ``git cat-file`` so that it never
+    needs to be held in memory at once"""
+
+    def __init__(self, git_dir, hexsha, **kw):
+        super(ProcessBlobStream, self).__init__(**kw)
+        self.process = subprocess.Popen(
+            ['git', '--git-dir', git_dir, 'cat-file', 'blob', hexsha],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process.wait()
+
+
+def open_blob(git_dir, oid, cached_data=None):
+    """returns the best :py:class:`BlobStream` for a blob"""
+    if cached_data is not None:
+        return CachedBlobStream(cached_data)
+
+    loose_path = find_loose_object(git_dir, oid.hex)
+    if loose_path:
+        return LooseBlobStream(loose_path)
+
+    return ProcessBlobStream(git_dir, oid.hex)
@@ -1,21 +1,376 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import zlib
+import heapq
+import shutil
+import hashlib
+import gevent
 import pygit2
 import logging
+import threading
+from bisect import bisect_left
+from bisect import bisect_right
 from collections import OrderedDict
+from collections import namedtuple
+from contextlib import contextmanager
+from gevent.event import AsyncResult
+from gevent import subprocess
 from pygit2 import Repository
 from pygit2 import GitError
 from pygit2 import init_repository
 from pygit2 import discover_repository
 
 from oldspeak import settings
+from oldspeak.persistence.maintenance import maintenance
+from oldspeak.persistence.offload import git_threads
+from oldspeak.persistence.leases import get_lease_manager
+from oldspeak.persistence.shared import stores as shared_stores
+from oldspeak.persistence.shared import get_shared_store
+from oldspeak.persistence.streams import open_blob
+from oldspeak.persistence.streams import find_loose_object
+from oldspeak.persistence.streams import object_headers
+from oldspeak.persistence.streams import SpooledFile
 
 
 class BlobNotFound(Exception):
     pass
 
 
+class InvalidPath(Exception):
+    pass
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class InvalidCursor(Exception):
+    """raised when the cursor of a page of history is not the oid of a
+    commit of the bucket"""
+
+
+class CommitConflict(Exception):
+    """raised when another process changed the same paths of a bucket
+    since the commit being created was started"""
+
+    def __init__(self, message, paths=None):
+        super(CommitConflict, self).__init__(message)
+        self.paths = paths or []
+
+
+def normalize_path(path):
+    """turns a user-given path into a clean tree path relative to the
+    root of the repository, e.g: ``./todo//oldspeak.md`` becomes
+    ``todo/oldspeak.md``"""
+    parts = []
+    for part in path.replace(os.sep, '/').split('/'):
+        if part in ('', '.'):
+            continue
+        elif part == '..':
+            raise InvalidPath('{} points outside of the repository'.format(path))
+
+        parts.append(part)
+
+    if not parts:
+        raise InvalidPath('{} does not point to a file'.format(path))
+
+    return '/'.join(parts)
+
+
+IndexEntry = namedtuple('IndexEntry', ['oid', 'size', 'mode'])
+
+
+def diff_trees(repo, old_tree_id, new_tree_id, prefix=''):
+    """yields a ``(path, entry)`` tuple for every blob that differs
+    between two trees, ``entry`` is ``None`` when the blob was removed.
+
+    Subtrees that have the same oid on both sides are skipped without
+    being read.
+    """
+    if old_tree_id == new_tree_id:
+        return
+
+    old = dict((entry.name, entry) for entry in repo.get(old_tree_id)) if old_tree_id else {}
+    new = dict((entry.name, entry) for entry in repo.get(new_tree_id)) if new_tree_id else {}
+
+    for name in sorted(set(old) | set(new)):
+        before = old.get(name)
+        after = new.get(name)
+        if before is not None and after is not None and before.id == after.id and before.filemode == after.filemode:
+            continue
+
+        path = prefix + name
+        before_is_tree = before is not None and before.filemode == pygit2.GIT_FILEMODE_TREE
+        after_is_tree = after is not None and after.filemode == pygit2.GIT_FILEMODE_TREE
+
+        if before is not None and not before_is_tree and (after is None or after_is_tree):
+            yield path, None
+
+        if before_is_tree or after_is_tree:
+            for item in diff_trees(
+                    repo,
+                    before.id if before_is_tree else None,
+                    after.id if after_is_tree else None,
+                    path + '/'):
+                yield item
+
+        if after is not None and not after_is_tree:
+            yield path, after
+
+
+def read_diff(git, old_tree_id, new_tree_id):
+    """returns the :py:func:`diff_trees` of two trees as a list,
+    computed in :py:data:`git_threads`"""
+    return git_threads.run(
+        git.path, lambda: list(diff_trees(git, old_tree_id, new_tree_id)))
+
+
+def read_object_header(repo, oid):
+    """returns the ``(type, size)`` of an object without inflating its
+    contents, ``type`` is a name such as ``'blob'`` or ``'tree'``.
+
+    Only the first bytes of loose objects are decompressed, including
+    the loose objects of the shared store. The pygit2 we depend on has
+    no way of reading the header of a packed object, so those are
+    asked to ``git cat-file --batch-check`` and only loaded in full by
+    libgit2 when git can't be run.
+    """
+    loose_path = find_loose_object(repo.path, oid.hex)
+    try:
+        fd = open(loose_path or '', 'rb')
+    except IOError:
+        header = object_headers.read(repo.path, oid.hex)
+        if header is not None:
+            return header
+
+        obj = repo.get(oid)
+        if obj.type == pygit2.GIT_OBJ_TREE:
+            return 'tree', len(obj.read_raw())
+
+        return OBJECT_TYPE_NAMES[obj.type], obj.size
+
+    decompressor = zlib.decompressobj()
+    header = b''
+    with fd:
+        while b'\0' not in header:
+            chunk = fd.read(64)
+            if not chunk:
+                break
+
+            header += decompressor.decompress(decompressor.unconsumed_tail + chunk, 64)
+
+    kind, size = header.split(b'\0', 1)[0].split(b' ', 1)
+    return kind, int(size)
+
+
+OBJECT_TYPE_NAMES = {
+    pygit2.GIT_OBJ_COMMIT: 'commit',
+    pygit2.GIT_OBJ_TREE: 'tree',
+    pygit2.GIT_OBJ_BLOB: 'blob',
+    pygit2.GIT_OBJ_TAG: 'tag',
+}
+
+
+class WalkEntry(object):
+    """an entry yielded by :py:meth:`GitRepository.traverse_blobs`, the
+    ``size`` of a tree is its number of entries"""
+    __slots__ = ('path', 'name', 'type', 'oid', 'mode', 'size', 'depth')
+
+    def __init__(self, path, name, type, oid, mode, size, depth):
+        self.path = path
+        self.name = name
+        self.type = type
+        self.oid = oid
+        self.mode = mode
+        self.size = size
+        self.depth = depth
+
+    def __repr__(self):
+        return b'<WalkEntry({0} {1} size={2})>'.format(self.type, self.path, self.size)
+
+    def to_dict(self):
+        return OrderedDict([
+            (b'path', self.path),
+            (b'type', self.type),
+            (b'oid', self.oid.hex),
+            (b'size', self.size),
+        ])
+
+
+class TreeNode(object):
+    """a directory that is cached in memory by the :py:class:`TreeWriter`.
+
+    The underlying ``TreeBuilder`` is only created when the node is
+    changed, untouched nodes are nothing but an oid.
+    """
+    __slots__ = ('oid', 'builder', 'children', 'dirty')
+
+    def __init__(self, oid=None):
+        self.oid = oid
+        self.builder = None
+        self.children = {}
+        self.dirty = False
+
+
+class TreeWriter(object):
+    """writes trees incrementally.
+
+    Only the subtrees in the path of a change are loaded, they are
+    kept in memory as dirty nodes and flushed bottom-up in a single
+    pass by :py:meth:`write`, so every changed directory is written
+    exactly once regardless of how many files changed inside of it.
+    Unchanged siblings are reused by oid.
+    """
+
+    def __init__(self, repo, tree_id=None, blob_store=None):
+        self.repo = repo
+        self.blob_store = blob_store or repo
+        self.root = TreeNode(tree_id)
+        self.changes = OrderedDict()
+        self.objects_written = 0
+        # the blobs written to a separate blob store, included in
+        # objects_written
+        self.shared_objects = 0
+
+    def get_builder(self, node):
+        if node.builder is None:
+            if node.oid:
+                node.builder = self.repo.TreeBuilder(node.oid)
+            else:
+                node.builder = self.repo.TreeBuilder()
+
+        return node.builder
+
+    def get_folder(self, parts):
+        """returns the node of the given folder, marking it and all its
+        ancestors as dirty"""
+        node = self.root
+        node.dirty = True
+        for name in parts:
+            child = node.children.get(name)
+            if child is None:
+                entry = self.get_builder(node).get(name)
+                if entry is not None and entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                    child = TreeNode(entry.id)
+                else:
+                    child = TreeNode()
+
+                node.children[name] = child
+
+            child.dirty = True
+            node = child
+
+        return node
+
+    def find_folder(self, parts):
+        """returns the node of the given folder or ``None`` when it
+        doesn't exist, without marking any node as dirty"""
+        node = self.root
+        for name in parts:
+            child = node.children.get(name)
+            if child is None:
+                entry = self.get_builder(node).get(name)
+                if entry is None or entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                    return None
+
+                child = node.children[name] = TreeNode(entry.id)
+
+            node = child
+
+        return node
+
+    def insert(self, path, oid, filemode=pygit2.GIT_FILEMODE_BLOB, size=None):
+        path = normalize_path(path)
+        parts = path.split('/')
+        node = self.get_folder(parts[:-1])
+        name = parts[-1]
+        node.children.pop(name, None)
+        self.get_builder(node).insert(name, oid, filemode)
+        self.changes[path] = IndexEntry(oid.hex, size, filemode)
+        logging.debug('inserting {} {}'.format(path, oid))
+        return oid
+
+    def count_blob(self):
+        self.objects_written += 1
+        if self.blob_store is not self.repo:
+            self.shared_objects += 1
+
+    def write_blob(self, path, data):
+        """creates a blob with the given data and stages it in ``path``,
+        returns the oid of the new blob"""
+        self.count_blob()
+        return self.insert(path, self.blob_store.create_blob(data), size=len(data))
+
+    def write_blob_fromdisk(self, path, filename):
+        """creates a blob from a file on disk, streaming it into the
+        object database"""
+        self.count_blob()
+        oid = self.blob_store.create_blob_fromdisk(filename)
+        return self.insert(path, oid, size=os.path.getsize(filename))
+
+    def remove(self, path):
+        path = normalize_path(path)
+        parts = path.split('/')
+        name = parts[-1]
+        node = self.find_folder(parts[:-1])
+        if node is None or (name not in node.children and self.get_builder(node).get(name) is None):
+            # missing paths are not changes, they would show up in the
+            # history of the path otherwise
+            return
+
+        self.get_folder(parts[:-1])
+        node.children.pop(name, None)
+        builder = self.get_builder(node)
+        if builder.get(name) is not None:
+            builder.remove(name)
+
+        self.changes[path] = None
+        logging.debug('removing {}'.format(path))
+
+    def rebase(self, tree_id):
+        """replays the staged changes on top of another tree"""
+        changes, self.changes = self.changes, OrderedDict()
+        self.root = TreeNode(tree_id)
+        for path, entry in changes.items():
+            if entry is None:
+                self.remove(path)
+            else:
+                self.insert(path, pygit2.Oid(hex=entry.oid), entry.mode, entry.size)
+
+    def flush(self, node):
+        builder = self.get_builder(node)
+        for name, child in node.children.items():
+            if not child.dirty:
+                continue
+
+            child_id = self.flush(child)
+            if child_id:
+                builder.insert(name, child_id, pygit2.GIT_FILEMODE_TREE)
+            else:
+                del node.children[name]
+                entry = builder.get(name)
+                if entry is not None and entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                    builder.remove(name)
+
+        node.dirty = False
+        if not len(builder):
+            node.oid = None
+            return None
+
+        node.oid = builder.write()
+        self.objects_written += 1
+        return node.oid
+
+    def write(self):
+        """flushes every dirty node and returns the oid of the root
+        tree. An empty tree is written if nothing is left in the root"""
+        if not self.root.dirty and self.root.oid:
+            return self.root.oid
+
+        return self.flush(self.root) or self.repo.TreeBuilder().write()
+
+
 class GitNode(object):
     def __init__(self, path, ancestry=None, original_path=None):
         path = path.rstrip(os.sep) or '.'
@@ -48,6 +403,7 @@ class GitFile(GitNode):
 class AutoTreeBuilder(object):
     def __init__(self, repo=None, author_name=None, author_email=None, message='auto saving'):
         self.repo = repo
+        self.writer = None
         if not repo:
             return
 
@@ -88,42 +444,13 @@ class AutoTreeBuilder(object):
         return GitFile(parts[-1], ancestry=ancestry, original_path=path)
 
     def write_blob(self, path, data, root_tree=None):
-        node = self.path_to_blob(path)
-        reverse_ancestry = [node]
-        reverse_ancestry.extend(reversed(node.ancestry))
-
-        child_tree = self.tree
-        if not root_tree:
-            root_tree = child_tree
-        else:
-            child_tree = root_tree
-
-        def make_tree():
-            if child_tree:
-                return self.repo.TreeBuilder(child_tree.write())
-            else:
-                return self.repo.TreeBuilder()
-
-        blob = self.repo.create_blob(data)
-        content = str(blob)
+        if root_tree is not None:
+            self.writer = TreeWriter(self.repo, root_tree.id)
+        elif self.writer is None:
+            self.writer = TreeWriter(self.repo, self.root_tree_id)
 
-        trees = []
-
-        for index, node in enumerate(reverse_ancestry):
-            current_tree = make_tree()
-            trees.append(current_tree)
-            child_tree = current_tree
-
-            if index is 0:
-                logging.warning('inserting blob {}'.format(node.name))
-                child_tree.insert(node.name, content, pygit2.GIT_FILEMODE_BLOB)
-                content = child_tree.write()
-            else:
-                logging.warning('inserting tree {}'.format(node.name))
-                child_tree.insert(node.name, content, pygit2.GIT_FILEMODE_TREE)
-                content = current_tree.write()
-
-        new_root_id = current_tree.write()
+        blob = self.writer.write_blob(path, data)
+        new_root_id = self.writer.write()
 
         parents = []
         if self.head:
@@ -139,15 +466,638 @@ class AutoTreeBuilder(object):
                 parents,
             )
 
+        self.root_tree_id = new_root_id
         return self.repo.get(new_root_id), self.repo.get(blob)
 
 
+class PathIndex(object):
+    """a sorted index of ``path -> (oid, size, mode)`` for every blob
+    in the head of a repository.
+
+    The index is kept up to date incrementally with the changes of
+    each commit and persisted next to the repository as a snapshot
+    plus an append-only log of changes, which is folded into a new
+    snapshot every once in a while.
+
+    It also keeps the running totals of the bucket, see
+    :py:meth:`usage`, which are written to ``usage.json`` after every
+    commit so that they can be read without loading the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.clear()
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.path, 'paths.json')
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, 'paths.log')
+
+    @property
+    def usage_path(self):
+        return os.path.join(self.path, 'usage.json')
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def clear(self):
+        self.commit = None
+        self.paths = []
+        self.entries = {}
+        self.log_size = 0
+        self.size = 0
+        self.objects = 0
+
+    def load(self):
+        self.clear()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as fd:
+                snapshot = json.load(fd)
+
+            self.commit = snapshot['commit']
+            self.objects = snapshot.get('objects', 0)
+            for path, oid, size, mode in snapshot['entries']:
+                self.entries[path] = IndexEntry(oid, size, mode)
+                self.size += size or 0
+
+            self.paths = sorted(self.entries)
+
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as fd:
+                for line in fd:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partially written line
+                        break
+
+                    self.log_size += 1
+                    if record['parent'] == self.commit:
+                        self.apply(self.unpack_changes(record['changes']))
+                        self.commit = record['commit']
+                        self.objects += record.get('objects', 0)
+
+        return self
+
+    def save(self):
+        """writes a new snapshot and truncates the log"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        snapshot = {
+            'commit': self.commit,
+            'objects': self.objects,
+            'entries': [[path] + list(self.entries[path]) for path in self.paths],
+        }
+        temporary_path = '{}.tmp'.format(self.snapshot_path)
+        with open(temporary_path, 'w') as fd:
+            json.dump(snapshot, fd)
+
+        os.rename(temporary_path, self.snapshot_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+        self.log_size = 0
+
+    def pack_changes(self, changes):
+        return [[path] + list(entry or []) for path, entry in changes]
+
+    def unpack_changes(self, changes):
+        return [(item[0], IndexEntry(*item[1:]) if len(item) > 1 else None) for item in changes]
+
+    def get(self, path, fallback=None):
+        return self.entries.get(path, fallback)
+
+    def discard(self, path):
+        """removes a path and everything under it when it is a folder"""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            del self.paths[bisect_left(self.paths, path)]
+            self.size -= entry.size or 0
+
+        # '0' is the character that comes after '/'
+        start = bisect_left(self.paths, path + '/')
+        end = bisect_left(self.paths, path + '0', start)
+        for child in self.paths[start:end]:
+            self.size -= self.entries.pop(child).size or 0
+
+        del self.paths[start:end]
+
+    def put(self, path, entry):
+        if path not in self.entries:
+            # a file takes the place of a folder or vice-versa
+            self.discard(path)
+            parts = path.split('/')
+            for index in range(1, len(parts)):
+                ancestor = '/'.join(parts[:index])
+                if ancestor in self.entries:
+                    self.discard(ancestor)
+
+            self.paths.insert(bisect_left(self.paths, path), path)
+        else:
+            self.size -= self.entries[path].size or 0
+
+        self.entries[path] = entry
+        self.size += entry.size or 0
+
+    def apply(self, changes):
+        for path, entry in changes:
+            if entry is None:
+                self.discard(path)
+            else:
+                self.put(path, entry)
+
+    def update(self, parent, commit, changes, objects=0):
+        """applies the changes of ``commit`` on top of ``parent`` and
+        appends them to the log.
+
+        :param objects: how many git objects the commit wrote
+        """
+        changes = list(changes)
+        self.apply(changes)
+        self.commit = commit
+        self.objects += objects
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(self.log_path, 'a') as fd:
+            fd.write(json.dumps({
+                'parent': parent,
+                'commit': commit,
+                'objects': objects,
+                'changes': self.pack_changes(changes),
+            }))
+            fd.write('\n')
+
+        self.log_size += 1
+        if self.log_size >= settings.VFS_PATH_INDEX_LOG_SIZE:
+            self.save()
+
+        self.save_usage()
+
+    def usage(self):
+        """the number of ``bytes`` and ``files`` in the head and the
+        number of git ``objects`` written by the commits"""
+        return OrderedDict([
+            ('bytes', self.size),
+            ('files', len(self.paths)),
+            ('objects', self.objects),
+        ])
+
+    def save_usage(self):
+        temporary_path = '{}.tmp'.format(self.usage_path)
+        with open(temporary_path, 'w') as fd:
+            json.dump(self.usage(), fd)
+
+        os.rename(temporary_path, self.usage_path)
+
+    def sync(self, repository):
+        """catches up with the head of the repository, reading only the
+        subtrees that changed since the last indexed commit"""
+        head = repository.head
+        head_id = head.hex if head else None
+        if head_id == self.commit:
+            return self
+
+        old_tree_id = None
+        if self.commit:
+            old_commit = repository.get_commit(self.commit)
+            if old_commit:
+                old_tree_id = old_commit.tree.id
+            else:
+                self.clear()
+
+        base = self.commit
+        new_tree_id = head.tree.id if head else None
+        with repository.checkout() as git:
+            changes = git_threads.run(git.path, self.read_changes, git, old_tree_id, new_tree_id)
+
+        if self.commit != base:
+            # another greenlet synced the index in the meantime
+            return self.sync(repository)
+
+        # commits made elsewhere are counted as their new blobs plus
+        # the commit itself, leaving out the trees
+        objects = sum(1 for _, staged in changes if staged is not None) + 1 if head else 0
+        self.update(self.commit, head_id, changes, objects)
+        return self
+
+    def read_changes(self, git, old_tree_id, new_tree_id):
+        """returns the changes between two trees with the size of the
+        new blobs, runs in :py:data:`git_threads`"""
+        changes = []
+        for path, entry in diff_trees(git, old_tree_id, new_tree_id):
+            if entry is not None:
+                entry = IndexEntry(entry.hex, read_object_header(git, entry.id)[1], entry.filemode)
+
+            changes.append((path, entry))
+
+        return changes
+
+    def scan(self, prefix=None, cursor=None, limit=None):
+        """yields ``(path, entry)`` in lexicographic order for the paths
+        that start with ``prefix`` and come after ``cursor``"""
+        prefix = prefix or ''
+        while prefix.startswith('./'):
+            prefix = prefix[2:]
+
+        prefix = prefix.lstrip('/')
+        start = bisect_left(self.paths, prefix)
+        if cursor:
+            start = max(start, bisect_right(self.paths, cursor))
+
+        count = 0
+        for index in xrange(start, len(self.paths)):
+            if limit is not None and count >= limit:
+                break
+
+            path = self.paths[index]
+            if not path.startswith(prefix):
+                break
+
+            count += 1
+            yield path, self.entries[path]
+
+
+CommitInfo = namedtuple('CommitInfo', ['oid', 'parents', 'tree', 'time', 'paths'])
+
+
+def touches(paths, path):
+    """returns ``True`` when any of the changed ``paths`` is ``path``,
+    is inside of it or is a removed folder that contained it"""
+    for changed in paths:
+        if changed == path or changed.startswith(path + '/') or path.startswith(changed + '/'):
+            return True
+
+    return False
+
+
+class CommitGraph(object):
+    """a bounded cache of the commit graph of a repository: the
+    parents, tree, timestamp and changed paths of each commit.
+
+    Commits are recorded as they are created and persisted in an
+    append-only log next to the repository, commits that are not in
+    the cache are read from git and diffed against their first parent
+    only once. The least recently used commits are dropped when the
+    cache has more than ``max_size`` commits.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size or settings.VFS_COMMIT_GRAPH_SIZE
+        self.commits = OrderedDict()
+        self.log_size = 0
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, 'commits.log')
+
+    def __len__(self):
+        return len(self.commits)
+
+    def __contains__(self, oid):
+        return oid in self.commits
+
+    def load(self):
+        self.commits.clear()
+        self.log_size = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as fd:
+                for line in fd:
+                    try:
+                        self.remember(CommitInfo(*json.loads(line)))
+                    except (ValueError, TypeError):
+                        # partially written line
+                        break
+
+                    self.log_size += 1
+
+        return self
+
+    def remember(self, info):
+        self.commits.pop(info.oid, None)
+        self.commits[info.oid] = info
+        while len(self.commits) > self.max_size:
+            self.commits.popitem(last=False)
+
+    def add(self, info):
+        self.remember(info)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(self.log_path, 'a') as fd:
+            fd.write(json.dumps(list(info)))
+            fd.write('\n')
+
+        self.log_size += 1
+        if self.log_size > self.max_size * 2:
+            self.save()
+
+    def save(self):
+        """rewrites the log with only the commits that are cached"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        temporary_path = '{}.tmp'.format(self.log_path)
+        with open(temporary_path, 'w') as fd:
+            for info in self.commits.values():
+                fd.write(json.dumps(list(info)))
+                fd.write('\n')
+
+        os.rename(temporary_path, self.log_path)
+        self.log_size = len(self.commits)
+
+    def read(self, git, oid):
+        commit = git.get(oid)
+        parents = [parent.hex for parent in commit.parent_ids]
+        parent_tree_id = git.get(commit.parent_ids[0]).tree_id if parents else None
+        paths = [path for path, entry in diff_trees(git, parent_tree_id, commit.tree_id)]
+        return CommitInfo(commit.hex, parents, commit.tree_id.hex, commit.commit_time, paths)
+
+    def get(self, git, oid):
+        info = self.commits.get(oid)
+        if info is None:
+            info = git_threads.run(git.path, self.read, git, oid)
+            self.add(info)
+        else:
+            self.remember(info)
+
+        return info
+
+    def walk(self, git, starts, path=None, after=None):
+        """yields the :py:class:`CommitInfo` of the ``starts`` oids and
+        their ancestors by commit time, newest first, each commit once
+        and only the ones that changed ``path`` when given.
+
+        The parents are followed through the cache, git is only read
+        for the commits that are not cached yet. The commits up to and
+        including ``after`` are skipped, which is how a page continues
+        where the previous one ended.
+        """
+        heap = []
+        seen = set()
+
+        def push(oid):
+            if oid not in seen:
+                seen.add(oid)
+                info = self.get(git, oid)
+                heapq.heappush(heap, (-info.time, info.oid, info))
+
+        for oid in starts:
+            push(oid)
+
+        skipping = after is not None
+        while heap:
+            info = heapq.heappop(heap)[2]
+            for parent in info.parents:
+                push(parent)
+
+            if skipping:
+                skipping = info.oid != after
+            elif path is None or touches(info.paths, path):
+                yield info
+
+
+def free_repository(repo):
+    # pygit2 >= 0.26 can release the file descriptors right away,
+    # older versions release them once the last reference is gone.
+    free = getattr(repo, 'free', None)
+    if callable(free):
+        free()
+
+
+class RepositoryPool(object):
+    """a process-wide LRU of open ``pygit2.Repository`` handles keyed
+    by path, also used for other per-repository state such as the
+    :py:class:`PathIndex`.
+
+    At most ``max_size`` repositories are kept open, the least
+    recently used handle gets closed when the limit is reached and
+    passed to ``on_close`` if given. Handles that are checked out with
+    :py:meth:`checkout` are never evicted, and when they are closed
+    they are only freed once every user released them.
+    """
+
+    def __init__(self, max_size=None, on_close=None):
+        self.max_size = max_size or settings.VFS_MAX_OPEN_REPOSITORIES
+        self.on_close = on_close
+        self.handles = OrderedDict()
+        self.lock = threading.RLock()
+        self.users = {}
+        self.retired = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, path):
+        return path in self.handles
+
+    def get(self, path, open_repository):
+        """returns the cached handle of ``path`` or calls
+        ``open_repository()`` to open a new one"""
+        with self.lock:
+            repo = self.handles.pop(path, None)
+            if repo is not None:
+                self.hits += 1
+                self.handles[path] = repo
+                return repo
+
+            self.misses += 1
+            repo = open_repository()
+            self.handles[path] = repo
+            self.evict(keep=path)
+            return repo
+
+    def evict(self, keep=None):
+        """closes the least recently used handles above ``max_size``
+        that aren't checked out, the pool grows past the limit while
+        every handle is in use"""
+        with self.lock:
+            excess = len(self.handles) - self.max_size
+            if excess <= 0:
+                return
+
+            idle = [path for path, repo in self.handles.items() if path != keep and id(repo) not in self.users]
+            for path in idle[:excess]:
+                self.close(path)
+                self.evictions += 1
+
+    @contextmanager
+    def checkout(self, path, open_repository):
+        """like :py:meth:`get` but the handle is not freed until the
+        block exits, even if it gets evicted meanwhile, e.g: while it is
+        used by a call in :py:data:`git_threads`"""
+        with self.lock:
+            repo = self.get(path, open_repository)
+            self.users[id(repo)] = self.users.get(id(repo), 0) + 1
+
+        try:
+            yield repo
+        finally:
+            self.release(repo)
+
+    def release(self, repo):
+        with self.lock:
+            users = self.users.pop(id(repo)) - 1
+            if users:
+                self.users[id(repo)] = users
+                return
+
+            retired = self.retired.pop(id(repo), None)
+
+        if retired is not None:
+            free_repository(retired)
+
+    def close(self, path):
+        with self.lock:
+            repo = self.handles.pop(path, None)
+            in_use = repo is not None and id(repo) in self.users
+            if in_use:
+                self.retired[id(repo)] = repo
+
+        if repo is not None and self.on_close is not None:
+            self.on_close(repo)
+
+        if not in_use:
+            free_repository(repo)
+
+        return repo is not None
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.handles.keys()):
+                self.close(path)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def stats(self):
+        return OrderedDict([
+            ('open', len(self.handles)),
+            ('max_size', self.max_size),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('evictions', self.evictions),
+        ])
+
+
+def forget_repository(repo):
+    # the maintenance stats and the header reads of a repository go
+    # away with its handle
+    maintenance.forget(repo.path)
+    object_headers.close(repo.path)
+
+
+repositories = RepositoryPool(on_close=forget_repository)
+path_indexes = RepositoryPool()
+write_coordinators = RepositoryPool()
+commit_graphs = RepositoryPool()
+
+# every pool of per-repository state, so that it can be dropped
+# when a repository is moved or removed
+pools = [repositories, path_indexes, write_coordinators, commit_graphs, object_headers]
+
+
+class BlobCache(object):
+    """a process-wide LRU of blob contents keyed by oid.
+
+    The size of the cache is bound by the total of bytes stored
+    rather than the number of entries, blobs bigger than
+    ``max_entry_size`` are never cached. Blobs are immutable so
+    entries don't ever need to be invalidated.
+    """
+
+    def __init__(self, max_bytes=None, max_entry_size=None):
+        self.max_bytes = max_bytes or settings.VFS_BLOB_CACHE_BYTES
+        self.max_entry_size = max_entry_size or self.max_bytes // 8
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, oid):
+        return str(oid) in self.entries
+
+    def put(self, oid, data):
+        key = str(oid)
+        length = len(data)
+        if length > self.max_entry_size:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self.entries[key] = data
+            self.size += length
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get(self, oid, load_data):
+        """returns the cached contents of the blob ``oid`` or calls
+        ``load_data()`` to read it from the object database"""
+        key = str(oid)
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.hits += 1
+                self.entries[key] = data
+                return data
+
+            self.misses += 1
+
+        data = load_data()
+        self.put(key, data)
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return OrderedDict([
+            ('entries', len(self.entries)),
+            ('bytes', self.size),
+            ('max_bytes', self.max_bytes),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('evictions', self.evictions),
+        ])
+
+
+blobs = BlobCache()
+
+
 class GitRepository(object):
-    def __init__(self, path, root_dir=None):
+    def __init__(self, path, root_dir=None, bare=None, registry=None, name=None):
         self.relative_path = path
         self.root_dir = root_dir or "."
+        self.bare = settings.VFS_BARE_REPOSITORIES if bare is None else bare
+        self.registry = registry
+        self.name = name or path
         self._current_tree = None
-        self.commit_cache = []
 
     @property
     def path(self):
@@ -172,18 +1122,38 @@ class GitRepository(object):
 
     def get_or_create(self):
         repo = self.get(self.path)
-        if repo:
-            return repo
+        if not repo:
+            repo = self.create(self.path, bare=self.bare)
+            if self.registry is not None:
+                self.registry.register(self.name)
+
+        store = get_shared_store(self.root_dir)
+        if store and store.attach(repo.path):
+            # libgit2 only reads the alternates when opening
+            repo = Repository(repo.path)
 
-        return self.create(self.path)
+        return repo
+
+    def exists(self):
+        return self.path in repositories or os.path.isdir(self.path)
 
     @property
     def git(self):
-        return self.get_or_create()
+        return repositories.get(self.path, self.get_or_create)
+
+    def checkout(self):
+        """the handle of :py:attr:`git`, kept open until the block
+        exits"""
+        return repositories.checkout(self.path, self.get_or_create)
+
+    def close(self):
+        return repositories.close(self.path)
 
     @property
     def head(self):
-        if self.git.head_is_unborn:
+        # reading from a bucket that was never written to should not
+        # create its repository
+        if not self.exists() or self.git.head_is_unborn:
             return None
 
         return self.git.head.get_object()
@@ -202,53 +1172,213 @@ class GitRepository(object):
         return self._current_tree
 
     def new_tree(self, *args, **kw):
-        logging.warning('new_tree() {args} {kw}'.format(**locals()))
+        logging.debug('new_tree() {args} {kw}'.format(**locals()))
         return self.git.TreeBuilder(*args, **kw)
 
-    def traverse_blobs(self, tree=None):
-        if not tree and not self.head and not self.tree:
-            raise StopIteration
+    def traverse_blobs(self, tree=None, prefix=None, max_depth=None):
+        """lazily walks a tree (the head tree by default) yielding a
+        :py:class:`WalkEntry` for every folder and file.
 
-        elif self.tree:
-            tree = self.tree
+        The walk is iterative, so it is not bound by the recursion
+        limit, and blob sizes are read from the path index or from the
+        object headers rather than by inflating the blobs.
+
+        :param prefix: only walk the paths that start with it
+        :param max_depth: do not descend into folders deeper than it,
+          ``0`` yields only the entries of the root tree.
+        """
+        index = None
+        if tree is None:
+            if not self.head:
+                return
 
-        elif not tree:
             tree = self.head.tree
+            index = self.paths
 
-        elif tree.type == 'blob':
-            entry = tree
-            node = self.git.get(entry.hex)
-            yield entry.name, OrderedDict([
-                (b'type', entry.type),
-                (b'size', node.size),
-                (b'is_binary', node.is_binary),
-            ])
-        else:
+        elif not isinstance(tree, pygit2.Tree):
+            tree = self.git.get(tree)
+
+        if prefix:
+            prefix = normalize_path(prefix)
+
+        stack = [(iter(tree), '', 0)]
+        while stack:
+            entries, parent, depth = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+
+            path = parent + entry.name
+            if prefix and not path.startswith(prefix) and not prefix.startswith(path + '/'):
+                continue
 
-            for entry in tree:
-                node = self.git.get(entry.hex)
-                if entry.type == 'blob':
-                    yield entry.name, OrderedDict([
-                        (b'type', entry.type),
-                        (b'size', node.size),
-                        (b'is_binary', node.is_binary),
-                    ])
-
-                elif entry.type == 'tree':
-                    yield entry.name, OrderedDict([
-                        (b'type', entry.type),
-                        (b'size', len(node)),
-                    ])
-                    for key, value in self.traverse_blobs(entry):
-                        yield key, value
+            if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                subtree = self.git.get(entry.id)
+                if not prefix or path.startswith(prefix):
+                    yield WalkEntry(path, entry.name, 'tree', entry.id, entry.filemode, len(subtree), depth)
+
+                if max_depth is None or depth < max_depth:
+                    stack.append((iter(subtree), path + '/', depth + 1))
+
+            elif entry.filemode != pygit2.GIT_FILEMODE_COMMIT:
+                indexed = index and index.get(path)
+                if indexed and indexed.oid == entry.hex:
+                    size = indexed.size
+                else:
+                    size = self.blob_size(entry.id)
+
+                yield WalkEntry(path, entry.name, 'blob', entry.id, entry.filemode, size, depth)
 
     def __iter__(self):
-        for k, v in self.traverse_blobs(self.head.tree):
-            yield k, v
+        return self.traverse_blobs()
+
+    def get_commit(self, revision=None):
+        """returns the commit of the given revision (a sha, a
+        reference name or any other git revision expression), or the
+        current head when no revision is given"""
+        if revision is None:
+            return self.head
+
+        try:
+            obj = self.git.revparse_single(str(revision))
+        except (KeyError, ValueError, GitError):
+            return None
+
+        if obj.type != pygit2.GIT_OBJ_COMMIT:
+            try:
+                obj = obj.peel(pygit2.Commit)
+            except (ValueError, GitError):
+                # e.g: the oid of a blob or of a tree
+                return None
+
+        return obj
+
+    def get_entry(self, path, revision=None):
+        """returns the tree entry of ``path`` at the given revision or
+        ``None`` if it does not exist"""
+        commit = self.get_commit(revision)
+        if not commit:
+            return None
+
+        tree = commit.tree
+        parts = normalize_path(path).split('/')
+        for name in parts[:-1]:
+            if name not in tree:
+                return None
+
+            entry = tree[name]
+            if entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                return None
+
+            tree = self.git.get(entry.id)
+
+        if parts[-1] not in tree:
+            return None
+
+        return tree[parts[-1]]
+
+    def blob_size(self, oid):
+        return read_object_header(self.git, oid)[1]
 
     @property
-    def name(self):
-        return os.path.basename(self.path)
+    def index_path(self):
+        return os.path.join(self.git.path, 'oldspeak')
+
+    @property
+    def paths(self):
+        """the :py:class:`PathIndex` of the head of this repository"""
+        index = path_indexes.get(self.path, lambda: PathIndex(self.index_path).load())
+        return index.sync(self)
+
+    def update_index(self, parent, commit, changes, objects=0):
+        """updates the path index with the changes made by a
+        :py:class:`TreeWriter` in ``commit``"""
+        index = path_indexes.get(self.path, lambda: PathIndex(self.index_path).load())
+        if index.commit != parent:
+            return index.sync(self)
+
+        entries = []
+        for path, entry in changes.items():
+            if entry is not None and entry.size is None:
+                entry = entry._replace(size=self.blob_size(entry.oid))
+
+            entries.append((path, entry))
+
+        index.update(parent, commit, entries, objects)
+        return index
+
+    def usage(self):
+        """returns the running totals of the head, see
+        :py:meth:`PathIndex.usage`"""
+        if not self.head:
+            return PathIndex(self.path).usage()
+
+        return self.paths.usage()
+
+    @property
+    def commit_graph(self):
+        return commit_graphs.get(self.path, lambda: CommitGraph(self.index_path).load())
+
+    def fast_forward(self, target, message='fast-forward'):
+        """see :py:meth:`WriteCoordinator.fast_forward`"""
+        coordinator = write_coordinators.get(self.path, lambda: WriteCoordinator(self))
+        return coordinator.fast_forward(target, message)
+
+    def record_commit(self, commit, paths):
+        """caches the commit graph entry of a commit that was just
+        created with the paths that it changed"""
+        self.commit_graph.add(CommitInfo(
+            commit.hex,
+            [parent.hex for parent in commit.parent_ids],
+            commit.tree_id.hex,
+            commit.commit_time,
+            list(paths),
+        ))
+
+    def history(self, path=None, limit=None, cursor=None):
+        """yields the :py:class:`CommitInfo` of the commits reachable
+        from the head, newest first.
+
+        :param path: only the commits that changed this path
+        :param limit: the maximum number of commits
+        :param cursor: the oid of the last commit of the previous page
+        :raises InvalidCursor: when ``cursor`` is not a commit
+        """
+        if cursor:
+            commit = self.get_commit(cursor)
+            if commit is None:
+                raise InvalidCursor('{} is not a commit of {}'.format(cursor, self.path))
+
+            # the walk starts over from the head so that the commits on
+            # the other side of a merge above the cursor are not lost
+            cursor = commit.hex
+
+        starts = [self.head.hex] if self.head else []
+        if path:
+            path = normalize_path(path)
+
+        with self.checkout() as git:
+            for count, info in enumerate(self.commit_graph.walk(git, starts, path, after=cursor)):
+                if limit is not None and count >= limit:
+                    return
+
+                yield info
+
+    def storage_stats(self):
+        """the loose object and pack counts of this repository, see
+        :py:class:`~oldspeak.persistence.maintenance.Maintenance`"""
+        return maintenance.stats(self.git.path)
+
+    def read_blob(self, oid):
+        """returns the contents of a blob, going through the shared
+        blob cache"""
+        return blobs.get(oid, lambda: self.git.get(oid).data)
+
+    def open_blob(self, oid):
+        """returns a file-like :py:class:`~oldspeak.persistence.streams.BlobStream`
+        that reads the blob in chunks"""
+        return open_blob(self.git.path, oid, blobs.entries.get(str(oid)))
 
     def commit(self, tree=None,
                author_name=None,
@@ -256,56 +1386,802 @@ class GitRepository(object):
                message=None,
                reference_name=None):
 
-        author_name = author_name or settings.VFS_PERSISTENCE_USER
-        author_email = author_email or settings.VFS_PERSISTENCE_USER
-        author = pygit2.Signature(author_name, author_email)
+        return create_commit(self.git, tree.id, author_name, author_email, message, reference_name)
+
+
+def create_commit(git, tree_id, author_name=None, author_email=None, message=None, reference_name=None, parents=None):
+    """commits a tree on top of the head of ``git``, only touches
+    libgit2 so it can run in :py:data:`git_threads`.
+
+    When ``parents`` are given the reference is only moved if it still
+    points to the first of them, otherwise a ``GitError`` is raised.
+    """
+    author_name = author_name or settings.VFS_PERSISTENCE_USER
+    author_email = author_email or settings.VFS_PERSISTENCE_USER
+    author = pygit2.Signature(author_name, author_email)
+
+    if parents is None:
+        parents = [] if git.head_is_unborn else [git.head.target]
+
+    if not reference_name:
+        reference_name = 'refs/heads/master'
+
+    sha = git.create_commit(
+        reference_name,
+        author,
+        author,
+        message or 'auto-save',
+        tree_id,
+        parents
+    )
+    commit = git.get(sha)
+
+    # bare repositories only store objects, there is no working
+    # tree to be checked out
+    if not git.is_bare:
+        git.reset(sha, pygit2.GIT_RESET_HARD)
+
+    return commit
+
+
+def get_tip(git, reference_name='refs/heads/master'):
+    """reads the oid that a reference points to from the disk, ``None``
+    when it doesn't exist yet"""
+    try:
+        return git.lookup_reference(reference_name).target.hex
+    except KeyError:
+        return None
+
+
+def update_branch(git, target, expected, reference_name='refs/heads/master', message='fast-forward'):
+    """moves a reference to ``target`` only if it still points to
+    ``expected``, ``None`` meaning that it must not exist yet. Returns
+    ``False`` when the reference was moved by someone else.
+
+    libgit2 only offers the compare-and-swap of a reference as part of
+    creating a commit, so this goes through ``git update-ref``.
+    """
+    command = ['git', '--git-dir', git.path, 'update-ref', '-m', message,
+               reference_name, target, expected or '0' * 40]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+    return process.returncode == 0
+
+
+def find_conflicts(ours, theirs):
+    """returns the sorted paths changed by both sides in different
+    ways, both arguments are dicts of ``path -> entry or None``.
+
+    Removing a folder conflicts with any file added inside of it and
+    a file conflicts with a folder of the same name.
+    """
+    names = sorted(theirs)
+    conflicts = set()
+    for path, entry in ours.items():
+        related = []
+        if path in theirs:
+            related.append(path)
+
+        start = bisect_left(names, path + '/')
+        for name in names[start:bisect_left(names, path + '0')]:
+            related.append(name)
+
+        parts = path.split('/')
+        for depth in range(1, len(parts)):
+            folder = '/'.join(parts[:depth])
+            if folder in theirs:
+                related.append(folder)
+
+        for name in related:
+            other = theirs[name]
+            if entry is None and other is None:
+                continue
+
+            if name == path and entry is not None and other is not None and \
+                    entry.oid == other.hex and entry.mode == other.filemode:
+                continue
+
+            conflicts.add(path)
+            conflicts.add(name)
+
+    return sorted(conflicts)
+
+
+def commit_optimistically(git, writer, parent, author_name=None, author_email=None, message=None, retries=None):
+    """commits the changes staged in a :py:class:`TreeWriter` on top of
+    ``parent`` with a compare-and-swap of the branch.
+
+    When another process moved the branch in the meantime, the changes
+    are replayed on top of the new tip as long as both sides changed
+    different paths, a :py:class:`CommitConflict` is raised otherwise.
+    """
+    retries = settings.VFS_COMMIT_RETRIES if retries is None else retries
+    tree_id = writer.write()
+    for attempt in range(retries + 1):
+        try:
+            return create_commit(
+                git, tree_id, author_name, author_email, message,
+                parents=[parent] if parent else [],
+            )
+        except GitError:
+            tip = get_tip(git)
+            if tip == parent:
+                raise
+
+        logging.info('{} moved from {} to {}, merging'.format(git.path, parent, tip))
+        parent_tree_id = git.get(parent).tree_id if parent else None
+        theirs = dict(diff_trees(git, parent_tree_id, git.get(tip).tree_id))
+        conflicts = find_conflicts(writer.changes, theirs)
+        if conflicts:
+            raise CommitConflict('{} were changed concurrently in {}'.format(', '.join(conflicts), git.path), conflicts)
+
+        writer.rebase(git.get(tip).tree_id)
+        tree_id = writer.write()
+        parent = tip
+
+    raise CommitConflict('gave up committing to {} after {} attempts'.format(git.path, retries + 1))
+
+
+def find_repositories(root_dir):
+    """yields the path of every git repository under ``root_dir``,
+    bare or not, without descending into them"""
+    for path, folders, files in os.walk(root_dir):
+        # hidden folders such as the shared object store are not buckets
+        folders[:] = [name for name in folders if name == '.git' or not name.startswith('.')]
+        if '.git' in folders:
+            folders[:] = []
+            yield path
+        elif 'HEAD' in files and 'objects' in folders and 'refs' in folders:
+            folders[:] = []
+            yield path
+
+
+def convert_to_bare(path):
+    """turns a repository with a working tree into a bare repository
+    in the same location, discarding the checked out files. Returns
+    ``False`` if the repository was already bare"""
+    path = os.path.abspath(path)
+    git_dir = os.path.join(path, '.git')
+    if not os.path.isdir(git_dir):
+        return False
+
+    for pool in pools:
+        pool.close(path)
+
+    temporary_path = '{}.bare'.format(path.rstrip(os.sep))
+    os.rename(git_dir, temporary_path)
+    shutil.rmtree(path)
+    os.rename(temporary_path, path)
+
+    repo = Repository(path)
+    repo.config['core.bare'] = True
+    return True
+
+
+class BucketRegistry(object):
+    """maps bucket names to the location of their repositories and keeps
+    a catalog of the buckets that exist.
+
+    Repositories are spread in a hashed fan-out of folders so that no
+    folder ends up with hundreds of thousands of entries, e.g:
+    ``fingerprint/<FP>`` is stored in ``fingerprint/3f/a1/<FP>``.
+    Buckets created before the fan-out are still found in their
+    original location until :py:meth:`migrate` moves them.
+
+    The catalog is an append-only file with one bucket name per line,
+    it allows enumerating the buckets without walking the folders.
+    """
+
+    def __init__(self, root_dir=None, depth=2):
+        self.root_dir = os.path.abspath(root_dir or settings.OLDSPEAK_DATADIR)
+        self.depth = depth
+        self.names = None
+        self.lock = threading.RLock()
+
+    @property
+    def catalog_path(self):
+        return os.path.join(self.root_dir, 'catalog.txt')
+
+    def shards(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return [digest[index * 2:index * 2 + 2] for index in range(self.depth)]
+
+    def location(self, name):
+        """the path of the repository of a bucket relative to
+        ``root_dir`` in the sharded layout"""
+        namespace, _, rest = name.partition('/')
+        if rest:
+            return '/'.join([namespace] + self.shards(name) + [rest])
+
+        return '/'.join(self.shards(name) + [name])
+
+    def legacy_location(self, name):
+        return name
+
+    def name_from_location(self, location):
+        """the bucket name of a repository path relative to
+        ``root_dir``, in either layout"""
+        parts = location.strip('/').split('/')
+        depth = self.depth
+        candidates = [
+            '/'.join(parts[depth:]),
+            '/'.join(parts[:1] + parts[depth + 1:]),
+        ]
+        for name in candidates:
+            if name and self.location(name) == '/'.join(parts):
+                return name
+
+        return '/'.join(parts)
+
+    def load(self):
+        names = set()
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path) as fd:
+                names.update(filter(bool, map(str.strip, fd)))
+
+        self.names = names
+        return names
+
+    def catalog(self):
+        if self.names is None:
+            with self.lock:
+                if self.names is None:
+                    self.load()
+
+        return self.names
+
+    def __contains__(self, name):
+        return name in self.catalog()
+
+    def __iter__(self):
+        return iter(sorted(self.catalog()))
+
+    def __len__(self):
+        return len(self.catalog())
+
+    def buckets(self, namespace=None):
+        """yields the names of the existing buckets, optionally only the
+        ones in the given namespace"""
+        prefix = namespace and '{}/'.format(namespace.strip('/'))
+        for name in self:
+            if not prefix or name.startswith(prefix):
+                yield name
+
+    def register(self, name):
+        with self.lock:
+            catalog = self.catalog()
+            if name in catalog:
+                return False
+
+            if not os.path.isdir(self.root_dir):
+                os.makedirs(self.root_dir)
+
+            with open(self.catalog_path, 'a') as fd:
+                fd.write('{}\n'.format(name))
+
+            catalog.add(name)
+            return True
+
+    def resolve(self, name):
+        """the location of an existing bucket or of where a new bucket
+        will be created"""
+        if name not in self:
+            legacy = self.legacy_location(name)
+            if os.path.isdir(os.path.join(self.root_dir, legacy)):
+                return legacy
+
+        return self.location(name)
+
+    def open(self, name, **kw):
+        """returns a :py:class:`GitRepository` for the bucket without
+        touching the disk, the repository is only created when it is
+        first written to"""
+        return GitRepository(self.resolve(name), self.root_dir, registry=self, name=name, **kw)
+
+    def usage(self, name):
+        """returns the totals of a bucket from its ``usage.json``
+        without opening the repository when possible"""
+        path = os.path.join(self.root_dir, self.resolve(name))
+        git_dir = os.path.join(path, '.git')
+        if not os.path.isdir(git_dir):
+            git_dir = path
+
+        try:
+            with open(os.path.join(git_dir, 'oldspeak', 'usage.json')) as fd:
+                return json.load(fd, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return self.open(name).usage()
 
-        if not self.git.head_is_unborn:
-            parents = [self.git.head.target]
+    def total_usage(self, namespace=None):
+        """adds up the totals of every bucket, optionally only the ones
+        in the given namespace"""
+        total = OrderedDict([('buckets', 0), ('bytes', 0), ('files', 0), ('objects', 0)])
+        for name in self.buckets(namespace):
+            total['buckets'] += 1
+            for key, value in self.usage(name).items():
+                total[key] += value
+
+        return total
+
+    def migrate(self, name):
+        """moves a bucket from the legacy layout to the sharded layout,
+        returns ``False`` if there was nothing to move"""
+        source = os.path.join(self.root_dir, self.legacy_location(name))
+        target = os.path.join(self.root_dir, self.location(name))
+        if source == target or not os.path.isdir(source) or os.path.exists(target):
+            return False
+
+        for pool in pools:
+            pool.close(source)
+
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        os.rename(source, target)
+        self.register(name)
+        return True
+
+    def rebuild(self, write=True):
+        """recreates the catalog from the repositories on disk and
+        returns the names of the buckets found. Buckets that are still
+        in the legacy layout are returned but not added to the
+        catalog.
+
+        With ``write=False`` the buckets are only listed and the
+        catalog is left untouched, e.g: for dry runs.
+        """
+        names = []
+        sharded = set()
+        for path in find_repositories(self.root_dir):
+            location = os.path.relpath(path, self.root_dir)
+            name = self.name_from_location(location)
+            names.append(name)
+            if self.location(name) == location:
+                sharded.add(name)
+
+        if not write:
+            return sorted(names)
+
+        if not os.path.isdir(self.root_dir):
+            os.makedirs(self.root_dir)
+
+        temporary_path = '{}.tmp'.format(self.catalog_path)
+        with open(temporary_path, 'w') as fd:
+            for name in sorted(sharded):
+                fd.write('{}\n'.format(name))
+
+        os.rename(temporary_path, self.catalog_path)
+        with self.lock:
+            self.names = sharded
+
+        return sorted(names)
+
+
+registries = {}
+
+
+def clear_caches():
+    """forgets every open repository and per-repository state, needed
+    when the data dir is removed from under a running process"""
+    for pool in pools:
+        pool.clear()
+
+    registries.clear()
+    shared_stores.clear()
+
+
+def get_registry(root_dir=None):
+    """returns the :py:class:`BucketRegistry` of a data dir"""
+    root_dir = os.path.abspath(root_dir or settings.OLDSPEAK_DATADIR)
+    registry = registries.get(root_dir)
+    if registry is None:
+        registry = registries.setdefault(root_dir, BucketRegistry(root_dir))
+
+    return registry
+
+
+class Transaction(object):
+    """stages any number of writes and deletes in memory and persists
+    them as a single tree and a single commit.
+
+    Can be used as a context manager, in which case the changes are
+    committed when the block exits without errors:
+
+    ::
+
+        with bucket.transaction(message='importing drafts') as t:
+            t.write('drafts/one.md', '# One')
+            t.delete('drafts/old.md')
+    """
+
+    def __init__(self, bucket, message=None, author_name=None, author_email=None):
+        self.bucket = bucket
+        self.message = message
+        self.author_name = author_name or bucket.author_name
+        self.author_email = author_email or bucket.author_email
+        self.changes = OrderedDict()
+        self.blobs = OrderedDict()
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.save()
         else:
-            parents = []
+            self.rollback()
 
-        tree_id = tree.id
+    def __len__(self):
+        return len(self.changes)
 
-        if not reference_name:
-            reference_name = 'refs/heads/master'
+    def write(self, path, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
 
-        sha = self.git.create_commit(
-            reference_name,
-            author,
-            author,
-            message or 'auto-save',
-            tree_id,
-            parents
-        )
-        commit = self.git.get(sha)
+        self.changes[normalize_path(path)] = data
 
-        self.git.reset(sha, pygit2.GIT_RESET_HARD)
+    def write_stream(self, path, fileobj):
+        """stages the contents of a file-like object, which are copied
+        to a temporary file in chunks rather than read into memory"""
+        self.changes[normalize_path(path)] = SpooledFile.from_fileobj(fileobj)
 
-        self.commit_cache.append((sha, tree_id, parents))
+    def delete(self, path):
+        self.changes[normalize_path(path)] = None
+
+    def cleanup(self):
+        for data in self.changes.values():
+            if isinstance(data, SpooledFile):
+                data.cleanup()
+
+    def rollback(self):
+        self.cleanup()
+        self.changes.clear()
+
+    def check_quota(self, committed_with=()):
+        """raises :py:class:`QuotaExceeded` when the staged changes would
+        take the bucket over its quota. Only the running totals and the
+        staged paths are looked at, deleting a folder frees nothing
+        here.
+
+        ``committed_with`` are the transactions that go in the same
+        commit, before this one.
+        """
+        max_bytes, max_files = self.bucket.get_quota()
+        if not max_bytes and not max_files:
+            return
+
+        changes = OrderedDict()
+        for transaction in committed_with:
+            changes.update(transaction.changes)
+
+        changes.update(self.changes)
+
+        repo = self.bucket.repo
+        index = repo.paths if repo.head else PathIndex(repo.path)
+        size, files = index.size, len(index)
+        for path, data in changes.items():
+            previous = index.get(path)
+            if previous is not None:
+                size -= previous.size or 0
+                files -= 1
+
+            if isinstance(data, SpooledFile):
+                size += data.size
+                files += 1
+            elif data is not None:
+                size += len(data)
+                files += 1
+
+        if max_bytes and size > max_bytes:
+            raise QuotaExceeded('{} would use {} bytes out of {}'.format(self.bucket.path, size, max_bytes))
+
+        if max_files and files > max_files:
+            raise QuotaExceeded('{} would have {} files out of {}'.format(self.bucket.path, files, max_files))
+
+    def get_message(self):
+        if self.message:
+            return self.message
+
+        paths = list(self.changes.keys())
+        if len(paths) == 1:
+            return 'changing {}'.format(paths[0])
+
+        return 'changing {} files'.format(len(paths))
+
+    def save(self):
+        """writes all the staged blobs, builds one tree and creates one
+        commit. Returns the commit or ``None`` when nothing was staged.
+
+        Transactions saved concurrently to the same repository are
+        grouped together in a single commit by the
+        :py:class:`WriteCoordinator`.
+        """
+        if not self.changes:
+            return None
+
+        try:
+            self.check_quota()
+        except QuotaExceeded:
+            self.rollback()
+            raise
+
+        repo = self.bucket.repo
+        try:
+            # an evicted coordinator would leave the repository with
+            # two leaders racing to move the branch
+            with write_coordinators.checkout(repo.path, lambda: WriteCoordinator(repo)) as coordinator:
+                self.result = coordinator.submit(self)
+        finally:
+            self.rollback()
+
+        return self.result
+
+
+class WriteCoordinator(object):
+    """serializes the writes to a repository and groups the
+    transactions that are saved concurrently within ``window`` seconds
+    into one tree and one commit.
+
+    The first greenlet to submit a transaction becomes the leader: it
+    waits for the window to close, commits everything that was queued
+    in the meantime and wakes the other writers with the result.
+    """
+
+    def __init__(self, repository, window=None):
+        self.repository = repository
+        self.window = window if window is not None else settings.VFS_GROUP_COMMIT_WINDOW
+        self.pending = []
+        self.leading = False
+        self.commits = 0
+        self.transactions = 0
+
+    def submit(self, transaction):
+        waiter = AsyncResult()
+        self.pending.append((transaction, waiter))
+        if not self.leading:
+            self.leading = True
+            self.lead()
+
+        return waiter.get()
+
+    def lead(self):
+        try:
+            gevent.sleep(self.window)
+            batch, self.pending = self.pending, []
+            self.flush(batch)
+        finally:
+            if self.pending:
+                gevent.spawn(self.lead)
+            else:
+                self.leading = False
+
+    def flush(self, batch):
+        # every transaction was checked alone when it was saved, the
+        # ones that would take the bucket over its quota together with
+        # the transactions before them are left out of the commit
+        admitted = []
+        for transaction, waiter in batch:
+            try:
+                transaction.check_quota([t for t, w in admitted])
+            except QuotaExceeded as error:
+                waiter.set_exception(error)
+            else:
+                admitted.append((transaction, waiter))
+
+        batch = admitted
+        if not batch:
+            return
+
+        try:
+            commit = self.commit([transaction for transaction, waiter in batch])
+        except Exception as error:
+            logging.exception('failed to commit {} transactions to {}'.format(len(batch), self.repository.path))
+            for transaction, waiter in batch:
+                waiter.set_exception(error)
+
+            return
+
+        for transaction, waiter in batch:
+            waiter.set(commit)
+
+    def get_message(self, transactions):
+        if len(transactions) == 1:
+            return transactions[0].get_message()
+
+        return '\n'.join(['grouping {} changes\n'.format(len(transactions))] + [
+            '- {}'.format(transaction.get_message()) for transaction in transactions
+        ])
+
+    def get_author(self, transactions):
+        authors = set((t.author_name, t.author_email) for t in transactions)
+        if len(authors) == 1:
+            return authors.pop()
+
+        return settings.VFS_PERSISTENCE_USER, settings.VFS_PERSISTENCE_EMAIL
+
+    def commit(self, transactions):
+        """applies the transactions in order on top of the head and
+        creates a single commit.
+
+        With write leases enabled the commit only happens while this
+        node holds the lease of the bucket.
+        """
+        leases = get_lease_manager()
+        if leases is None:
+            return self.apply(transactions)
+
+        with leases.hold(self.repository.name) as lease:
+            return self.apply(transactions, lease)
+
+    def apply(self, transactions, lease=None):
+        repo = self.repository
+        head = repo.head
+
+        store = get_shared_store(repo.root_dir)
+        author_name, author_email = self.get_author(transactions)
+
+        with repo.checkout() as git:
+            writer = TreeWriter(git, head.tree.id if head else None, blob_store=store)
+            # creating the blobs, trees and the commit is the blocking part
+            git_threads.run(git.path, self.write_blobs, writer, transactions)
+            if not writer.changes:
+                # e.g: deleting paths that don't exist
+                return head
+
+            if store:
+                # referenced before the commit so that collect() never
+                # deletes the blobs of a commit, a failed commit only
+                # leaves unused references behind
+                store.reference(repo.name, [oid for t in transactions for oid in t.blobs.values()])
+
+            commit = git_threads.run(
+                git.path, self.write,
+                writer, head.hex if head else None,
+                author_name, author_email, self.get_message(transactions),
+                lease, repo.index_path,
+            )
+            # the parent differs from the head read above when another
+            # process committed in the meantime
+            parent = commit.parent_ids[0].hex if commit.parent_ids else None
+            git_dir = git.path
+
+        for transaction in transactions:
+            for path, data in transaction.changes.items():
+                if isinstance(data, str):
+                    blobs.put(transaction.blobs[path], data)
+
+        repo.update_index(parent, commit.hex, writer.changes, writer.objects_written + 1)
+        repo.record_commit(commit, writer.changes.keys())
+        # the blobs of the shared store are loose objects of the store,
+        # not of the bucket
+        maintenance.track(git_dir, writer.objects_written - writer.shared_objects + 1)
+        if store and writer.shared_objects:
+            maintenance.track(store.path, writer.shared_objects, packer=store.pack)
+
+        self.commits += 1
+        self.transactions += len(transactions)
         return commit
 
+    def fast_forward(self, target, message='fast-forward'):
+        """moves the branch to ``target``, a commit that is already in
+        the repository and descends from the head, e.g: the tip of an
+        imported bundle.
+
+        It holds the same lease as the commits and raises
+        :py:class:`CommitConflict` if the head is not an ancestor of
+        ``target``.
+        """
+        leases = get_lease_manager()
+        if leases is None:
+            return self.move(target, message)
+
+        with leases.hold(self.repository.name) as lease:
+            return self.move(target, message, lease)
+
+    def move(self, target, message, lease=None):
+        repo = self.repository
+        git = repo.git
+        if lease is not None:
+            lease.fence(repo.index_path)
+
+        for attempt in range(settings.VFS_COMMIT_RETRIES + 1):
+            tip = get_tip(git)
+            if tip == target:
+                break
+
+            if tip and git.merge_base(pygit2.Oid(hex=tip), pygit2.Oid(hex=target)) != pygit2.Oid(hex=tip):
+                raise CommitConflict('{} is not a fast-forward of {} in {}'.format(target, tip, git.path))
+
+            if update_branch(git, target, tip, message=message):
+                break
+        else:
+            raise CommitConflict('gave up moving {} after {} attempts'.format(git.path, settings.VFS_COMMIT_RETRIES + 1))
+
+        if not git.is_bare:
+            with repo.checkout() as git:
+                git_threads.run(git.path, git.reset, pygit2.Oid(hex=target), pygit2.GIT_RESET_HARD)
+
+        # the path index catches up with the new head
+        repo.paths
+        self.commits += 1
+        return git.get(target)
+
+    def write_blobs(self, writer, transactions):
+        """writes the blobs of the transactions and stages their
+        removals, runs in :py:data:`git_threads`"""
+        for transaction in transactions:
+            for path, data in transaction.changes.items():
+                if data is None:
+                    writer.remove(path)
+                elif isinstance(data, SpooledFile):
+                    transaction.blobs[path] = writer.write_blob_fromdisk(path, data.path)
+                else:
+                    transaction.blobs[path] = writer.write_blob(path, data)
+
+    def write(self, writer, parent, author_name, author_email, message, lease=None, index_path=None):
+        """writes the trees of the staged changes and commits them,
+        runs in :py:data:`git_threads`"""
+        if lease is not None:
+            lease.fence(index_path)
+
+        return commit_optimistically(writer.repo, writer, parent, author_name, author_email, message)
+
+    def stats(self):
+        return OrderedDict([
+            ('pending', len(self.pending)),
+            ('commits', self.commits),
+            ('transactions', self.transactions),
+        ])
+
 
 class Bucket(object):
+    # ``None`` falls back to the settings, ``0`` means unlimited
+    quota_bytes = None
+    quota_files = None
+
     def __init__(self, path=None, author_name=None, author_email=None, *args, **kw):
         self.new(path, *args, **kw)
         self.path = path or self.get_path()
-        self.repo = GitRepository(self.path, settings.OLDSPEAK_DATADIR)
+        self.repo = get_registry().open(self.path)
 
         self.author_name = author_name or 'oldspeak'
         self.author_email = author_email or 'oldspeak@oldspeak'
 
+    def transaction(self, message=None, author_name=None, author_email=None):
+        return Transaction(
+            self,
+            message=message,
+            author_name=author_name,
+            author_email=author_email,
+        )
+
+    def write_files(self, files, deleted=None, message=None, author_name=None, author_email=None, **kw):
+        """writes many files at once with a single commit.
+
+        :param files: a dict of path -> data
+        :param deleted: an optional list of paths to be removed
+        :returns: a dict of path -> blob
+        """
+        transaction = self.transaction(message, author_name, author_email)
+        for name, data in files.items():
+            transaction.write(name, data)
+
+        for name in deleted or []:
+            transaction.delete(name)
+
+        transaction.save()
+        return OrderedDict([
+            (path, self.resolve(oid)) for path, oid in transaction.blobs.items()
+        ])
+
     def write_file(self, name, data, message=None, author_name=None, author_email=None, **kw):
-        commit_data = {
-            'message': message or 'changing {name}'.format(**locals()),
-            'author_name': author_name or self.author_name,
-            'author_email': author_email or self.author_email,
-        }
-        writer = AutoTreeBuilder(self.repo.git)
-        tree, blob = writer.write_blob(name, data)
-        commit_data['tree'] = tree
-        self.repo.commit(**commit_data)
-        return blob
+        blobs = self.write_files({name: data}, message=message, author_name=author_name, author_email=author_email)
+        return blobs.values()[0]
+
+    def delete_files(self, names, message=None, author_name=None, author_email=None, **kw):
+        return self.write_files({}, deleted=names, message=message, author_name=author_name, author_email=author_email)
 
     def save(self, message=None, author_name=None, author_email=None, **kw):
         kw = {}
@@ -321,19 +2197,98 @@ class Bucket(object):
     def resolve(self, oid):
         return self.repo.git.get(oid)
 
+    def get_quota(self):
+        """returns the maximum ``(bytes, files)`` of the bucket"""
+        return (
+            settings.VFS_BUCKET_QUOTA_BYTES if self.quota_bytes is None else self.quota_bytes,
+            settings.VFS_BUCKET_QUOTA_FILES if self.quota_files is None else self.quota_files,
+        )
+
+    def usage(self):
+        """returns the ``bytes``, ``files`` and ``objects`` of the bucket
+        from running totals, without walking the tree"""
+        return self.repo.usage()
+
+    def read_file(self, path, at=None):
+        """returns the contents of the file in ``path`` as of the
+        revision ``at``, which defaults to the latest commit"""
+        entry = self.repo.get_entry(path, at)
+        if entry is None or entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            raise BlobNotFound('{} does not exist in {}'.format(path, self.path))
+
+        return self.repo.read_blob(entry.id)
+
+    def open(self, path, at=None):
+        """returns a read-only file-like object with the contents of the
+        file in ``path``, reading it in chunks so that big files are
+        never held in memory at once"""
+        entry = self.repo.get_entry(path, at)
+        if entry is None or entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            raise BlobNotFound('{} does not exist in {}'.format(path, self.path))
+
+        return self.repo.open_blob(entry.id)
+
+    def write_stream(self, name, fileobj, message=None, author_name=None, author_email=None, **kw):
+        """writes the contents of a file-like object, e.g: an upload,
+        with constant memory. Returns the oid of the new blob"""
+        transaction = self.transaction(message, author_name, author_email)
+        transaction.write_stream(name, fileobj)
+        transaction.save()
+        return transaction.blobs.values()[0]
+
     def new(self, *args, **kw):
         pass
 
-    def list(self):
+    def history(self, path=None, limit=20, cursor=None):
+        """returns a page of the commits of the bucket, newest first.
+
+        :param path: only list the commits that changed this path
+        :param limit: the number of commits in the page
+        :param cursor: the ``oid`` of the last commit of the previous
+          page.
+        :raises InvalidCursor: when ``cursor`` is not a commit of the
+          bucket
+        """
+        result = []
+        for info in self.repo.history(path=path, limit=limit, cursor=cursor):
+            commit = self.repo.git.get(info.oid)
+            result.append(OrderedDict([
+                ('oid', info.oid),
+                ('parents', info.parents),
+                ('tree', info.tree),
+                ('time', info.time),
+                ('paths', info.paths),
+                ('message', commit.message),
+                ('author_name', commit.author.name),
+                ('author_email', commit.author.email),
+            ]))
+
+        return result
+
+    def last_modified(self, path):
+        """returns the :py:class:`CommitInfo` of the last commit that
+        changed ``path`` or ``None``"""
+        for info in self.repo.history(path=path, limit=1):
+            return info
+
+    def entries(self, prefix=None, limit=None, cursor=None):
+        """returns a list of ``(path, IndexEntry)`` from the path index,
+        see :py:meth:`list`"""
         if not self.repo.head:
             return []
 
-        data = []
-        tree = self.repo.head.tree
-        for patch in tree.diff_to_tree():
-            data.append(patch.delta.new_file.path)
+        return list(self.repo.paths.scan(prefix=prefix, cursor=cursor, limit=limit))
 
-        return data
+    def list(self, prefix=None, limit=None, cursor=None):
+        """lists the paths of the files in the bucket in lexicographic
+        order.
+
+        :param prefix: only list the paths that start with it
+        :param limit: the maximum number of paths to return
+        :param cursor: only list paths after this one, pass the last
+          path of a page to get the next page.
+        """
+        return [path for path, entry in self.entries(prefix, limit, cursor)]
 
 
 class System(Bucket):
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import json
+import tempfile
+
+from oldspeak.persistence.sql.mapper import import_fixture
 from oldspeak.persistence.sql.models import User
 from tests.functional.scenarios import sql_scenario
 
@@ -7,3 +11,68 @@ from tests.functional.scenarios import sql_scenario
 def test_mysql_connect(context):
     "Checking database querying"
     User.using(context.db.alias).all().should.be.empty
+
+
+def make_users(count):
+    return [{'email': 'user{}@oldspeak.io'.format(number), 'public_key': 'key {}'.format(number)}
+            for number in range(count)]
+
+
+@sql_scenario
+def test_bulk_create_and_update(context):
+    "Manager.bulk_create() and bulk_update() write many rows at once"
+    users = User.using(context.db.alias)
+
+    users.bulk_create(make_users(25), chunk_size=10).should.equal(25)
+    users.total_rows().should.equal(25)
+
+    ids = users.bulk_create(make_users(30)[25:], return_ids=True)
+    ids.should.have.length_of(5)
+    created = users.bulk_create([{'email': 'mary@oldspeak.io', 'public_key': 'mary'}], hydrate=True)
+    created[0].id.should.be.greater_than(max(ids))
+    created[0].email.should.equal('mary@oldspeak.io')
+
+    users.bulk_update([{'id': pk, 'status': 'imported'} for pk in ids]).should.equal(5)
+    users.total_rows(status='imported').should.equal(5)
+
+
+@sql_scenario
+def test_import_fixture(context):
+    "import_fixture() inserts the fixtures in bulk"
+    with tempfile.NamedTemporaryFile(suffix='.json') as fd:
+        json.dump([{'model': 'User', 'data': data} for data in make_users(3)], fd)
+        fd.flush()
+
+        import_fixture(fd.name, alias=context.db.alias).should.equal(3)
+        User.using(context.db.alias).total_rows().should.equal(3)
+
+
+@sql_scenario
+def test_bulk_create_decodes_and_keeps_the_order(context):
+    "Manager.bulk_create() decodes dict values and inserts rows in order"
+    users = User.using(context.db.alias)
+    rows = make_users(3)
+    rows[1]['last_login'] = '2017-01-06T21:34:10'
+
+    users.bulk_create(rows).should.equal(3)
+
+    [user.email for user in users.find_by(order_by='+id')].should.equal(
+        ['user0@oldspeak.io', 'user1@oldspeak.io', 'user2@oldspeak.io'])
+    users.find_one_by(email='user1@oldspeak.io').last_login.should.equal('2017-01-06T21:34:10')
+
+
+@sql_scenario
+def test_find_by_binds_cached_statements(context):
+    "find_one_by() and find_by() return the right rows from cached statements"
+    users = User.using(context.db.alias)
+    users.bulk_create(make_users(3))
+
+    users.find_one_by(email='user1@oldspeak.io').public_key.should.equal('key 1')
+    users.find_one_by(email='user2@oldspeak.io').public_key.should.equal('key 2')
+    users.find_one_by(email='nobody@oldspeak.io').should.be.none
+
+    [user.email for user in users.find_by(email__startswith='user', order_by='+id', limit_by=2)].should.equal(
+        ['user0@oldspeak.io', 'user1@oldspeak.io'])
+    [user.email for user in users.find_by(email__startswith='user', order_by='+id', limit_by=2, offset_by=2)].should.equal(
+        ['user2@oldspeak.io'])
+    users.find_by(status=None).should.have.length_of(3)
@@ -8,6 +8,7 @@ from sure import scenario
 # from datetime import datetime
 from oldspeak import settings
 from oldspeak.persistence import connectors
+from oldspeak.persistence import vfs
 from oldspeak.persistence.sql.mapper import metadata, orm
 from oldspeak.http.server import Application
 from oldspeak.lib.clients import OldSpeakClient
@@ -65,6 +66,7 @@ def cleanup_sql(context):
 
 def prepare_storage(context):
     target = settings.OLDSPEAK_DATADIR
+    vfs.clear_caches()
     if os.path.isdir(target):
         shutil.rmtree(target)
 
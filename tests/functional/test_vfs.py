@@ -1,10 +1,37 @@
 # -*- coding: utf-8 -*-
-# import os
+import os
+import gevent
+import pygit2
+from StringIO import StringIO
+from mock import patch
 # from glob import glob
 from tests.functional.fixtures import JohnDoe
 from tests.functional.scenarios import storage_scenario
 from oldspeak.persistence.vfs import Bucket
+from oldspeak.persistence.vfs import BlobNotFound
+from oldspeak.persistence.vfs import GitRepository
+from oldspeak.persistence.vfs import convert_to_bare
+from oldspeak.persistence.vfs import find_repositories
+from oldspeak.persistence.vfs import get_registry
 from oldspeak.persistence.vfs import System
+from oldspeak.persistence.vfs import TreeWriter
+from oldspeak.persistence.vfs import CommitConflict
+from oldspeak.persistence.vfs import InvalidCursor
+from oldspeak.persistence.vfs import QuotaExceeded
+from oldspeak.persistence.vfs import create_commit
+from oldspeak.persistence.vfs import commit_optimistically
+from oldspeak.persistence.vfs import AutoTreeBuilder
+from oldspeak import settings
+from oldspeak.persistence.maintenance import Maintenance
+from oldspeak.persistence.maintenance import maintenance
+from oldspeak.persistence.replication import export_bucket
+from oldspeak.persistence.replication import import_bucket
+from oldspeak.persistence.replication import ReplicationError
+from oldspeak.persistence.shared import get_shared_store
+from oldspeak.persistence.search import search
+from oldspeak.persistence.offload import git_threads
+from oldspeak.persistence.leases import LeaseLost
+from oldspeak.persistence.leases import get_lease_manager
 # from oldspeak.persistence.vfs import Member
 
 # import ipdb;ipdb.set_trace()
@@ -76,4 +103,647 @@ def test_core_system_storage(context):
 
     # tree.should.be.a('_pygit2.Tree')
     blob.should.be.a('_pygit2.Blob')
-    system.list().should.equal(['9FF44C58C3F0456CCD41F4EE876863BB2759DF55.json', 'fingerprints/9FF44C58C3F0456CCD41F4EE876863BB2759DF55.json'])
+    system.list().should.equal(['fingerprints/9FF44C58C3F0456CCD41F4EE876863BB2759DF55.json'])
+
+
+@storage_scenario
+def test_bucket_transaction_single_commit(context):
+    my_bucket = Bucket(
+        'transactions',
+        author_name=JohnDoe.name,
+        author_email=JohnDoe.email,
+    )
+    my_bucket.write_file('drafts/old.md', '# Old')
+    first_commit = my_bucket.repo.head
+
+    with my_bucket.transaction(message='importing drafts') as transaction:
+        for index in range(40):
+            transaction.write('drafts/{}/draft.md'.format(index), '# Draft {}'.format(index))
+
+        transaction.delete('drafts/old.md')
+
+    commit = transaction.result
+    commit.message.should.equal('importing drafts')
+    commit.parents.should.have.length_of(1)
+    commit.parents[0].id.should.equal(first_commit.id)
+
+    sorted(my_bucket.list()).should.equal(sorted(
+        'drafts/{}/draft.md'.format(index) for index in range(40)
+    ))
+
+
+@storage_scenario
+def test_bucket_write_files(context):
+    my_bucket = Bucket('write-many')
+
+    blobs = my_bucket.write_files({
+        'hello.md': 'hello',
+        'nested/world.md': 'world',
+    })
+
+    blobs['hello.md'].data.should.equal('hello')
+    blobs['nested/world.md'].data.should.equal('world')
+    my_bucket.repo.head.parents.should.be.empty
+
+    my_bucket.delete_files(['hello.md'])
+    my_bucket.list().should.equal(['nested/world.md'])
+
+
+@storage_scenario
+def test_tree_writer_nests_subtrees(context):
+    my_bucket = Bucket('tree-writer')
+    git = my_bucket.repo.git
+
+    writer = TreeWriter(git)
+    writer.write_blob('fingerprints/ABC.json', '{}')
+    writer.write_blob('fingerprints/DEF.json', '{}')
+    writer.write_blob('README.md', '# hello')
+    root = git.get(writer.write())
+
+    sorted(entry.name for entry in root).should.equal(['README.md', 'fingerprints'])
+    fingerprints = git.get(root['fingerprints'].id)
+    sorted(entry.name for entry in fingerprints).should.equal(['ABC.json', 'DEF.json'])
+
+    writer = TreeWriter(git, root.id)
+    writer.remove('fingerprints/ABC.json')
+    writer.remove('fingerprints/DEF.json')
+    new_root = git.get(writer.write())
+
+    [entry.name for entry in new_root].should.equal(['README.md'])
+    new_root['README.md'].id.should.equal(root['README.md'].id)
+
+
+@storage_scenario
+def test_tree_writer_ignores_removals_below_files(context):
+    my_bucket = Bucket('tree-writer-files')
+    git = my_bucket.repo.git
+
+    writer = TreeWriter(git)
+    writer.write_blob('notes', 'a file, not a folder')
+    root = git.get(writer.write())
+
+    writer = TreeWriter(git, root.id)
+    writer.remove('notes/today.md')
+    writer.remove('missing/today.md')
+    writer.remove('absent.md')
+    writer.changes.should.be.empty
+    new_root = git.get(writer.write())
+
+    [entry.name for entry in new_root].should.equal(['notes'])
+    new_root['notes'].id.should.equal(root['notes'].id)
+
+
+@storage_scenario
+def test_deleting_missing_files_commits_nothing(context):
+    my_bucket = Bucket('delete-missing')
+    my_bucket.write_file('a.md', 'a1', message='first')
+    head = my_bucket.repo.head.hex
+
+    my_bucket.delete_files(['missing.md', 'a.md/below.md'])
+
+    my_bucket.repo.head.hex.should.equal(head)
+    my_bucket.history(path='missing.md').should.be.empty
+    my_bucket.last_modified('missing.md').should.be.none
+
+
+@storage_scenario
+def test_auto_tree_builder_write_blob(context):
+    my_bucket = Bucket('auto-tree-builder')
+    builder = AutoTreeBuilder(my_bucket.repo.git, author_email=JohnDoe.email)
+
+    builder.write_blob('files/level1/level.2', 'two')
+    tree, blob = builder.write_blob('files/level.1', 'one')
+
+    blob.data.should.equal('one')
+    [entry.name for entry in tree].should.equal(['files'])
+    sorted(my_bucket.list()).should.equal(['files/level.1', 'files/level1/level.2'])
+
+
+@storage_scenario
+def test_bucket_read_file(context):
+    my_bucket = Bucket('read-file')
+    my_bucket.write_file('essays/one.md', 'first version')
+    first_commit = my_bucket.repo.head.id
+    my_bucket.write_file('essays/one.md', 'second version')
+
+    my_bucket.read_file('essays/one.md').should.equal('second version')
+    my_bucket.read_file('./essays/one.md', at=first_commit).should.equal('first version')
+    my_bucket.read_file.when.called_with('essays/two.md').should.throw(BlobNotFound)
+    my_bucket.read_file.when.called_with('essays').should.throw(BlobNotFound)
+
+
+@storage_scenario
+def test_bucket_list_with_prefix_and_pagination(context):
+    system = System()
+    with system.transaction() as transaction:
+        for index in range(10):
+            transaction.write('fingerprints/{:02d}.json'.format(index), '{}')
+
+        transaction.write('README.md', '# System')
+
+    system.list(prefix='fingerprints/', limit=4).should.equal([
+        'fingerprints/00.json',
+        'fingerprints/01.json',
+        'fingerprints/02.json',
+        'fingerprints/03.json',
+    ])
+    system.list(prefix='fingerprints/', limit=4, cursor='fingerprints/07.json').should.equal([
+        'fingerprints/08.json',
+        'fingerprints/09.json',
+    ])
+    path, entry = system.entries(prefix='README')[0]
+    entry.size.should.equal(len('# System'))
+
+    system.delete_files(['fingerprints'])
+    system.list().should.equal(['README.md'])
+
+
+@storage_scenario
+def test_traverse_blobs(context):
+    my_bucket = Bucket('traverse')
+    my_bucket.write_files({
+        'a.md': 'a',
+        'docs/b.md': 'bb',
+        'docs/deep/c.md': 'ccc',
+        'other/d.md': 'dddd',
+    })
+
+    [(e.path, e.type, e.size) for e in my_bucket.repo].should.equal([
+        ('a.md', 'blob', 1),
+        ('docs', 'tree', 2),
+        ('docs/b.md', 'blob', 2),
+        ('docs/deep', 'tree', 1),
+        ('docs/deep/c.md', 'blob', 3),
+        ('other', 'tree', 1),
+        ('other/d.md', 'blob', 4),
+    ])
+
+    walk = my_bucket.repo.traverse_blobs(prefix='docs/deep')
+    [e.path for e in walk].should.equal(['docs/deep', 'docs/deep/c.md'])
+
+    walk = my_bucket.repo.traverse_blobs(max_depth=0)
+    [e.path for e in walk].should.equal(['a.md', 'docs', 'other'])
+
+    tree = my_bucket.repo.head.tree
+    walk = my_bucket.repo.traverse_blobs(tree, prefix='other')
+    [(e.path, e.size, e.depth) for e in walk].should.equal([('other', 1, 0), ('other/d.md', 4, 1)])
+
+
+@storage_scenario
+def test_maintenance_repacks_loose_objects(context):
+    my_bucket = Bucket('maintenance')
+    my_bucket.write_files({
+        'a.md': 'a',
+        'docs/b.md': 'b',
+    })
+    git_dir = my_bucket.repo.git.path
+
+    maintenance = Maintenance(threshold=5, min_interval=0, cooldown=0)
+    maintenance.stats(git_dir)['loose_objects'].should.equal(5)
+    maintenance.track(git_dir, 0).scheduled.should.be.true
+
+    maintenance.run_pending().should.equal(1)
+
+    stats = maintenance.stats(git_dir)
+    stats['loose_objects'].should.equal(0)
+    stats['packs'].should.equal(1)
+    stats['repacks'].should.equal(1)
+    my_bucket.read_file('docs/b.md').should.equal('b')
+
+
+@storage_scenario
+def test_concurrent_writes_are_grouped_in_one_commit(context):
+    my_bucket = Bucket('group-commit')
+    my_bucket.write_file('README.md', '# group commit')
+    parent = my_bucket.repo.head.id
+
+    jobs = [
+        gevent.spawn(my_bucket.write_file, 'notes/{}.md'.format(index), 'note {}'.format(index))
+        for index in range(10)
+    ]
+    gevent.joinall(jobs, raise_error=True)
+
+    [job.value.data for job in jobs].should.equal(['note {}'.format(index) for index in range(10)])
+    head = my_bucket.repo.head
+    head.parents.should.have.length_of(1)
+    head.parents[0].id.should.equal(parent)
+    my_bucket.list(prefix='notes/').should.have.length_of(10)
+
+
+@storage_scenario
+def test_buckets_are_bare_repositories(context):
+    my_bucket = Bucket('bare')
+    my_bucket.write_file('hello.md', 'hello')
+
+    my_bucket.repo.git.is_bare.should.be.true
+    os.path.exists(os.path.join(my_bucket.repo.path, 'hello.md')).should.be.false
+    my_bucket.read_file('hello.md').should.equal('hello')
+
+
+@storage_scenario
+def test_convert_to_bare(context):
+    repository = GitRepository('legacy', settings.OLDSPEAK_DATADIR, bare=False)
+    my_bucket = Bucket('legacy')
+    my_bucket.repo = repository
+    my_bucket.write_file('docs/hello.md', 'hello')
+
+    os.path.exists(os.path.join(repository.path, 'docs', 'hello.md')).should.be.true
+    list(find_repositories(settings.OLDSPEAK_DATADIR)).should.equal([repository.path])
+
+    convert_to_bare(repository.path).should.be.true
+    convert_to_bare(repository.path).should.be.false
+
+    migrated = Bucket('legacy')
+    migrated.repo.git.is_bare.should.be.true
+    migrated.read_file('docs/hello.md').should.equal('hello')
+    migrated.list().should.equal(['docs/hello.md'])
+
+
+@storage_scenario
+def test_bucket_history(context):
+    my_bucket = Bucket('history')
+    my_bucket.write_file('a.md', 'a1', message='first')
+    my_bucket.write_file('docs/b.md', 'b1', message='second')
+    my_bucket.write_file('a.md', 'a2', message='third')
+    my_bucket.delete_files(['docs'], message='fourth')
+
+    page = my_bucket.history(limit=2)
+    [c['message'] for c in page].should.equal(['fourth', 'third'])
+
+    page = my_bucket.history(limit=2, cursor=page[-1]['oid'])
+    [c['message'] for c in page].should.equal(['second', 'first'])
+    page[0]['paths'].should.equal(['docs/b.md'])
+
+    [c['message'] for c in my_bucket.history(path='a.md')].should.equal(['third', 'first'])
+    [c['message'] for c in my_bucket.history(path='docs/b.md')].should.equal(['fourth', 'second'])
+    my_bucket.last_modified('a.md').oid.should.equal(my_bucket.history(limit=2)[1]['oid'])
+    my_bucket.last_modified('missing.md').should.be.none
+
+
+@storage_scenario
+def test_bucket_history_pages_through_merges(context):
+    my_bucket = Bucket('history-merges')
+    my_bucket.write_file('a.md', 'a1', message='first')
+    git = my_bucket.repo.git
+    base = git.head.target
+
+    writer = TreeWriter(git, git.get(base).tree.id)
+    writer.write_blob('side.md', 'side')
+    side = create_commit(git, writer.write(), message='side', reference_name='refs/heads/side', parents=[base])
+
+    my_bucket.write_file('b.md', 'b1', message='main')
+    writer = TreeWriter(git, git.head.get_object().tree.id)
+    writer.write_blob('side.md', 'side')
+    merge = create_commit(git, writer.write(), message='merge', parents=[git.head.target, side.id])
+
+    [c['message'] for c in my_bucket.history()][0].should.equal('merge')
+
+    messages = [c['message'] for c in my_bucket.history(cursor=merge.hex)]
+    sorted(messages).should.equal(['first', 'main', 'side'])
+    messages[-1].should.equal('first')
+
+    # every cursor continues right after its own commit, including
+    # the ones below the merge
+    oids = [c['oid'] for c in my_bucket.history()]
+    for index, oid in enumerate(oids):
+        [c['oid'] for c in my_bucket.history(cursor=oid)].should.equal(oids[index + 1:])
+
+    pages = [my_bucket.history(limit=1)]
+    while pages[-1]:
+        pages.append(my_bucket.history(limit=1, cursor=pages[-1][0]['oid']))
+
+    [page[0]['oid'] for page in pages[:-1]].should.equal(oids)
+
+    my_bucket.history.when.called_with(cursor='0' * 40).should.throw(InvalidCursor)
+    my_bucket.history.when.called_with(cursor='not-an-oid').should.throw(InvalidCursor)
+    my_bucket.history.when.called_with(cursor=git.head.get_object().tree.id.hex).should.throw(InvalidCursor)
+
+
+@storage_scenario
+def test_registry_shards_buckets(context):
+    registry = get_registry()
+    registry.location('fingerprint/9FF44C58').should.match(r'^fingerprint/[0-9a-f]{2}/[0-9a-f]{2}/9FF44C58$')
+    registry.location('my-bucket').should.match(r'^[0-9a-f]{2}/[0-9a-f]{2}/my-bucket$')
+    registry.name_from_location(registry.location('fingerprint/9FF44C58')).should.equal('fingerprint/9FF44C58')
+
+    system = System()
+    system.list().should.be.empty
+    system.repo.exists().should.be.false
+    list(registry.buckets()).should.be.empty
+
+    system.write_file('README.md', '# System')
+    Bucket('fingerprint/ABC').write_file('README.md', '# ABC')
+
+    system.repo.path.should.equal(os.path.join(registry.root_dir, registry.location(system.path)))
+    list(registry.buckets()).should.equal(['fingerprint/ABC', system.path])
+    list(registry.buckets('fingerprint')).should.equal(['fingerprint/ABC'])
+    registry.rebuild().should.equal(['fingerprint/ABC', system.path])
+
+
+@storage_scenario
+def test_registry_migrates_legacy_buckets(context):
+    legacy = Bucket('legacy')
+    legacy.repo = GitRepository('legacy', settings.OLDSPEAK_DATADIR)
+    legacy.write_file('hello.md', 'hello')
+
+    registry = get_registry()
+    registry.resolve('legacy').should.equal('legacy')
+    registry.rebuild(write=False).should.equal(['legacy'])
+    os.path.exists(registry.catalog_path).should.be.false
+    registry.rebuild().should.equal(['legacy'])
+    list(registry.buckets()).should.be.empty
+
+    registry.migrate('legacy').should.be.true
+    registry.resolve('legacy').should.equal(registry.location('legacy'))
+    list(registry.buckets()).should.equal(['legacy'])
+    Bucket('legacy').read_file('hello.md').should.equal('hello')
+
+
+@storage_scenario
+def test_export_and_import_bucket_incrementally(context):
+    source = Bucket('replication/source')
+    source.write_file('a.md', 'a' * 4096)
+    source.write_file('b.md', 'b' * 4096)
+
+    full = StringIO()
+    head = export_bucket(source, full)
+    full.seek(0)
+
+    replica = Bucket('replication/replica')
+    import_bucket(replica, full).should.equal(head)
+    replica.read_file('a.md').should.equal('a' * 4096)
+
+    source.write_file('c.md', 'c')
+    incremental = StringIO()
+    export_bucket(source, incremental, since=head).should.equal(source.repo.head.hex)
+    incremental.seek(0)
+
+    len(incremental.getvalue()).should.be.lower_than(len(full.getvalue()))
+    import_bucket(replica, incremental).should.equal(source.repo.head.hex)
+    replica.list().should.equal(['a.md', 'b.md', 'c.md'])
+    export_bucket(source, StringIO(), since=source.repo.head.hex).should.be.none
+
+
+@storage_scenario
+def test_import_bucket_only_fast_forwards(context):
+    source = Bucket('replication/origin')
+    source.write_file('a.md', 'a')
+    bundle = StringIO()
+    export_bucket(source, bundle)
+    bundle.seek(0)
+
+    replica = Bucket('replication/worktree')
+    replica.repo = GitRepository('replication/worktree', settings.OLDSPEAK_DATADIR, bare=False)
+    import_bucket(replica, bundle)
+    replica.list().should.equal(['a.md'])
+    os.path.exists(os.path.join(replica.repo.path, 'a.md')).should.be.true
+
+    replica.write_file('local.md', 'local')
+    head = replica.repo.head.hex
+    source.write_file('b.md', 'b')
+    bundle = StringIO()
+    export_bucket(source, bundle)
+    bundle.seek(0)
+
+    import_bucket.when.called_with(replica, bundle).should.throw(ReplicationError)
+    replica.repo.head.hex.should.equal(head)
+    replica.list().should.equal(['a.md', 'local.md'])
+
+
+@storage_scenario
+def test_shared_object_store_deduplicates_blobs(context):
+    settings.VFS_SHARED_OBJECTS = True
+    try:
+        first = Bucket('shared/first')
+        second = Bucket('shared/second')
+        first_blob = first.write_file('template.md', '# the same template')
+        second_blob = second.write_file('copy.md', '# the same template')
+
+        store = get_shared_store()
+        first_blob.id.should.equal(second_blob.id)
+        store.refcount(first_blob.id).should.equal(2)
+        os.path.exists(os.path.join(store.objects_dir, first_blob.hex[:2], first_blob.hex[2:])).should.be.true
+        os.path.exists(os.path.join(first.repo.git.path, 'objects', first_blob.hex[:2], first_blob.hex[2:])).should.be.false
+        second.read_file('copy.md').should.equal('# the same template')
+
+        store.release('shared/first')
+        store.collect(grace=0).should.equal(0)
+        store.release('shared/second')
+        store.collect(grace=0).should.equal(1)
+        store.refcount(first_blob.id).should.equal(0)
+    finally:
+        settings.VFS_SHARED_OBJECTS = False
+
+
+@storage_scenario
+def test_shared_object_store_sees_references_of_other_processes(context):
+    settings.VFS_SHARED_OBJECTS = True
+    try:
+        bucket = Bucket('shared/mine')
+        blob = bucket.write_file('template.md', '# shared template')
+        store = get_shared_store()
+        maintenance.stats().should.have.key(store.path)
+
+        # another process references the blob and this one releases it
+        with open(store.log_path, 'a') as fd:
+            fd.write('+ {} shared/theirs\n'.format(blob.hex))
+
+        store.release('shared/mine')
+        store.collect(grace=0).should.equal(0)
+        store.refcount(blob.id).should.equal(1)
+
+        store.pack().should.be.true
+        store.is_loose(blob.hex).should.be.false
+        bucket.read_file('template.md').should.equal('# shared template')
+    finally:
+        settings.VFS_SHARED_OBJECTS = False
+
+
+@storage_scenario
+def test_shared_blobs_are_referenced_before_the_commit(context):
+    settings.VFS_SHARED_OBJECTS = True
+    try:
+        bucket = Bucket('shared/failing')
+        with patch('oldspeak.persistence.vfs.commit_optimistically', side_effect=CommitConflict('failed')):
+            bucket.write_file.when.called_with('template.md', '# never committed').should.throw(CommitConflict)
+
+        bucket.list().should.be.empty
+        get_shared_store().refcount(pygit2.hash('# never committed')).should.equal(1)
+    finally:
+        settings.VFS_SHARED_OBJECTS = False
+
+
+@storage_scenario
+def test_bucket_write_stream_and_open(context):
+    my_bucket = Bucket('streams')
+    contents = ''.join('line {}\n'.format(index) for index in range(20000))
+
+    oid = my_bucket.write_stream('uploads/big.txt', StringIO(contents))
+
+    my_bucket.entries(prefix='uploads/')[0][1].size.should.equal(len(contents))
+    with my_bucket.open('uploads/big.txt') as stream:
+        chunks = list(stream)
+
+    ''.join(chunks).should.equal(contents)
+    chunks.should.have.length_of(len(contents) // stream.chunk_size + 1)
+    stream.size.should.equal(len(contents))
+    my_bucket.resolve(oid).size.should.equal(len(contents))
+
+    with my_bucket.open('uploads/big.txt') as stream:
+        stream.read(5).should.equal('line ')
+        stream.read(3).should.equal('0\nl')
+
+    Maintenance(threshold=1, min_interval=0, cooldown=0).repack(my_bucket.repo.git.path)
+    with my_bucket.open('uploads/big.txt') as stream:
+        stream.read().should.equal(contents)
+
+
+@storage_scenario
+def test_search_across_buckets(context):
+    first = Bucket('search/first')
+    second = Bucket('search/second')
+    first.write_files({
+        'todo.md': '- import public key\n- query white-listed fingerprints',
+        'data.json': '{"public": "key"}',
+    })
+    second.write_file('essays/keys.md', 'A public key is public')
+
+    [(r['bucket'], r['path']) for r in search('public key', [first, second])].should.equal([
+        ('search/second', 'essays/keys.md'),
+        ('search/first', 'todo.md'),
+    ])
+    [r['path'] for r in search('"white listed"', [first, second])].should.equal(['todo.md'])
+
+    first.write_file('todo.md', '- nothing left')
+    second.delete_files(['essays'])
+    search('public', [first, second]).should.be.empty
+    [r['path'] for r in search('nothing', [first])].should.equal(['todo.md'])
+
+
+@storage_scenario
+def test_commits_run_in_the_git_threads(context):
+    completed = git_threads.stats()['completed']
+    bucket = Bucket('threads/test')
+
+    gevent.joinall([
+        gevent.spawn(bucket.write_file, 'file-{}.txt'.format(number), 'data {}'.format(number))
+        for number in range(10)
+    ], raise_error=True)
+
+    bucket.list().should.have.length_of(10)
+    bucket.read_file('file-3.txt').should.equal('data 3')
+    git_threads.stats()['completed'].should.be.greater_than(completed)
+    git_threads.stats()['pending'].should.equal(0)
+
+
+def commit_from_another_process(bucket, files):
+    git = pygit2.Repository(bucket.repo.git.path)
+    writer = TreeWriter(git, git.head.get_object().tree.id)
+    for path, data in files.items():
+        writer.write_blob(path, data)
+
+    return create_commit(git, writer.write(), message='another process')
+
+
+@storage_scenario
+def test_commit_optimistically_merges_other_paths(context):
+    bucket = Bucket('optimistic/merge')
+    bucket.write_file('a.md', 'A')
+    base = bucket.repo.head
+
+    other = commit_from_another_process(bucket, {'b.md': 'B'})
+
+    writer = TreeWriter(bucket.repo.git, base.tree.id)
+    writer.write_blob('c.md', 'C')
+    commit = commit_optimistically(bucket.repo.git, writer, base.hex, message='stale parent')
+
+    [parent.hex for parent in commit.parent_ids].should.equal([other.hex])
+    bucket.repo.head.hex.should.equal(commit.hex)
+    bucket.list().should.equal(['a.md', 'b.md', 'c.md'])
+    bucket.read_file('b.md').should.equal('B')
+    bucket.read_file('c.md').should.equal('C')
+
+
+@storage_scenario
+def test_commit_optimistically_conflicts_on_the_same_path(context):
+    bucket = Bucket('optimistic/conflict')
+    bucket.write_file('a.md', 'A')
+    base = bucket.repo.head
+
+    other = commit_from_another_process(bucket, {'a.md': 'theirs'})
+
+    writer = TreeWriter(bucket.repo.git, base.tree.id)
+    writer.write_blob('a.md', 'ours')
+    commit_optimistically.when.called_with(
+        bucket.repo.git, writer, base.hex,
+    ).should.throw(CommitConflict, 'a.md were changed concurrently')
+
+    bucket.repo.head.hex.should.equal(other.hex)
+    bucket.read_file('a.md').should.equal('theirs')
+
+
+@storage_scenario
+def test_commits_hold_a_fenced_write_lease(context):
+    settings.VFS_WRITE_LEASES = True
+    settings.VFS_LEASE_BACKEND = 'local'
+    try:
+        bucket = Bucket('leases/test')
+        bucket.write_file('a.md', 'A')
+        bucket.write_file('b.md', 'B')
+
+        manager = get_lease_manager()
+        manager.held.should.be.empty
+        fence_path = os.path.join(bucket.repo.index_path, 'fence')
+        open(fence_path).read().strip().should.equal('2')
+
+        # another node took the lease over and wrote with a newer token
+        with open(fence_path, 'w') as fd:
+            fd.write('100\n')
+
+        bucket.write_file.when.called_with('c.md', 'C').should.throw(LeaseLost)
+        bucket.list().should.equal(['a.md', 'b.md'])
+    finally:
+        settings.VFS_WRITE_LEASES = False
+        settings.VFS_LEASE_BACKEND = 'redis'
+
+
+@storage_scenario
+def test_bucket_usage_and_quota(context):
+    bucket = Bucket('usage/first')
+    Bucket('usage/empty').usage()['files'].should.equal(0)
+
+    bucket.write_files({'a.md': 'A' * 10, 'docs/b.md': 'B' * 20})
+    bucket.write_file('a.md', 'A' * 5)
+    dict(bucket.usage()).should.equal({'bytes': 25, 'files': 2, 'objects': 8})
+
+    bucket.quota_bytes = 30
+    bucket.write_file('c.md', 'C' * 5)
+    bucket.write_file.when.called_with('d.md', 'D').should.throw(QuotaExceeded)
+    bucket.write_file('a.md', '')
+    bucket.list().should.equal(['a.md', 'c.md', 'docs/b.md'])
+
+    Bucket('usage/second').write_file('e.md', 'E' * 3)
+    dict(get_registry().total_usage('usage')).should.equal({
+        'buckets': 2,
+        'bytes': 28,
+        'files': 4,
+        'objects': 17,
+    })
+
+
+@storage_scenario
+def test_concurrent_writes_share_the_quota(context):
+    bucket = Bucket('usage/concurrent')
+    bucket.quota_bytes = 10
+
+    # each write fits alone, both together don't
+    jobs = [
+        gevent.spawn(bucket.write_file, 'first.md', 'A' * 6),
+        gevent.spawn(bucket.write_file, 'second.md', 'B' * 6),
+    ]
+    gevent.joinall(jobs)
+
+    jobs[0].successful().should.be.true
+    jobs[1].exception.should.be.a(QuotaExceeded)
+    bucket.list().should.equal(['first.md'])
+    bucket.usage()['bytes'].should.equal(6)
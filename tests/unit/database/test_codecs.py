@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from mock import Mock
+from mock import patch
+
+from oldspeak.persistence.sql.codecs import parse_datetime
+from oldspeak.persistence.sql.mapper import Manager
+from tests.unit.database.test_sql import DemoModelOne
+
+
+def test_parse_datetime_fast_path():
+    'parse_datetime() parses isoformat() output without dateutil'
+    parse_datetime('2017-01-06T21:34:10.123').should.equal(datetime(2017, 1, 6, 21, 34, 10, 123000))
+    parse_datetime('2017-01-06 21:34').should.equal(datetime(2017, 1, 6, 21, 34))
+    parse_datetime('2017-01-06').should.equal(datetime(2017, 1, 6))
+    parse_datetime('Jan 6 2017').should.equal(datetime(2017, 1, 6))
+
+
+def test_model_encodes_and_decodes_with_compiled_codecs():
+    'Model decodes datetimes on the way in and serializes them on the way out'
+    model = DemoModelOne(field_string_100=10, field_datetime_nullable='2017-01-06T21:34:10')
+
+    model.get('field_datetime_nullable').should.equal(datetime(2017, 1, 6, 21, 34, 10))
+    model.field_datetime_nullable.should.equal('2017-01-06T21:34:10')
+    model.field_string_100.should.equal('10')
+    model.serialize().should.equal({
+        'id': None,
+        'field_string_100': '10',
+        'field_text': None,
+        'field_datetime_nullable': '2017-01-06T21:34:10',
+    })
+
+
+def test_from_result_proxy_hydrates_rows():
+    'Manager.many_from_result_proxy() builds models straight from the rows'
+    proxy = Mock(name='proxy')
+    proxy.keys.return_value = ['id', 'field_string_100', 'field_text', 'field_datetime_nullable']
+    proxy.fetchall.return_value = [
+        (1, 'one', 'text', '2017-01-06 21:34:10'),
+        (2, 'two', 'text', None),
+    ]
+    manager = Manager(DemoModelOne, 'test')
+
+    with patch.object(Manager, 'engine', None):
+        first, second = manager.many_from_result_proxy(proxy)
+
+    first.should.be.a(DemoModelOne)
+    first.id.should.equal(1)
+    first.get('field_datetime_nullable').should.equal(datetime(2017, 1, 6, 21, 34, 10))
+    second.field_string_100.should.equal('two')
+    second.get('field_datetime_nullable').should.be.none
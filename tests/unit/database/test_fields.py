@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from mock import Mock
+import sqlalchemy as db
+
+from oldspeak.persistence.sql.fields import ColumnDescriptor
+from oldspeak.persistence.sql.mapper import Manager
+from oldspeak.persistence.sql.mapper import Model
+from oldspeak.persistence.sql.mapper import PrimaryKey
+from oldspeak.persistence.sql.mapper import metadata
+from tests.unit.database.test_sql import DemoModelOne
+
+
+class CompactModel(Model):
+    __slots__ = ('cached', )
+
+    table = db.Table(
+        'demo_compact', metadata,
+        PrimaryKey(),
+        db.Column('field_string_100', db.String(100), nullable=False),
+        db.Column('field_datetime_nullable', db.DateTime, nullable=True),
+    )
+
+
+def test_columns_are_descriptors():
+    'the orm metaclass turns every column into a data descriptor'
+    DemoModelOne.field_string_100.should.be.a(ColumnDescriptor)
+
+    model = CompactModel(field_string_100='one')
+    model.field_datetime_nullable = '2017-01-06T21:34:10'
+
+    model.get('field_datetime_nullable').should.equal(datetime(2017, 1, 6, 21, 34, 10))
+    model.field_datetime_nullable.should.equal('2017-01-06T21:34:10')
+    hasattr(model, '__dict__').should.be.false
+
+
+def test_models_without_slots_keep_other_attributes():
+    'models that do not declare __slots__ still hold any attribute'
+    model = DemoModelOne(field_string_100='one')
+    model.cached = 'value'
+
+    model.cached.should.equal('value')
+    model.__dict__.should.equal({'cached': 'value'})
+    model.__data__.shouldnt.have.key('cached')
+
+
+def test_models_with_slots_only_hold_declared_attributes():
+    'models that declare __slots__ hold the other attributes in them'
+    model = CompactModel(field_string_100='one')
+    model.cached = 'value'
+
+    model.cached.should.equal('value')
+    model.__data__.shouldnt.have.key('cached')
+    model.__setattr__.when.called_with('other', 'value').should.throw(AttributeError)
+
+
+def test_rows_are_read_only():
+    'Manager.rows_from_result_proxy() builds compact read-only rows'
+    proxy = Mock(name='proxy')
+    proxy.keys.return_value = ['id', 'field_string_100', 'field_datetime_nullable']
+    proxy.fetchall.return_value = [
+        (1, 'one', datetime(2017, 1, 6, 21, 34, 10)),
+    ]
+    manager = Manager(DemoModelOne, 'test')
+
+    row, = manager.rows_from_result_proxy(proxy)
+
+    row.should.be.a(DemoModelOne.Row)
+    row.id.should.equal(1)
+    row.field_datetime_nullable.should.equal('2017-01-06T21:34:10')
+    row.field_text.should.be.none
+    hasattr(row, '__dict__').should.be.false
+    row.to_dict().should.equal({
+        'id': 1,
+        'field_string_100': 'one',
+        'field_text': None,
+        'field_datetime_nullable': '2017-01-06T21:34:10',
+    })
+    row.__setattr__.when.called_with('field_text', 'text').should.throw(AttributeError)
+
+
+def test_row_to_model():
+    'Row.to_model() returns a model that can be changed and saved'
+    proxy = Mock(name='proxy')
+    proxy.keys.return_value = ['id', 'field_string_100']
+    proxy.fetchall.return_value = [(1, 'one')]
+    manager = Manager(DemoModelOne, 'test')
+
+    row, = manager.rows_from_result_proxy(proxy)
+    model = row.to_model()
+
+    model.should.be.a(DemoModelOne)
+    model.id.should.equal(1)
+    model.field_string_100.should.equal('one')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gevent
+from mock import Mock
+
+from oldspeak.persistence.sql.session import connection
+from oldspeak.persistence.sql.session import get_session
+from oldspeak.persistence.sql.session import session_scope
+
+
+def make_engine():
+    engine = Mock(name='engine')
+    engine.connect.side_effect = lambda: Mock(name='connection', closed=False)
+    return engine
+
+
+def test_session_scope_reuses_one_connection():
+    'session_scope() checks out one connection per engine and closes it on exit'
+    engine = make_engine()
+
+    with session_scope() as session:
+        with connection(engine) as first:
+            pass
+
+        with session_scope():
+            with connection(engine) as second:
+                pass
+
+        second.should.be(first)
+        first.close.called.should.be.false
+
+    engine.connect.call_count.should.equal(1)
+    first.close.assert_called_once_with()
+    get_session().should.be.none
+
+
+def test_connection_without_a_session_is_closed_right_away():
+    'connection() closes its own connection when there is no session'
+    engine = make_engine()
+
+    with connection(engine) as conn:
+        pass
+
+    conn.close.assert_called_once_with()
+
+
+def test_sessions_are_bound_to_greenlets():
+    'session_scope() gives every greenlet its own connections'
+    engine = make_engine()
+
+    def work():
+        with session_scope():
+            with connection(engine) as conn:
+                gevent.sleep(0)
+                return conn
+
+    greenlets = [gevent.spawn(work), gevent.spawn(work)]
+    gevent.joinall(greenlets, raise_error=True)
+    first, second = [greenlet.value for greenlet in greenlets]
+    first.should_not.be(second)
+    engine.connect.call_count.should.equal(2)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from mock import Mock
+from mock import MagicMock
+from mock import patch
+
+from oldspeak.persistence.sql.mapper import Manager
+from oldspeak.persistence.sql.mapper import InvalidColumnName
+from tests.unit.database.test_sql import DemoModelOne
+
+
+def test_statements_are_cached_by_shape():
+    'Manager.get_statement() reuses the select of a query shape and only binds new values'
+    manager = Manager(DemoModelOne, 'test')
+
+    first, first_params = manager.get_statement(field_string_100='one')
+    second, second_params = manager.get_statement(field_string_100='two')
+
+    second.should.be(first)
+    first_params.should.equal({'field_string_100': 'one'})
+    second_params.should.equal({'field_string_100': 'two'})
+
+
+def test_statement_shape_includes_modifiers_and_paging():
+    'modifiers, comparisons to None, order and paging make different shapes'
+    manager = Manager(DemoModelOne, 'test')
+
+    plain, _ = manager.get_statement(field_string_100='one')
+    null, params = manager.get_statement(field_string_100=None)
+    prefix, prefix_params = manager.get_statement(field_string_100__startswith='on')
+    paged, paged_params = manager.get_statement(field_string_100='one', limit_by=10, offset_by=20.0)
+    ordered, _ = manager.get_statement(field_string_100='one', order_by='+field_text')
+
+    len(set(map(id, [plain, null, prefix, paged, ordered]))).should.equal(5)
+    params.should.be.empty
+    prefix_params.should.equal({'field_string_100__startswith': 'on%'})
+    paged_params.should.equal({'field_string_100': 'one', 'limit_by': 10, 'offset_by': 20})
+
+
+def test_invalid_fields_are_not_cached():
+    'Manager.get_statement() raises for unknown fields every time'
+    manager = Manager(DemoModelOne, 'test')
+
+    manager.get_statement.when.called_with(unknown='one').should.throw(InvalidColumnName)
+    manager.get_statement.when.called_with(unknown='one').should.throw(InvalidColumnName)
+
+
+def make_connection(returning):
+    conn = Mock(name='connection')
+    conn.dialect.implicit_returning = returning
+    conn.dialect.supports_multivalues_insert = True
+    conn.execute.return_value.fetchall.return_value = [(1, ), (2, )]
+    conn.execute.return_value.inserted_primary_key = [3]
+    return conn
+
+
+def bulk_create_ids(conn):
+    manager = Manager(DemoModelOne, 'test')
+    rows = [
+        {'field_string_100': 'one', 'field_text': 'text'},
+        {'field_string_100': 'two', 'field_text': 'text'},
+    ]
+    with patch.object(Manager, 'transaction', return_value=MagicMock(__enter__=Mock(return_value=conn))):
+        return manager.bulk_create(rows, return_ids=True)
+
+
+def test_bulk_create_returns_ids_of_multi_row_inserts():
+    'Manager.bulk_create() collects the ids with one INSERT ... RETURNING where supported'
+    conn = make_connection(returning=True)
+
+    bulk_create_ids(conn).should.equal([1, 2])
+    conn.execute.call_count.should.equal(1)
+
+
+def test_bulk_create_returns_ids_one_row_at_a_time_elsewhere():
+    'Manager.bulk_create() falls back to an insert per row without RETURNING'
+    conn = make_connection(returning=False)
+
+    bulk_create_ids(conn).should.equal([3, 3])
+    conn.execute.call_count.should.equal(2)
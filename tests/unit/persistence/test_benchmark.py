@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from oldspeak.persistence.benchmark import percentile
+from oldspeak.persistence.benchmark import generate_paths
+from oldspeak.persistence.benchmark import compare
+
+
+def test_percentile():
+    'percentile() returns the nearest rank'
+    values = range(1, 101)
+    percentile(values, 0.5).should.equal(51)
+    percentile(values, 0.99).should.equal(99)
+    percentile([], 0.5).should.be.none
+
+
+def test_generate_paths():
+    'generate_paths() is deterministic and nests the files'
+    paths = generate_paths(100, 3)
+    paths.should.equal(generate_paths(100, 3))
+    set(paths).should.have.length_of(100)
+    set(path.count('/') for path in paths).should.equal({2})
+
+
+def report(ops_per_second, p99):
+    return {'scenarios': {'1000x3': {'operations': {'write_file': {
+        'ops_per_second': ops_per_second,
+        'p99': p99,
+    }}}}}
+
+
+def test_compare_with_baseline():
+    'compare() lists the operations that regressed beyond the tolerance'
+    baseline = report(100.0, 0.010)
+
+    compare(report(90.0, 0.011), baseline, tolerance=0.2).should.be.empty
+    compare(report(50.0, 0.011), baseline, tolerance=0.2).should.equal([
+        '1000x3 write_file: 50.0 ops/s, was 100.0',
+    ])
+    compare(report(100.0, 0.020), baseline, tolerance=0.2).should.equal([
+        '1000x3 write_file: p99 20.00ms, was 10.00ms',
+    ])
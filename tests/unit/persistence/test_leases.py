@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+
+import gevent
+
+from oldspeak.persistence.leases import LeaseManager
+from oldspeak.persistence.leases import LeaseLost
+from oldspeak.persistence.leases import LeaseUnavailable
+from oldspeak.persistence.leases import LocalLeaseBackend
+from oldspeak.persistence.leases import write_fence
+
+
+def test_local_backend_hands_out_increasing_tokens():
+    'LocalLeaseBackend only lets one owner hold a lease at a time'
+    backend = LocalLeaseBackend()
+
+    backend.acquire('bucket', 'node-1', 10).should.equal(1)
+    backend.acquire('bucket', 'node-2', 10).should.be.none
+    backend.release('bucket', 'node-2', 1).should.be.false
+    backend.release('bucket', 'node-1', 1).should.be.true
+    backend.acquire('bucket', 'node-2', 10).should.equal(2)
+
+
+def test_local_backend_leases_expire():
+    'LocalLeaseBackend drops leases that were not renewed in time'
+    backend = LocalLeaseBackend()
+    backend.acquire('bucket', 'node-1', 0.01).should.equal(1)
+    gevent.sleep(0.02)
+
+    backend.renew('bucket', 'node-1', 1, 10).should.be.false
+    backend.acquire('bucket', 'node-2', 10).should.equal(2)
+
+
+def test_lease_manager_waits_for_the_holder():
+    'LeaseManager.acquire() gives up after waiting for another node'
+    backend = LocalLeaseBackend()
+    first = LeaseManager(backend, owner='node-1', ttl=10)
+    second = LeaseManager(backend, owner='node-2', ttl=10, wait=0.05, retry_interval=0.01)
+
+    lease = first.acquire('bucket')
+    second.acquire.when.called_with('bucket').should.throw(LeaseUnavailable)
+
+    lease.release()
+    second.acquire('bucket').token.should.equal(2)
+
+
+def test_lease_manager_renews_leases():
+    'LeaseManager keeps the leases alive while they are held'
+    manager = LeaseManager(LocalLeaseBackend(), owner='node-1', ttl=0.06)
+    with manager.hold('bucket') as lease:
+        gevent.sleep(0.15)
+        lease.valid.should.be.true
+
+        with manager.hold('bucket') as nested:
+            nested.should.be(lease)
+
+        lease.valid.should.be.true
+
+    lease.valid.should.be.false
+    manager.held.should.be.empty
+
+
+def test_write_fence_refuses_older_tokens():
+    'write_fence() stops writers with an older token'
+    folder = tempfile.mkdtemp()
+    try:
+        write_fence(folder, 1)
+        write_fence(folder, 3)
+        write_fence.when.called_with(folder, 2).should.throw(LeaseLost)
+        write_fence(folder, 3)
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+
+from oldspeak.persistence.maintenance import Maintenance
+
+
+def test_failed_repacks_unschedule_the_repository():
+    'Maintenance.repack() unschedules the repository even when git fails to run'
+    maintenance = Maintenance(threshold=1, min_interval=0, cooldown=0)
+    stats = maintenance.get_stats('/missing/a.git')
+    stats.scheduled = True
+
+    with patch('oldspeak.persistence.maintenance.subprocess.Popen', side_effect=OSError('no git')):
+        maintenance.repack.when.called_with('/missing/a.git').should.throw(OSError)
+
+    stats.scheduled.should.be.false
+
+
+def test_run_pending_goes_on_after_a_failure():
+    'Maintenance.run_pending() logs a failed repack and moves on to the next repository'
+    maintenance = Maintenance(threshold=1, min_interval=0, cooldown=0)
+    for git_dir in ('/missing/a.git', '/missing/b.git'):
+        maintenance.get_stats(git_dir).scheduled = True
+        maintenance.queue.append(git_dir)
+
+    with patch('oldspeak.persistence.maintenance.subprocess.Popen', side_effect=OSError('no git')):
+        maintenance.run_pending().should.equal(2)
+
+    maintenance.queue.should.be.empty
+    maintenance.stats('/missing/b.git')['scheduled'].should.be.false
+
+
+def test_forget_drops_the_stats_of_closed_repositories():
+    'Maintenance.forget() drops the stats and the pending repack of a repository'
+    maintenance = Maintenance()
+    maintenance.get_stats('/missing/a.git')
+    maintenance.queue.append('/missing/a.git')
+
+    maintenance.forget('/missing/a.git')
+
+    maintenance.stats().should.be.empty
+    maintenance.next_repository().should.be.none
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+import gevent
+
+from oldspeak.persistence.offload import GitThreadPool
+
+
+def test_run_returns_the_result_from_a_thread():
+    'GitThreadPool.run() calls the function in another thread'
+    pool = GitThreadPool(size=2)
+    main_thread = threading.current_thread().ident
+
+    pool.run('bucket', lambda: threading.current_thread().ident).should_not.equal(main_thread)
+    pool.stats()['completed'].should.equal(1)
+    pool.close()
+
+
+def test_run_inline_without_threads():
+    'GitThreadPool.run() calls the function right away when size is 0'
+    pool = GitThreadPool(size=0)
+    main_thread = threading.current_thread().ident
+
+    pool.run('bucket', lambda: threading.current_thread().ident).should.equal(main_thread)
+
+
+def test_run_preserves_the_order_per_key():
+    'GitThreadPool.run() runs the calls with the same key one at a time in order'
+    pool = GitThreadPool(size=4)
+    calls = []
+
+    def work(number):
+        calls.append(('start', number))
+        time.sleep(0.01)
+        calls.append(('end', number))
+
+    gevent.joinall([gevent.spawn(pool.run, 'bucket', work, number) for number in range(3)], raise_error=True)
+
+    calls.should.equal([
+        ('start', 0), ('end', 0),
+        ('start', 1), ('end', 1),
+        ('start', 2), ('end', 2),
+    ])
+    pool.keys.should.be.empty
+    pool.close()
+
+
+def test_run_does_not_block_the_hub():
+    'GitThreadPool.run() lets other greenlets run while the call blocks'
+    pool = GitThreadPool(size=1)
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            ticks.append(time.time())
+            gevent.sleep(0.01)
+
+    ticker = gevent.spawn(tick)
+    pool.run('bucket', time.sleep, 0.1)
+    ticker.join()
+
+    ticks.should.have.length_of(5)
+    (ticks[-1] - ticks[0]).should.be.lower_than(0.1)
+    pool.close()
+
+
+def test_run_propagates_errors():
+    'GitThreadPool.run() raises the error of the call in the greenlet'
+    pool = GitThreadPool(size=1)
+
+    def fail():
+        raise ValueError('boom')
+
+    pool.run.when.called_with('bucket', fail).should.throw(ValueError, 'boom')
+    stats = pool.stats()
+    stats['failed'].should.equal(1)
+    stats['pending'].should.equal(0)
+    pool.close()
+
+
+def test_interrupted_calls_leave_no_trace():
+    'GitThreadPool.run() forgets a call interrupted while it waits for its key'
+    pool = GitThreadPool(size=1)
+    first = gevent.spawn(pool.run, 'bucket', time.sleep, 0.1)
+    gevent.sleep(0)
+
+    with gevent.Timeout(0.01, False):
+        pool.run('bucket', time.sleep, 0)
+
+    first.join()
+    stats = pool.stats()
+    stats['pending'].should.equal(0)
+    stats['running'].should.equal(0)
+    stats['completed'].should.equal(1)
+    pool.keys.should.be.empty
+    pool.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+
+from mock import Mock
+from mock import patch
+
+from oldspeak.persistence.search import Segment
+from oldspeak.persistence.search import SearchIndex
+from oldspeak.persistence.search import tokenize
+from oldspeak.persistence.search import parse_query
+
+
+def test_tokenize():
+    'tokenize() lowercases words and drops punctuation'
+    tokenize('# OldSpeak TO-DO list\n- import public key').should.equal([
+        'oldspeak', 'to', 'do', 'list', 'import', 'public', 'key',
+    ])
+
+
+def test_parse_query():
+    'parse_query() splits terms and quoted phrases'
+    parse_query('Todo "public KEY" ').should.equal([['todo'], ['public', 'key']])
+
+
+def make_index(*segments):
+    index = SearchIndex('/dev/null')
+    for name, docs, deleted in segments:
+        segment = Segment(name)
+        for path, text in docs:
+            segment.add(path, '0' * 40, text)
+
+        for path in deleted:
+            segment.delete(path)
+
+        index.append(segment)
+
+    return index
+
+
+def test_search_index_terms_and_phrases():
+    'SearchIndex.search() matches every term and phrase'
+    index = make_index(('s1', [
+        ('a.md', 'import the public key'),
+        ('b.md', 'the key is public'),
+    ], []))
+
+    index.search('public key').should.equal({'a.md': 2, 'b.md': 2})
+    index.search('"public key"').should.equal({'a.md': 1})
+    index.search('"key public"').should.equal({})
+    index.search('missing').should.equal({})
+
+
+def test_search_index_newest_segment_wins():
+    'SearchIndex ignores documents replaced or deleted by newer segments'
+    index = make_index(
+        ('s1', [('a.md', 'old text'), ('b.md', 'old text')], []),
+        ('s2', [('a.md', 'new text')], ['b.md']),
+    )
+
+    index.search('old').should.equal({})
+    index.search('text').should.equal({'a.md': 1})
+    index.should.have.length_of(1)
+
+
+def make_repository(commits, head):
+    """a stand-in repository whose commits are dicts of path -> text"""
+    repository = Mock(name='repository')
+
+    def get_commit(oid):
+        return Mock(tree=Mock(id=oid))
+
+    repository.head = get_commit(head)
+    repository.head.hex = head
+    repository.get_commit.side_effect = get_commit
+    repository.blob_size.side_effect = lambda oid: len(oid[1])
+    repository.read_blob.side_effect = lambda oid: oid[1]
+    checkout = repository.checkout.return_value
+    checkout.__enter__ = Mock(return_value=Mock(name='git', path='/tmp/demo.git'))
+    checkout.__exit__ = Mock(return_value=False)
+
+    def diff_trees(git, old, new):
+        before, after = commits.get(old, {}), commits[new]
+        for path in sorted(set(before) | set(after)):
+            if before.get(path) != after.get(path):
+                text = after.get(path)
+                yield path, None if text is None else Mock(id=(path, text), hex='0' * 40)
+
+    return repository, diff_trees
+
+
+def test_search_index_processes_share_the_folder():
+    'SearchIndex.sync() merges the manifest written by another process'
+    commits = {
+        'c1': {'a.md': 'first note'},
+        'c2': {'a.md': 'first note', 'b.md': 'second note'},
+    }
+    folder = tempfile.mkdtemp(prefix='oldspeak-test-')
+    try:
+        first, second = SearchIndex(folder), SearchIndex(folder)
+
+        repository, diff_trees = make_repository(commits, 'c1')
+        with patch('oldspeak.persistence.search.vfs.diff_trees', diff_trees):
+            first.sync(repository)
+
+        repository, diff_trees = make_repository(commits, 'c2')
+        with patch('oldspeak.persistence.search.vfs.diff_trees', diff_trees):
+            second.sync(repository)
+
+        [segment.name for segment in second.segments[:1]].should.equal(
+            [segment.name for segment in first.segments])
+        second.search('note').should.equal({'a.md': 1, 'b.md': 1})
+        SearchIndex(folder).load().search('note').should.equal({'a.md': 1, 'b.md': 1})
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import shutil
+import tempfile
+import subprocess
+
+from oldspeak.persistence.streams import LooseBlobStream
+from oldspeak.persistence.streams import ObjectHeaderReader
+
+
+def write_loose_object(data):
+    fd, path = tempfile.mkstemp(prefix='oldspeak-test-')
+    with os.fdopen(fd, 'wb') as loose:
+        loose.write(zlib.compress('blob {}\0{}'.format(len(data), data)))
+
+    return path
+
+
+def test_loose_blob_stream_inflates_a_chunk_at_a_time():
+    'LooseBlobStream never inflates much more than what was read'
+    data = 'a' * (1024 * 1024)
+    path = write_loose_object(data)
+    try:
+        with LooseBlobStream(path, chunk_size=1024) as stream:
+            stream.size.should.equal(len(data))
+            stream.read(10).should.equal('a' * 10)
+            len(stream.buffer).should.be.lower_than(2048)
+
+            chunks = list(stream)
+    finally:
+        os.remove(path)
+
+    ''.join(chunks).should.equal(data[10:])
+    max(map(len, chunks)).should.equal(1024)
+
+
+def test_loose_blob_stream_read_all():
+    'LooseBlobStream.read() without a size returns the rest of the blob'
+    path = write_loose_object('hello world')
+    try:
+        with LooseBlobStream(path) as stream:
+            stream.read(6).should.equal('hello ')
+            stream.read().should.equal('world')
+            stream.read().should.equal('')
+    finally:
+        os.remove(path)
+
+
+def git(git_dir, *args, **kw):
+    process = subprocess.Popen(['git', '--git-dir', git_dir] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process.communicate(kw.get('input'))[0].strip()
+
+
+def test_object_header_reader_reads_packed_objects():
+    'ObjectHeaderReader reads the type and size of packed objects'
+    git_dir = tempfile.mkdtemp(prefix='oldspeak-test-')
+    reader = ObjectHeaderReader(max_processes=1)
+    try:
+        git(git_dir, 'init', '-q', '--bare')
+        hexsha = git(git_dir, 'hash-object', '-w', '--stdin', input='packed contents')
+        git(git_dir, 'pack-objects', '-q', os.path.join(git_dir, 'objects', 'pack', 'pack'), input=hexsha + '\n')
+        git(git_dir, 'prune-packed')
+
+        os.path.exists(os.path.join(git_dir, 'objects', hexsha[:2], hexsha[2:])).should.be.false
+        reader.read(git_dir, hexsha).should.equal(('blob', len('packed contents')))
+        reader.read(git_dir, '0' * 40).should.be.none
+        reader.processes.should.have.length_of(1)
+    finally:
+        reader.clear()
+        shutil.rmtree(git_dir)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from oldspeak.persistence.vfs import BlobCache
+
+
+def test_blob_cache_loads_once():
+    'BlobCache.get() only calls the loader on a miss'
+    cache = BlobCache(max_bytes=100)
+    calls = []
+
+    def load():
+        calls.append(1)
+        return 'hello'
+
+    cache.get('a' * 40, load).should.equal('hello')
+    cache.get('a' * 40, load).should.equal('hello')
+
+    calls.should.have.length_of(1)
+    cache.hits.should.equal(1)
+    cache.misses.should.equal(1)
+    cache.size.should.equal(5)
+
+
+def test_blob_cache_respects_byte_budget():
+    'BlobCache evicts the least recently used blobs beyond max_bytes'
+    cache = BlobCache(max_bytes=10, max_entry_size=10)
+
+    cache.put('a', '1234')
+    cache.put('b', '1234')
+    cache.get('a', lambda: None)
+    cache.put('c', '1234')
+
+    ('a' in cache).should.be.true
+    ('c' in cache).should.be.true
+    ('b' in cache).should.be.false
+    cache.size.should.equal(8)
+    cache.evictions.should.equal(1)
+
+
+def test_blob_cache_skips_big_blobs():
+    'BlobCache does not keep blobs bigger than max_entry_size'
+    cache = BlobCache(max_bytes=100, max_entry_size=4)
+
+    cache.get('big', lambda: '12345').should.equal('12345')
+
+    cache.should.have.length_of(0)
+    cache.size.should.equal(0)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+from oldspeak.persistence.vfs import IndexEntry
+from oldspeak.persistence.vfs import find_conflicts
+
+
+TreeEntry = namedtuple('TreeEntry', ['hex', 'filemode'])
+
+
+def ours(oid):
+    return IndexEntry(oid * 40, None, 0o100644)
+
+
+def theirs(oid):
+    return TreeEntry(oid * 40, 0o100644)
+
+
+def test_find_conflicts_of_different_paths():
+    'find_conflicts() ignores changes to different paths'
+    find_conflicts(
+        {'a.md': ours('1'), 'docs/b.md': None},
+        {'c.md': theirs('2'), 'docs/c.md': theirs('3')},
+    ).should.be.empty
+
+
+def test_find_conflicts_of_the_same_path():
+    'find_conflicts() only reports same-path changes that differ'
+    find_conflicts({'a.md': ours('1')}, {'a.md': theirs('2')}).should.equal(['a.md'])
+    find_conflicts({'a.md': ours('1')}, {'a.md': None}).should.equal(['a.md'])
+    find_conflicts({'a.md': ours('1')}, {'a.md': theirs('1')}).should.be.empty
+    find_conflicts({'a.md': None}, {'a.md': None}).should.be.empty
+
+
+def test_find_conflicts_between_files_and_folders():
+    'find_conflicts() reports files that clash with folders'
+    find_conflicts({'docs': None}, {'docs/a.md': theirs('1')}).should.equal(['docs', 'docs/a.md'])
+    find_conflicts({'docs': None}, {'docs/a.md': None}).should.be.empty
+    find_conflicts({'docs/a.md': ours('1')}, {'docs': theirs('2')}).should.equal(['docs', 'docs/a.md'])
+    find_conflicts({'docs': ours('1')}, {'docs/a.md': theirs('2')}).should.equal(['docs', 'docs/a.md'])
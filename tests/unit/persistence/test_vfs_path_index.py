@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from oldspeak.persistence.vfs import PathIndex
+from oldspeak.persistence.vfs import IndexEntry
+
+
+def make_entry(size):
+    return IndexEntry('0' * 40, size, 0o100644)
+
+
+def test_path_index_scan_with_prefix_cursor_and_limit():
+    'PathIndex.scan() pages through the paths that match a prefix'
+    index = PathIndex('/dev/null')
+    index.apply([
+        ('b/2.md', make_entry(2)),
+        ('a.md', make_entry(1)),
+        ('b/1.md', make_entry(1)),
+        ('b/3.md', make_entry(3)),
+        ('c.md', make_entry(1)),
+    ])
+
+    [p for p, e in index.scan()].should.equal(['a.md', 'b/1.md', 'b/2.md', 'b/3.md', 'c.md'])
+    [p for p, e in index.scan(prefix='b/', limit=2)].should.equal(['b/1.md', 'b/2.md'])
+    [p for p, e in index.scan(prefix='b/', cursor='b/2.md')].should.equal(['b/3.md'])
+
+
+def test_path_index_replaces_folders_and_files():
+    'PathIndex.put() drops folders replaced by files and vice-versa'
+    index = PathIndex('/dev/null')
+    index.apply([
+        ('docs/one.md', make_entry(1)),
+        ('docs/two.md', make_entry(1)),
+        ('docs.md', make_entry(1)),
+    ])
+
+    index.put('docs', make_entry(4))
+    index.paths.should.equal(['docs', 'docs.md'])
+
+    index.put('docs.md/nested.md', make_entry(1))
+    index.paths.should.equal(['docs', 'docs.md/nested.md'])
+
+    index.discard('docs.md')
+    index.paths.should.equal(['docs'])
+
+
+def test_path_index_persists_snapshot_and_log():
+    'PathIndex.load() replays the log on top of the snapshot'
+    folder = tempfile.mkdtemp()
+    try:
+        index = PathIndex(folder)
+        index.update(None, 'c1', [('a.md', make_entry(1))])
+        index.save()
+        index.update('c1', 'c2', [('b.md', make_entry(2)), ('a.md', None)])
+        index.update('stale', 'c3', [('c.md', make_entry(3))])
+
+        loaded = PathIndex(folder).load()
+
+        loaded.commit.should.equal('c2')
+        loaded.paths.should.equal(['b.md'])
+        loaded.get('b.md').size.should.equal(2)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_path_index_keeps_running_totals():
+    'PathIndex.usage() follows puts, replacements and folder removals'
+    folder = tempfile.mkdtemp()
+    try:
+        index = PathIndex(folder)
+        index.update(None, 'c1', [
+            ('docs/one.md', make_entry(10)),
+            ('docs/two.md', make_entry(20)),
+            ('a.md', make_entry(5)),
+        ], objects=6)
+        index.update('c1', 'c2', [('a.md', make_entry(7)), ('docs', None)], objects=3)
+
+        dict(index.usage()).should.equal({'bytes': 7, 'files': 1, 'objects': 9})
+        dict(PathIndex(folder).load().usage()).should.equal({'bytes': 7, 'files': 1, 'objects': 9})
+        os.path.exists(index.usage_path).should.be.true
+    finally:
+        shutil.rmtree(folder)
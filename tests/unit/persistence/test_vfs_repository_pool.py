@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from oldspeak.persistence.vfs import RepositoryPool
+
+
+class FakeRepository(object):
+    def __init__(self, path):
+        self.path = path
+        self.freed = False
+
+    def free(self):
+        self.freed = True
+
+
+def test_repository_pool_reuses_handles():
+    'RepositoryPool.get() opens a repository only once'
+    pool = RepositoryPool(max_size=2)
+    opened = []
+
+    def opener(path):
+        def open_repository():
+            opened.append(path)
+            return FakeRepository(path)
+        return open_repository
+
+    first = pool.get('/data/a', opener('/data/a'))
+    second = pool.get('/data/a', opener('/data/a'))
+
+    second.should.be(first)
+    opened.should.equal(['/data/a'])
+    pool.stats().should.equal({
+        'open': 1,
+        'max_size': 2,
+        'hits': 1,
+        'misses': 1,
+        'evictions': 0,
+    })
+
+
+def test_repository_pool_evicts_least_recently_used():
+    'RepositoryPool.get() closes the least recently used handle'
+    pool = RepositoryPool(max_size=2)
+
+    a = pool.get('a', lambda: FakeRepository('a'))
+    b = pool.get('b', lambda: FakeRepository('b'))
+    pool.get('a', lambda: FakeRepository('a'))
+    pool.get('c', lambda: FakeRepository('c'))
+
+    pool.should.have.length_of(2)
+    ('a' in pool).should.be.true
+    ('c' in pool).should.be.true
+    b.freed.should.be.true
+    a.freed.should.be.false
+    pool.evictions.should.equal(1)
+
+
+def test_repository_pool_resize():
+    'RepositoryPool.resize() closes handles above the new limit'
+    pool = RepositoryPool(max_size=3)
+    handles = [pool.get(name, lambda: FakeRepository(name)) for name in 'abc']
+
+    pool.resize(1)
+
+    [h.freed for h in handles].should.equal([True, True, False])
+    pool.clear()
+    pool.should.have.length_of(0)
+
+
+def test_repository_pool_keeps_checked_out_handles():
+    'RepositoryPool.get() never evicts a checked out handle'
+    pool = RepositoryPool(max_size=1)
+
+    with pool.checkout('a', lambda: FakeRepository('a')) as a:
+        b = pool.get('b', lambda: FakeRepository('b'))
+        pool.should.have.length_of(2)
+        pool.get('a', lambda: FakeRepository('a')).should.be(a)
+
+    pool.get('c', lambda: FakeRepository('c'))
+    pool.should.have.length_of(1)
+    [a.freed, b.freed].should.equal([True, True])
+
+
+def test_repository_pool_defers_freeing_checked_out_handles():
+    'RepositoryPool.close() frees a checked out handle once it is released'
+    pool = RepositoryPool(max_size=2)
+
+    with pool.checkout('a', lambda: FakeRepository('a')) as a:
+        with pool.checkout('a', lambda: FakeRepository('a')) as again:
+            again.should.be(a)
+            pool.close('a')
+
+        ('a' in pool).should.be.false
+        a.freed.should.be.false
+
+    a.freed.should.be.true
+    pool.users.should.be.empty
+    pool.retired.should.be.empty